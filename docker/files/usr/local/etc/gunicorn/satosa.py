@@ -1,86 +1,90 @@
-import datetime
+import gc
 import json
 import logging
 import os
+import shutil
 import sys
 
-import json_log_formatter
+from oidc2fer.logs import DefaultJSONFormatter, RequestJSONFormatter, logger_config
 
 
-class RequestJSONFormatter(json_log_formatter.JSONFormatter):
+class NoPingFilter(logging.Filter):
+    """
+    Filters out /ping requests and /metrics scrapes from the access log.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not( record.args.get("m", "") == "GET"
+                   and record.args.get("U", "") in ("/ping", "/metrics")
+                   and str(record.args.get("s", "")) == "200" )
+
+
+# Set before the workers load the app, for them to share their metrics through
+# files in this directory, see oidc2fer.metrics
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+# The preloaded app opens the files of its unlabelled metrics when loaded,
+# before on_starting
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def on_starting(server):
     """
-    Converts Gunicorn request log records to JSON.
+    Refuses to start several workers if the preloaded app must run in a single
+    one, see oidc2fer.workers, and clears the metrics of the previous run. The
+    files of the preloaded app are removed too, the workers write to files
+    named after their own pid.
+    """
+    from oidc2fer import workers
+
+    workers.check(server.num_workers)
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
 
-    See https://docs.gunicorn.org/en/stable/settings.html#access-log-format
+def when_ready(server):
     """
+    Moves the objects of the preloaded app out of the garbage collector's
+    reach, so that collections in the workers don't write to the memory pages
+    they share with the master.
+    """
+    gc.freeze()
+
 
-    def json_record(
-        self,
-        message: str,
-        extra: dict[str, str | int | float],
-        record: logging.LogRecord,
-    ) -> dict[str, str | int | float]:
-        # Convert the log record to a JSON object.
-
-        response_time = datetime.datetime.strptime(
-            record.args["t"], "[%d/%b/%Y:%H:%M:%S %z]"
-        )
-        url = record.args["U"]
-        if record.args["q"]:
-            url += f"?{record.args['q']}"
-
-        return {
-            "logger": record.name,
-            "level": record.levelname,
-            "remote_ip": record.args["h"],
-            "method": record.args["m"],
-            "path": url,
-            "status": str(record.args["s"]),
-            "time": response_time.isoformat(),
-            "user_agent": record.args["a"],
-            "referer": record.args["f"],
-            "duration_in_ms": record.args["M"],
-            "pid": record.process,
-        }
-
-
-class DefaultJSONFormatter(json_log_formatter.JSONFormatter):
+def post_fork(server, worker):
     """
-    Formats a log record as JSON, adding level and pid.
+    Creates the resources of the app that can't be shared with the master,
+    like threads, see oidc2fer.workers.
     """
+    from oidc2fer import workers
 
-    def json_record(
-        self,
-        message: str,
-        extra: dict[str, str | int | float],
-        record: logging.LogRecord,
-    ) -> dict[str, str | int | float]:
-        payload: dict[str, str | int | float] = super().json_record(
-            message, extra, record
-        )
-        payload["logger"] = record.name
-        payload["level"] = record.levelname
-        payload["pid"] = record.process
-        return payload
+    workers.start()
 
 
-class NoPingFilter(logging.Filter):
+def child_exit(server, worker):
     """
-    Filters out /ping requests from the access log.
+    Removes the live gauges of a worker from the metrics, its counters and
+    histograms keep being added up.
     """
+    from prometheus_client import multiprocess
 
-    def filter(self, record: logging.LogRecord) -> bool:
-        return not( record.args.get("m", "") == "GET"
-                   and record.args.get("U", "") == "/ping"
-                   and str(record.args.get("s", "")) == "200" )
+    multiprocess.mark_process_dead(worker.pid)
 
 
 bind = ["0.0.0.0:8000"]
 name = "satosa"
 python_path = "/app"
 wsgi_app = "oidc2fer.wsgi:app"
+# Load the app in the master before forking the workers: the configuration,
+# keys, client db and federation metadata are parsed once, and their memory is
+# shared by the workers. Code changes then need a restart instead of a HUP.
+preload_app = True
 
 # Run
+# Each worker handles requests in a pool of threads, so that a slow client or
+# slow I/O holds a thread instead of a whole process. The state shared by the
+# threads is either immutable or swapped atomically when reloaded.
+worker_class = "gthread"
+threads = 4
 graceful_timeout = 90
 timeout = 90
 
@@ -130,7 +134,13 @@ logconfig_dict = {
         "satosa.frontends.ping": {
             "level": "INFO",
         },
-        **{k: {"level": v.upper()} for k, v in loglevels.items()},
+        # Logs the stage timing histograms as JSON, with their labels and
+        # quantiles as fields
+        "oidc2fer.stage_timing": {
+            "level": "INFO",
+        },
+        # A level, or an object of a level and a `sample` or `per_second` rate
+        **{k: logger_config(v) for k, v in loglevels.items()},
     },
     "formatters": {
         "json_request": {
@@ -140,14 +150,15 @@ logconfig_dict = {
             "()": DefaultJSONFormatter,
         },
     },
+    # The records are written to stdout by a thread, see oidc2fer.logs
     "handlers": {
         "json_request": {
-            "class": "logging.StreamHandler",
+            "class": "oidc2fer.logs.QueueStreamHandler",
             "stream": sys.stdout,
             "formatter": "json_request",
         },
         "json_error": {
-            "class": "logging.StreamHandler",
+            "class": "oidc2fer.logs.QueueStreamHandler",
             "stream": sys.stdout,
             "formatter": "json_error",
         },
@@ -1,51 +1,437 @@
+import asyncio
 import csv
+import concurrent.futures
+import datetime
+import email.utils
+import importlib.util
 import json
+import logging
 import os
+import threading
+import urllib.error
+import urllib.parse
 import urllib.request
-import sys
 import time
 import argparse
+import bisect
+import random
 import re
-import subprocess
+import struct
+import sys
 
 RED = '\033[91m'
 RESET = '\033[0m'
 
-def check_siret_info(siret):
-    url = f"https://recherche-entreprises.api.gouv.fr/search?q={siret}"
-    max_retries = 3
+SIRET_API_URL = "https://recherche-entreprises.api.gouv.fr/search"
+# The API allows 7 requests per second
+SIRET_API_RATE = 7
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'oidc2fer')
+GRIST_IDPS_URL = "https://grist.numerique.gouv.fr/api/docs/gNkPzdjPZnv8rjdedfYhry/tables/Fournisseurs_d_identite/records"
+DISCOVERY_IDPS_URL = "https://discovery.renater.fr/agentconnect/api.php"
+GATEWAY_IDP_NAME = 'Passerelle Fédération Éducation Recherche'
+SATOSA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'satosa')
+
+# Progress and errors go to stderr, stdout being the SIRET map
+logger = logging.getLogger('process_renater_csv')
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, in bursts of at most `capacity`,
+    shared by all threads. `pause` stops all calls, e.g. when told to Retry-After."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class DiskCache:
+    """JSON file of results keyed by string, each one valid for `ttl` seconds.
+    Nothing is read or written if `path` is None."""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"{RED}Ignoring unreadable cache {path}: {e}{RESET}")
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and time.time() - entry['checked_at'] < self.ttl:
+            return entry['value']
+        return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = {'checked_at': time.time(), 'value': value}
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self.lock:
+            now = time.time()
+            entries = {k: e for k, e in self.entries.items() if now - e['checked_at'] < self.ttl}
+            with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(f"{self.path}.tmp", self.path)
+
+def parse_retry_after(value, default=2):
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+def parse_siret_info(siret, data):
+    if not data.get('results'):
+        return {'status': 'not_found', 'name': None}
+
+    result = data['results'][0]
+    name = result.get('nom_complet') or result.get('nom_commercial')
+
+    for etab in result.get('matching_etablissements', []):
+        if etab.get('siret') == siret:
+            enseignes = etab.get('liste_enseignes')
+            enseigne = enseignes[0] if enseignes else None
+
+            etab_name = etab.get('nom_commercial') or enseigne or name
+            is_open = etab.get('etat_administratif') == 'A'
+            return {'status': 'open' if is_open else 'closed', 'name': f"{name} :: {etab_name}"}
+
+    is_open = result.get('etat_administratif') == 'A'
+    return {'status': 'open' if is_open else 'closed', 'name': name}
+
+def check_siret_info(siret, rate_limiter=None, api_url=SIRET_API_URL, max_retries=5):
+    url = f"{api_url}?{urllib.parse.urlencode({'q': siret})}"
     for attempt in range(max_retries):
+        if rate_limiter:
+            rate_limiter.acquire()
         try:
             req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req) as response:
-                data = json.loads(response.read().decode())
-                if not data.get('results'):
-                    return {'status': 'not_found', 'name': None}
-                
-                result = data['results'][0]
-                name = result.get('nom_complet') or result.get('nom_commercial')
-                
-                for etab in result.get('matching_etablissements', []):
-                    if etab.get('siret') == siret:
-                        enseignes = etab.get('liste_enseignes')
-                        enseigne = enseignes[0] if enseignes else None
-                        
-                        etab_name = etab.get('nom_commercial') or enseigne or name
-                        is_open = etab.get('etat_administratif') == 'A'
-                        return {'status': 'open' if is_open else 'closed', 'name': f"{name} :: {etab_name}"}
-                
-                is_open = result.get('etat_administratif') == 'A'
-                return {'status': 'open' if is_open else 'closed', 'name': name}
+            with urllib.request.urlopen(req, timeout=10) as response:
+                return parse_siret_info(siret, json.loads(response.read().decode()))
         except Exception as e:
             if getattr(e, 'code', None) == 429 and attempt < max_retries - 1:
-                time.sleep(2)
+                retry_after = parse_retry_after(e.headers.get('Retry-After'))
+                if rate_limiter:
+                    rate_limiter.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
                 continue
-            print(f"{RED}Error checking {siret}: {e}{RESET}", file=sys.stderr)
+            logger.error(f"{RED}Error checking {siret}: {e}{RESET}")
             return {'status': 'error', 'name': None}
     return {'status': 'error', 'name': None}
 
-def read_csv_entries(csv_path):
-    entries = []
+def check_sirets(sirets, concurrency=4, rate=SIRET_API_RATE, cache=None, api_url=SIRET_API_URL):
+    """Checks the given SIRETs concurrently, at most `rate` requests per second, and
+    returns their info by SIRET. SIRETs with fresh results in `cache` are not queried."""
+    infos = {}
+    to_check = []
+    for siret in dict.fromkeys(sirets):
+        cached = cache.get(f"siret:{siret}") if cache else None
+        if cached is not None:
+            infos[siret] = cached
+        else:
+            to_check.append(siret)
+
+    rate_limiter = TokenBucket(rate)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for siret, info in zip(to_check, executor.map(lambda s: check_siret_info(s, rate_limiter, api_url), to_check)):
+            infos[siret] = info
+            # Errors are transient, check again next time
+            if cache and info['status'] != 'error':
+                cache.set(f"siret:{siret}", info)
+    if cache:
+        cache.save()
+    return infos
+
+DNS_TYPE_MX = 15
+DNS_RCODE_NXDOMAIN = 3
+# Set when the answer didn't fit in a UDP datagram
+DNS_FLAG_TC = 0x0200
+
+class DNSError(Exception):
+    pass
+
+def default_dns_server():
+    try:
+        with open('/etc/resolv.conf', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1]
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+def build_mx_query(domain, query_id):
+    # Header with the "recursion desired" flag, then a single MX question
+    query = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    for label in domain.rstrip('.').encode('idna').split(b'.'):
+        query += bytes([len(label)]) + label
+    return query + struct.pack('>BHH', 0, DNS_TYPE_MX, 1)
+
+def skip_dns_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        # Compressed name: a pointer to a previous one ends the name
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def is_truncated(data):
+    return bool(struct.unpack('>H', data[2:4])[0] & DNS_FLAG_TC)
+
+def parse_mx_response(data):
+    """Returns whether the response holds MX records, False for non-existent domains."""
+    _, flags, question_count, answer_count = struct.unpack('>HHHH', data[:8])
+    if flags & DNS_FLAG_TC:
+        raise DNSError("the DNS server answered with a truncated response")
+    rcode = flags & 0xF
+    if rcode == DNS_RCODE_NXDOMAIN:
+        return False
+    if rcode != 0:
+        raise DNSError(f"DNS server answered with RCODE {rcode}")
+    offset = 12
+    for _ in range(question_count):
+        offset = skip_dns_name(data, offset) + 4
+    for _ in range(answer_count):
+        offset = skip_dns_name(data, offset)
+        record_type, _, _, length = struct.unpack('>HHIH', data[offset:offset + 10])
+        if record_type == DNS_TYPE_MX:
+            return True
+        offset += 10 + length
+    return False
+
+class DNSClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id):
+        self.query_id = query_id
+        self.response = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 12 and struct.unpack('>H', data[:2])[0] == self.query_id and not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
+async def query_over_tcp(query, dns_server, timeout):
+    """Returns the response to `query` over TCP, for the answers too large for UDP."""
+    async def exchange():
+        reader, writer = await asyncio.open_connection(*dns_server)
+        try:
+            writer.write(struct.pack('>H', len(query)) + query)
+            await writer.drain()
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    try:
+        response = await asyncio.wait_for(exchange(), timeout)
+    except asyncio.TimeoutError:
+        raise DNSError(f"no answer over TCP from DNS server {dns_server[0]} after {timeout}s") from None
+    except asyncio.IncompleteReadError as e:
+        raise DNSError(f"incomplete answer over TCP from DNS server {dns_server[0]}") from e
+    if response[:2] != query[:2]:
+        raise DNSError(f"unexpected answer over TCP from DNS server {dns_server[0]}")
+    return response
+
+async def has_mx_record(domain, dns_server, timeout=5, attempts=2):
+    loop = asyncio.get_running_loop()
+    for attempt in range(attempts):
+        query_id = random.getrandbits(16)
+        query = build_mx_query(domain, query_id)
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: DNSClientProtocol(query_id), remote_addr=dns_server)
+        try:
+            transport.sendto(query)
+            response = await asyncio.wait_for(protocol.response, timeout)
+        except asyncio.TimeoutError:
+            if attempt == attempts - 1:
+                raise DNSError(f"no answer from DNS server {dns_server[0]} after {timeout}s") from None
+            continue
+        finally:
+            transport.close()
+        # The records that didn't fit may be the MX ones
+        if is_truncated(response):
+            response = await query_over_tcp(query, dns_server, timeout)
+        return parse_mx_response(response)
+
+async def check_mx_domains_async(domains, dns_server, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(domain):
+        async with semaphore:
+            try:
+                return await has_mx_record(domain, dns_server)
+            except (OSError, DNSError, UnicodeError, struct.error, IndexError) as e:
+                return f"{type(e).__name__}: {e}"
+
+    return dict(zip(domains, await asyncio.gather(*(check(d) for d in domains))))
+
+def check_mx_domains(domains, dns_server=None, concurrency=20, cache=None):
+    """Resolves the MX records of all the given domains at once, and returns by domain
+    True if there are some, False if there are none, or an error message. Each domain is
+    resolved once, unless it has a fresh result in `cache`. `dns_server` is an address,
+    or an (address, port) pair."""
+    results = {}
+    to_check = []
+    for domain in dict.fromkeys(d.lower() for d in domains):
+        cached = cache.get(f"mx:{domain}") if cache else None
+        if cached is not None:
+            results[domain] = cached
+        else:
+            to_check.append(domain)
+
+    dns_server = dns_server or default_dns_server()
+    if isinstance(dns_server, str):
+        dns_server = (dns_server, 53)
+    if to_check:
+        checked = asyncio.run(check_mx_domains_async(to_check, dns_server, concurrency))
+        for domain, result in checked.items():
+            results[domain] = result
+            # Errors are transient, check again next time
+            if cache and isinstance(result, bool):
+                cache.set(f"mx:{domain}", result)
+    if cache:
+        cache.save()
+    return results
+
+class DomainIndex:
+    """Owners of domains, which also finds the owners of the parent domains and of the
+    subdomains of a domain: mail.univ.fr overlaps both univ.fr and smtp.mail.univ.fr."""
+
+    def __init__(self, owners=None):
+        self.owners = {}
+        # Domains with their labels reversed (fr.univ.mail), sorted so that the
+        # subdomains of a domain are next to each other
+        self.reversed_domains = []
+        for domain, owner in (owners or {}).items():
+            self.add(domain, owner)
+
+    @staticmethod
+    def normalize(domain):
+        return domain.lower().rstrip('.')
+
+    @staticmethod
+    def reverse(domain):
+        return '.'.join(reversed(domain.split('.')))
+
+    def add(self, domain, owner):
+        """Adds the domain, unless it already has an owner."""
+        domain = self.normalize(domain)
+        if domain not in self.owners:
+            self.owners[domain] = owner
+            bisect.insort(self.reversed_domains, self.reverse(domain))
+
+    def __contains__(self, domain):
+        return self.normalize(domain) in self.owners
+
+    def __getitem__(self, domain):
+        return self.owners[self.normalize(domain)]
+
+    def get(self, domain, default=None):
+        return self.owners.get(self.normalize(domain), default)
+
+    def overlaps(self, domain):
+        """Returns the (domain, owner) pairs for the parent domains and the subdomains
+        of `domain`, not including itself."""
+        domain = self.normalize(domain)
+        labels = domain.split('.')
+        parents = ['.'.join(labels[i:]) for i in range(1, len(labels) - 1)]
+        matches = [(parent, self.owners[parent]) for parent in parents if parent in self.owners]
+        # Every domain is under a top-level domain
+        if len(labels) < 2:
+            return matches
+        prefix = self.reverse(domain) + '.'
+        for reversed_domain in self.reversed_domains[bisect.bisect_left(self.reversed_domains, prefix):]:
+            if not reversed_domain.startswith(prefix):
+                break
+            subdomain = self.reverse(reversed_domain)
+            matches.append((subdomain, self.owners[subdomain]))
+        return matches
+
+def fetch_snapshot(url, path, build_index, headers=None):
+    """Returns build_index(<JSON document at `url`>). The index is saved to `path` with
+    the ETag and Last-Modified of the document, and reused as long as the server
+    answers 304 Not Modified, or if the server can't be reached."""
+    snapshot = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"{RED}Ignoring unreadable snapshot {path}: {e}{RESET}")
+        if snapshot and snapshot.get('url') != url:
+            snapshot = None
+
+    request_headers = {'User-Agent': 'Mozilla/5.0', **(headers or {})}
+    if snapshot and snapshot.get('etag'):
+        request_headers['If-None-Match'] = snapshot['etag']
+    if snapshot and snapshot.get('last_modified'):
+        request_headers['If-Modified-Since'] = snapshot['last_modified']
+
+    try:
+        req = urllib.request.Request(url, headers=request_headers)
+        with urllib.request.urlopen(req, timeout=30) as response:
+            index = build_index(json.loads(response.read().decode()))
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and snapshot:
+            return snapshot['index']
+        if not snapshot:
+            raise
+        logger.warning(f"{RED}Using snapshot from {path} as {url} failed: {e}{RESET}")
+        return snapshot['index']
+    except (OSError, ValueError) as e:
+        if not snapshot:
+            raise
+        logger.warning(f"{RED}Using snapshot from {path} as {url} failed: {e}{RESET}")
+        return snapshot['index']
+
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'index': index}, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+    return index
+
+def iter_csv_entries(csv_path):
     with open(csv_path, 'r', newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         for row in reader:
@@ -59,120 +445,186 @@ def read_csv_entries(csv_path):
                 
             domains = [d for d in re.split(r'\s+', domains_raw) if d]
             
-            entries.append({
+            yield {
                 'name': nom_csv,
                 'entity_id': entity_id,
                 'siret': siret,
                 'domains': domains,
                 'errors': []
-            })
-    return entries
+            }
 
-def check_entry_domains(entry, check_grist, check_mx, grist_domains, seen_domains):
+def read_csv_entries(csv_path):
+    return list(iter_csv_entries(csv_path))
+
+def report_error(entry, message):
+    logger.error(f"  {RED}{message}{RESET}")
+    entry['errors'].append(message)
+
+def check_entry_domains(entry, check_grist, check_mx, grist_domains, seen_domains, mx_results=None):
     is_success = True
     for d in entry['domains']:
         if check_grist:
             if d in seen_domains:
                 conflicting_name = seen_domains[d]
-                print(f"  {RED}ERROR: Domain conflict (internal): '{d}' is also used by '{conflicting_name}'{RESET}", file=sys.stderr)
+                report_error(entry, f"ERROR: Domain conflict (internal): '{d}' is also used by '{conflicting_name}'")
                 is_success = False
             else:
-                seen_domains[d] = entry['name']
+                for overlapping, conflicting_name in seen_domains.overlaps(d):
+                    # The entry's own domains may overlap each other
+                    if overlapping not in entry['domains']:
+                        report_error(entry, f"ERROR: Domain conflict (internal): '{d}' overlaps '{overlapping}' used by '{conflicting_name}'")
+                        is_success = False
+                seen_domains.add(d, entry['name'])
             
             if d in grist_domains:
                 idp_name = grist_domains[d]
-                if idp_name == 'Passerelle Fédération Éducation Recherche':
-                    print(f"  Grist: Domain '{d}' found in '{idp_name}'", file=sys.stderr)
+                if idp_name == GATEWAY_IDP_NAME:
+                    logger.info(f"  Grist: Domain '{d}' found in '{idp_name}'")
                 else:
-                    print(f"  {RED}ERROR: Domain conflict (external): '{d}' is already used by Grist IdP '{idp_name}'{RESET}", file=sys.stderr)
+                    report_error(entry, f"ERROR: Domain conflict (external): '{d}' is already used by Grist IdP '{idp_name}'")
+                    is_success = False
+            for overlapping, idp_name in grist_domains.overlaps(d):
+                if idp_name != GATEWAY_IDP_NAME:
+                    report_error(entry, f"ERROR: Domain conflict (external): '{d}' overlaps '{overlapping}' used by Grist IdP '{idp_name}'")
                     is_success = False
         
         if check_mx:
-            try:
-                result = subprocess.run(['dig', '+short', 'MX', d], capture_output=True, text=True, timeout=5)
-                if not result.stdout.strip():
-                    print(f"  {RED}ERROR: No MX record found for domain '{d}'{RESET}", file=sys.stderr)
-                    is_success = False
-            except Exception as e:
-                print(f"  {RED}ERROR: Failed to check MX record for domain '{d}': {e}{RESET}", file=sys.stderr)
+            if mx_results is None:
+                mx_results = check_mx_domains(entry['domains'])
+            result = mx_results[d.lower()]
+            if result is False:
+                report_error(entry, f"ERROR: No MX record found for domain '{d}'")
+                is_success = False
+            elif result is not True:
+                report_error(entry, f"ERROR: Failed to check MX record for domain '{d}': {result}")
                 is_success = False
     return is_success
 
-def get_grist_idps():
+def index_grist_idps(data):
     grist_domains = {}
-    url = "https://grist.numerique.gouv.fr/api/docs/gNkPzdjPZnv8rjdedfYhry/tables/Fournisseurs_d_identite/records"
+    for record in data.get('records', []):
+        fields = record.get('fields', {})
+        fqdns_raw = fields.get('Liste_des_FQDN')
+        if not fqdns_raw:
+            continue
+        
+        if isinstance(fqdns_raw, list):
+            fqdns_raw = " ".join(str(x) for x in fqdns_raw)
+        else:
+            fqdns_raw = str(fqdns_raw)
+        
+        fqdns = [d for d in re.split(r'[\s,]+', fqdns_raw) if d]
+        idp_name = fields.get('Titre') or fields.get('Nom_raccourci') or fields.get('Nom') or record.get('id')
+        
+        for fqdn in fqdns:
+            grist_domains[fqdn] = idp_name
+    return grist_domains
+
+def get_grist_idps(snapshot_path=None, url=GRIST_IDPS_URL):
     try:
-        req = urllib.request.Request(url, headers={
-            'User-Agent': 'Mozilla/5.0',
+        return DomainIndex(fetch_snapshot(url, snapshot_path, index_grist_idps, headers={
             'Authorization': f'Bearer { os.environ.get("GRIST_API_KEY") }'
-        })
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            
-            for record in data.get('records', []):
-                fields = record.get('fields', {})
-                fqdns_raw = fields.get('Liste_des_FQDN')
-                if not fqdns_raw:
-                    continue
-                
-                if isinstance(fqdns_raw, list):
-                    fqdns_raw = " ".join(str(x) for x in fqdns_raw)
-                else:
-                    fqdns_raw = str(fqdns_raw)
-                
-                fqdns = [d for d in re.split(r'[\s,]+', fqdns_raw) if d]
-                idp_name = fields.get('Titre') or fields.get('Nom_raccourci') or fields.get('Nom') or record.get('id')
-                
-                for fqdn in fqdns:
-                    grist_domains[fqdn] = idp_name
+        }))
     except Exception as e:
-        print(f"{RED}Error fetching Grist IdPs: {e}{RESET}", file=sys.stderr)
+        logger.error(f"{RED}Error fetching Grist IdPs: {e}{RESET}")
         raise e
-    return grist_domains
 
-def process_entry_siret(entry, check_siret, entity_to_siret):
+def process_entry_siret(entry, check_siret, entity_to_siret, siret_infos=None):
     is_success = True
     if check_siret:
-        info = check_siret_info(entry['siret'])
+        info = (siret_infos or {}).get(entry['siret']) or check_siret_info(entry['siret'])
         
         if info.get('name'):
-            print(f"  SIRET API Name : {info['name']}", file=sys.stderr)
-        print(f"  SIRET Link     : https://annuaire-entreprises.data.gouv.fr/etablissement/{entry['siret']}", file=sys.stderr)
+            logger.info(f"  SIRET API Name : {info['name']}")
+        logger.info(f"  SIRET Link     : https://annuaire-entreprises.data.gouv.fr/etablissement/{entry['siret']}")
         
         if info['status'] == 'open':
-            print(f"  SIRET Status   : Open", file=sys.stderr)
+            logger.info(f"  SIRET Status   : Open")
             entity_to_siret[entry['entity_id']] = entry['siret']
         elif info['status'] == 'closed':
             is_success = False
-            print(f"  {RED}SIRET Status   : Closed{RESET}", file=sys.stderr)
+            report_error(entry, "SIRET Status   : Closed")
         elif info['status'] == 'not_found':
             is_success = False
-            print(f"  {RED}SIRET Status   : Not found{RESET}", file=sys.stderr)
+            report_error(entry, "SIRET Status   : Not found")
         else:
             is_success = False
-            print(f"  {RED}SIRET Status   : Error fetching info{RESET}", file=sys.stderr)
-        
-        time.sleep(0.5)
+            report_error(entry, "SIRET Status   : Error fetching info")
     else:
         entity_to_siret[entry['entity_id']] = entry['siret']
     return is_success
 
 
-def get_discovery_idps():
-    url = "https://discovery.renater.fr/agentconnect/api.php"
+def index_discovery_idps(data):
     idp_map = {}
+    for group in data:
+        if isinstance(group, dict) and 'children' in group:
+            for child in group['children']:
+                if 'id' in child and 'text' in child:
+                    idp_map[child['id']] = child['text']
+    return idp_map
+
+def get_discovery_idps(snapshot_path=None, url=DISCOVERY_IDPS_URL):
     try:
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            for group in data:
-                if isinstance(group, dict) and 'children' in group:
-                    for child in group['children']:
-                        if 'id' in child and 'text' in child:
-                            idp_map[child['id']] = child['text']
+        return fetch_snapshot(url, snapshot_path, index_discovery_idps)
     except Exception as e:
-        print(f"{RED}Error fetching discovery service IdP list: {e}{RESET}", file=sys.stderr)
-    return idp_map
+        logger.error(f"{RED}Error fetching discovery service IdP list: {e}{RESET}")
+    return {}
+
+def iter_batches(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_checked_batches(entries, check_batch, batch_size):
+    """Yields (batch, check_batch(batch)) for batches of `batch_size` entries. The next
+    batch is read and checked in the background while the current one is consumed."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for batch in iter_batches(entries, batch_size):
+            future = executor.submit(check_batch, batch)
+            if pending:
+                yield pending[0], pending[1].result()
+            pending = (batch, future)
+        if pending:
+            yield pending[0], pending[1].result()
+
+def load_checkpoint(path):
+    """Returns the results already written to the JSON Lines file at `path`, and drops
+    any incomplete last line, e.g. from an interrupted run."""
+    results = []
+    valid_size = 0
+    if not os.path.exists(path):
+        return results
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                results.pop()
+                break
+            valid_size += len(line)
+    os.truncate(path, valid_size)
+    return results
+
+def write_siret_map_file(path, entity_to_siret):
+    """Replaces the SIRET map file at `path` with `entity_to_siret`, with the
+    write_mapping_file function of the gateway, which reloads the file."""
+    # Only the module is loaded, its package imports SATOSA
+    if SATOSA_DIR not in sys.path:
+        sys.path.append(SATOSA_DIR)
+    spec = importlib.util.spec_from_file_location(
+        'siret_mapping', os.path.join(SATOSA_DIR, 'oidc2fer', 'attribute_generators', 'siret_mapping.py'))
+    siret_mapping = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(siret_mapping)
+    siret_mapping.write_mapping_file(path, entity_to_siret)
 
 def main():
     parser = argparse.ArgumentParser(description="Check requested IdP additions from RENATER.")
@@ -182,7 +634,21 @@ def main():
     parser.add_argument('--check-mx', action='store_true', help="Check that an MX record exists for each domain")
     parser.add_argument('--check-discovery', action='store_true', help="Check that CSV Entity IDs are present in the discovery service")
     parser.add_argument('--check-all', action='store_true', help="Run all checks (--check-siret, --check-grist, --check-mx, --check-discovery)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of concurrent SIRET API requests (default: 4)")
+    parser.add_argument('--dns-server', help="DNS server used to check MX records (default: the first nameserver of /etc/resolv.conf)")
+    parser.add_argument('--dns-concurrency', type=int, default=20, help="Number of concurrent DNS queries (default: 20)")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help=f"Directory where check results are cached across runs (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-ttl', type=float, default=24, help="Hours during which cached check results are reused (default: 24)")
+    parser.add_argument('--no-cache', action='store_true', help="Neither read nor write cached check results")
+    parser.add_argument('--siret-map-file', help="Also write the SIRET map to this file, replacing it, read by EntityIdToSiretMapper's mapping_path")
+    parser.add_argument('--output', help="Write the result of each entry to this JSON Lines file as soon as it is checked")
+    parser.add_argument('--resume', action='store_true', help="Skip the entries already in --output, e.g. after an interrupted run")
+    parser.add_argument('--batch-size', type=int, default=50, help="Number of entries checked together (default: 50)")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.resume and not args.output:
+        parser.error("--resume requires --output")
 
     if args.check_all:
         args.check_siret = True
@@ -192,66 +658,117 @@ def main():
 
     csv_path = args.csv_file
     
-    print(f"Reading {csv_path}...", file=sys.stderr)
-    entries = read_csv_entries(csv_path)
-
-    all_csv_domains = [d for entry in entries for d in entry['domains']]
-    
-    grist_domains = {}
+    grist_domains = DomainIndex()
     if args.check_grist:
-        print("Fetching Grist IdPs...", file=sys.stderr)
-        grist_domains = get_grist_idps()
+        logger.info("Fetching Grist IdPs...")
+        grist_domains = get_grist_idps(None if args.no_cache else os.path.join(args.cache_dir, 'grist.json'))
 
     discovery_idps = {}
     if args.check_discovery:
-        print("Fetching discovery IdPs...", file=sys.stderr)
-        discovery_idps = get_discovery_idps()
+        logger.info("Fetching discovery IdPs...")
+        discovery_idps = get_discovery_idps(None if args.no_cache else os.path.join(args.cache_dir, 'discovery.json'))
+
+    siret_cache = DiskCache(None if args.no_cache else os.path.join(args.cache_dir, 'siret.json'), args.cache_ttl * 3600)
+    mx_cache = DiskCache(None if args.no_cache else os.path.join(args.cache_dir, 'mx.json'), args.cache_ttl * 3600)
+
+    def check_batch(batch):
+        # SIRET and MX checks of a batch run at the same time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            siret_infos = executor.submit(check_sirets, [entry['siret'] for entry in batch], args.concurrency, cache=siret_cache) if args.check_siret else None
+            mx_results = executor.submit(check_mx_domains, [d for entry in batch for d in entry['domains']], args.dns_server, args.dns_concurrency, mx_cache) if args.check_mx else None
+            return (siret_infos.result() if siret_infos else {}), (mx_results.result() if mx_results else None)
 
-    print("", file=sys.stderr)
+    logger.info("")
     
+    all_csv_domains = []
     entity_to_siret = {}
     success_count = 0
     error_count = 0
-    seen_domains = {}
-
-    for entry in entries:
-        is_success = True
-        print(f"--- \033[1m{entry['name']}\033[0m ---", file=sys.stderr)
-        print(f"  EntityID : {entry['entity_id']}", file=sys.stderr)
-        print(f"  Domains  : {' '.join(entry['domains'])}", file=sys.stderr)
-        
-        if not check_entry_domains(entry, args.check_grist, args.check_mx, grist_domains, seen_domains):
-            is_success = False
+    seen_domains = DomainIndex()
 
-        if not process_entry_siret(entry, args.check_siret, entity_to_siret):
-            is_success = False
-            
-        if args.check_discovery:
-            if entry['entity_id'] in discovery_idps:
-                print(f"  Discovery: Found -> {discovery_idps[entry['entity_id']]}", file=sys.stderr)
+    # Entries already checked by a previous run are replayed from the output
+    done = set()
+    if args.resume:
+        for result in load_checkpoint(args.output):
+            done.add(result['entity_id'])
+            all_csv_domains.extend(result['domains'])
+            for d in result['domains']:
+                seen_domains.add(d, result['name'])
+            if result['siret_mapped']:
+                entity_to_siret[result['entity_id']] = result['siret']
+            if result['success']:
+                success_count += 1
             else:
-                is_success = False
-                print(f"  {RED}Discovery: NOT FOUND in discovery service{RESET}", file=sys.stderr)
+                error_count += 1
+        logger.info(f"Resuming after {len(done)} entries already checked in {args.output}")
 
-        if is_success:
-            success_count += 1
-        else:
-            error_count += 1
+    logger.info(f"Reading {csv_path}...")
+    entries = (entry for entry in iter_csv_entries(csv_path) if entry['entity_id'] not in done)
 
-        print("", file=sys.stderr)
+    output = open(args.output, 'a' if args.resume else 'w', encoding='utf-8') if args.output else None
+    try:
+        for batch, (siret_infos, mx_results) in iter_checked_batches(entries, check_batch, args.batch_size):
+            for entry in batch:
+                logger.info(f"--- \033[1m{entry['name']}\033[0m ---")
+                logger.info(f"  EntityID : {entry['entity_id']}")
+                logger.info(f"  Domains  : {' '.join(entry['domains'])}")
+                all_csv_domains.extend(entry['domains'])
+                
+                is_success = True
+                if not check_entry_domains(entry, args.check_grist, args.check_mx, grist_domains, seen_domains, mx_results):
+                    is_success = False
+
+                if not process_entry_siret(entry, args.check_siret, entity_to_siret, siret_infos):
+                    is_success = False
+                    
+                if args.check_discovery:
+                    if entry['entity_id'] in discovery_idps:
+                        logger.info(f"  Discovery: Found -> {discovery_idps[entry['entity_id']]}")
+                    else:
+                        is_success = False
+                        report_error(entry, "Discovery: NOT FOUND in discovery service")
+
+                if is_success:
+                    success_count += 1
+                else:
+                    error_count += 1
+
+                if output:
+                    siret_info = siret_infos.get(entry['siret']) or {}
+                    output.write(json.dumps({
+                        **entry,
+                        'siret_status': siret_info.get('status'),
+                        'siret_name': siret_info.get('name'),
+                        'siret_mapped': entry['entity_id'] in entity_to_siret,
+                        'success': is_success,
+                    }, ensure_ascii=False) + '\n')
+                    output.flush()
+
+                logger.info("")
+    except KeyboardInterrupt:
+        if output:
+            logger.info(f"Interrupted, run again with --resume to continue from {args.output}")
+        raise
+    finally:
+        if output:
+            output.close()
 
     if all_csv_domains:
-        print("--- ALL CSV DOMAINS ---", file=sys.stderr)
-        print(" ".join(all_csv_domains), file=sys.stderr)
-        print("", file=sys.stderr)
+        logger.info("--- ALL CSV DOMAINS ---")
+        logger.info(" ".join(all_csv_domains))
+        logger.info("")
 
-    print("--- SIRET MAP ---", file=sys.stderr)
+    logger.info("--- SIRET MAP ---")
     print(json.dumps(entity_to_siret, indent=4))
 
-    print("--- SUMMARY ---", file=sys.stderr)
-    print(f"  Successfully checked: \033[92m{success_count}\033[0m", file=sys.stderr)
-    print(f"  Entries in error:     {RED}{error_count}{RESET}", file=sys.stderr)
-    print("", file=sys.stderr)
+    if args.siret_map_file:
+        write_siret_map_file(args.siret_map_file, entity_to_siret)
+        logger.info(f"Wrote {len(entity_to_siret)} entries to {args.siret_map_file}")
+
+    logger.info("--- SUMMARY ---")
+    logger.info(f"  Successfully checked: \033[92m{success_count}\033[0m")
+    logger.info(f"  Entries in error:     {RED}{error_count}{RESET}")
+    logger.info("")
 
 if __name__ == "__main__":
     main()
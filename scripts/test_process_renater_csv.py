@@ -0,0 +1,580 @@
+import json
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import process_renater_csv
+from process_renater_csv import (
+    DiskCache,
+    DomainIndex,
+    TokenBucket,
+    check_entry_domains,
+    check_mx_domains,
+    check_sirets,
+    get_discovery_idps,
+    get_grist_idps,
+    iter_checked_batches,
+    load_checkpoint,
+)
+
+ETABLISSEMENTS = {
+    "12345678200010": {"nom_complet": "UNIVERSITE EXEMPLE", "etat_administratif": "A"},
+    "98765432100015": {"nom_complet": "ECOLE FERMEE", "etat_administratif": "F"},
+}
+
+
+class StubSiretAPI(BaseHTTPRequestHandler):
+    """
+    Answers like recherche-entreprises.api.gouv.fr, after `throttled` 429
+    responses.
+    """
+
+    def do_GET(self):
+        server = self.server
+        siret = parse_qs(urlparse(self.path).query)["q"][0]
+        with server.lock:
+            server.requests.append(siret)
+            throttled = server.throttled > 0
+            server.throttled -= 1
+        if throttled:
+            self.send_response(429)
+            self.send_header("Retry-After", str(server.retry_after))
+            self.end_headers()
+            return
+        results = []
+        if siret in ETABLISSEMENTS:
+            results = [
+                {
+                    **ETABLISSEMENTS[siret],
+                    "matching_etablissements": [
+                        {"siret": siret, **ETABLISSEMENTS[siret]},
+                    ],
+                }
+            ]
+        body = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(name="siret_api")
+def fixture_siret_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSiretAPI)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.throttled = 0
+    server.retry_after = 0
+    server.url = f"http://127.0.0.1:{server.server_port}/search"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+MX_RECORDS = {
+    "univ-exemple.fr": ["mx1.univ-exemple.fr", "mx2.univ-exemple.fr"],
+    "ecole-exemple.fr": ["mx.renater.fr"],
+    "grande-univ.fr": [f"mx{i}.grande-univ.fr" for i in range(40)],
+}
+NO_MX_DOMAINS = {"sans-mx.fr"}
+# Answered over UDP with the TC flag and no records
+TRUNCATED_DOMAINS = {"grande-univ.fr"}
+
+
+def encode_dns_name(name):
+    return b"".join(bytes([len(label)]) + label for label in name.encode().split(b"."))
+
+
+def answer_dns_query(server, query, over_udp):
+    """
+    Answers MX queries from MX_RECORDS, with no records for NO_MX_DOMAINS and
+    NXDOMAIN for other domains.
+    """
+    question_end = query.index(b"\0", 12) + 5
+    labels = []
+    offset = 12
+    while query[offset]:
+        labels.append(query[offset + 1 : offset + 1 + query[offset]].decode())
+        offset += query[offset] + 1
+    domain = ".".join(labels)
+    with server.lock:
+        server.queries.append(domain)
+
+    exchanges = MX_RECORDS.get(domain, [])
+    rcode = 0 if domain in MX_RECORDS or domain in NO_MX_DOMAINS else 3
+    flags = 0x8180 | rcode
+    if over_udp and domain in TRUNCATED_DOMAINS:
+        exchanges = []
+        flags |= 0x0200
+    answers = b""
+    for preference, exchange in enumerate(exchanges):
+        rdata = struct.pack(">H", preference) + encode_dns_name(exchange) + b"\0"
+        # The owner name points to the name in the question
+        answers += struct.pack(">HHHIH", 0xC00C, 15, 1, 300, len(rdata)) + rdata
+    header = struct.pack(
+        ">HHHHHH", struct.unpack(">H", query[:2])[0], flags, 1, len(exchanges), 0, 0
+    )
+    return header + query[12:question_end] + answers
+
+
+class StubDNSServer(socketserver.BaseRequestHandler):
+    def handle(self):
+        query, sock = self.request
+        sock.sendto(answer_dns_query(self.server, query, True), self.client_address)
+
+
+class StubDNSTCPServer(socketserver.StreamRequestHandler):
+    def handle(self):
+        (length,) = struct.unpack(">H", self.rfile.read(2))
+        response = answer_dns_query(self.server, self.rfile.read(length), False)
+        self.wfile.write(struct.pack(">H", len(response)) + response)
+
+
+@pytest.fixture(name="dns_server")
+def fixture_dns_server():
+    server = socketserver.ThreadingUDPServer(("127.0.0.1", 0), StubDNSServer)
+    server.lock = threading.Lock()
+    server.queries = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(name="dns_tcp_server")
+def fixture_dns_tcp_server(dns_server):
+    """
+    Answers over TCP on the port of dns_server.
+    """
+    server = socketserver.ThreadingTCPServer(
+        dns_server.server_address, StubDNSTCPServer
+    )
+    server.lock = threading.Lock()
+    server.queries = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestCheckMxDomains:
+    def test_resolves_each_domain_once(self, dns_server):
+        results = check_mx_domains(
+            [
+                "univ-exemple.fr",
+                "ecole-exemple.fr",
+                "sans-mx.fr",
+                "inexistant.fr",
+                "UNIV-exemple.fr",
+            ],
+            dns_server=dns_server.server_address,
+        )
+        assert results == {
+            "univ-exemple.fr": True,
+            "ecole-exemple.fr": True,
+            "sans-mx.fr": False,
+            "inexistant.fr": False,
+        }
+        assert sorted(dns_server.queries) == sorted(results)
+
+    def test_retries_truncated_answers_over_tcp(self, dns_server, dns_tcp_server):
+        results = check_mx_domains(
+            ["grande-univ.fr", "univ-exemple.fr"], dns_server=dns_server.server_address
+        )
+        assert results == {"grande-univ.fr": True, "univ-exemple.fr": True}
+        assert dns_tcp_server.queries == ["grande-univ.fr"]
+
+    def test_reports_truncated_answers_without_tcp(self, dns_server):
+        results = check_mx_domains(
+            ["grande-univ.fr"], dns_server=dns_server.server_address
+        )
+        assert isinstance(results["grande-univ.fr"], str)
+
+    def test_reports_unreachable_server(self):
+        # Nothing listens on the discard port
+        results = check_mx_domains(["univ-exemple.fr"], dns_server=("127.0.0.1", 9))
+        assert isinstance(results["univ-exemple.fr"], str)
+
+    def test_reuses_cached_results(self, dns_server, tmp_path):
+        cache_path = tmp_path / "mx.json"
+        check_mx_domains(
+            ["univ-exemple.fr"],
+            dns_server=dns_server.server_address,
+            cache=DiskCache(cache_path, ttl=3600),
+        )
+        results = check_mx_domains(
+            ["univ-exemple.fr", "sans-mx.fr"],
+            dns_server=dns_server.server_address,
+            cache=DiskCache(cache_path, ttl=3600),
+        )
+        assert results == {"univ-exemple.fr": True, "sans-mx.fr": False}
+        assert dns_server.queries == ["univ-exemple.fr", "sans-mx.fr"]
+
+    def test_check_entry_domains(self, dns_server):
+        entry = {
+            "name": "Université",
+            "domains": ["univ-exemple.fr", "sans-mx.fr"],
+            "errors": [],
+        }
+        mx_results = check_mx_domains(
+            entry["domains"], dns_server=dns_server.server_address
+        )
+        assert not check_entry_domains(entry, False, True, {}, {}, mx_results)
+        entry["domains"] = ["univ-exemple.fr"]
+        assert check_entry_domains(entry, False, True, {}, {}, mx_results)
+
+    def test_check_entry_domains_reports_conflicts(self):
+        seen_domains = DomainIndex({"univ-exemple.fr": "Université"})
+        grist_domains = DomainIndex({"ecole-exemple.fr": "Autre IdP"})
+        for domain in ("univ-exemple.fr", "mail.univ-exemple.fr", "ecole-exemple.fr"):
+            entry = {"name": "École", "domains": [domain], "errors": []}
+            assert not check_entry_domains(
+                entry, True, False, grist_domains, seen_domains
+            )
+            assert entry["errors"]
+
+
+class TestCheckSirets:
+    def test_checks_each_siret_once(self, siret_api):
+        infos = check_sirets(
+            ["12345678200010", "98765432100015", "11111111111111", "12345678200010"],
+            concurrency=3,
+            rate=1000,
+            api_url=siret_api.url,
+        )
+        assert infos == {
+            "12345678200010": {
+                "status": "open",
+                "name": "UNIVERSITE EXEMPLE :: UNIVERSITE EXEMPLE",
+            },
+            "98765432100015": {
+                "status": "closed",
+                "name": "ECOLE FERMEE :: ECOLE FERMEE",
+            },
+            "11111111111111": {"status": "not_found", "name": None},
+        }
+        assert sorted(siret_api.requests) == sorted(infos)
+
+    def test_retries_after_throttling(self, siret_api):
+        siret_api.throttled = 2
+        siret_api.retry_after = 1
+        started_at = time.monotonic()
+        infos = check_sirets(
+            ["12345678200010", "98765432100015"],
+            concurrency=2,
+            rate=1000,
+            api_url=siret_api.url,
+        )
+        assert infos["12345678200010"]["status"] == "open"
+        assert infos["98765432100015"]["status"] == "closed"
+        assert len(siret_api.requests) == 4
+        assert time.monotonic() - started_at >= 1
+
+    def test_reuses_cached_results(self, siret_api, tmp_path):
+        cache_path = tmp_path / "siret.json"
+        check_sirets(
+            ["12345678200010"],
+            cache=DiskCache(cache_path, ttl=3600),
+            api_url=siret_api.url,
+        )
+        infos = check_sirets(
+            ["12345678200010", "98765432100015"],
+            cache=DiskCache(cache_path, ttl=3600),
+            api_url=siret_api.url,
+        )
+        assert infos["12345678200010"]["status"] == "open"
+        assert siret_api.requests == ["12345678200010", "98765432100015"]
+
+    def test_does_not_cache_errors(self, siret_api, tmp_path, monkeypatch):
+        monkeypatch.setattr(process_renater_csv, "parse_retry_after", lambda _: 0)
+        cache = DiskCache(tmp_path / "siret.json", ttl=3600)
+        siret_api.throttled = 10
+        infos = check_sirets(["12345678200010"], cache=cache, api_url=siret_api.url)
+        assert infos["12345678200010"]["status"] == "error"
+        assert cache.get("siret:12345678200010") is None
+
+
+class TestDiskCache:
+    def test_expires_entries(self, tmp_path):
+        cache = DiskCache(tmp_path / "cache.json", ttl=0)
+        cache.set("key", "value")
+        assert cache.get("key") is None
+
+    def test_persists_entries(self, tmp_path):
+        cache = DiskCache(tmp_path / "cache.json", ttl=3600)
+        cache.set("key", {"status": "open"})
+        cache.save()
+        assert DiskCache(tmp_path / "cache.json", ttl=3600).get("key") == {
+            "status": "open"
+        }
+
+
+class TestTokenBucket:
+    def test_limits_rate(self):
+        rate_limiter = TokenBucket(rate=20)
+        started_at = time.monotonic()
+        for _ in range(5):
+            rate_limiter.acquire()
+        assert time.monotonic() - started_at >= 4 / 20
+
+    def test_pause(self):
+        rate_limiter = TokenBucket(rate=1000)
+        rate_limiter.pause(0.2)
+        started_at = time.monotonic()
+        rate_limiter.acquire()
+        assert time.monotonic() - started_at >= 0.2
+
+
+GRIST_RECORDS = {
+    "records": [
+        {"id": 1, "fields": {"Titre": "Université", "Liste_des_FQDN": "univ.fr"}},
+        {
+            "id": 2,
+            "fields": {"Nom": "Labo", "Liste_des_FQDN": ["labo.univ.fr", "labo.fr"]},
+        },
+    ]
+}
+DISCOVERY_IDPS = [
+    {
+        "text": "Universités",
+        "children": [{"id": "https://idp.univ.fr", "text": "Université"}],
+    }
+]
+
+
+class StubSnapshotServer(BaseHTTPRequestHandler):
+    """
+    Serves `documents` by path with an ETag, answering 304 when revalidated.
+    """
+
+    def do_GET(self):
+        body = json.dumps(self.server.documents[self.path]).encode()
+        etag = f'"{hash(body)}"'
+        self.server.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(name="snapshot_server")
+def fixture_snapshot_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSnapshotServer)
+    server.documents = {"/grist": GRIST_RECORDS, "/discovery": DISCOVERY_IDPS}
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestSnapshots:
+    def test_revalidates_snapshot(self, snapshot_server, tmp_path):
+        snapshot_path = tmp_path / "grist.json"
+        url = f"{snapshot_server.url}/grist"
+        first = get_grist_idps(snapshot_path, url)
+        second = get_grist_idps(snapshot_path, url)
+        assert (
+            first.owners
+            == second.owners
+            == {
+                "univ.fr": "Université",
+                "labo.univ.fr": "Labo",
+                "labo.fr": "Labo",
+            }
+        )
+        assert snapshot_server.requests[0] is None
+        assert snapshot_server.requests[1] is not None
+
+    def test_refreshes_changed_document(self, snapshot_server, tmp_path):
+        snapshot_path = tmp_path / "discovery.json"
+        url = f"{snapshot_server.url}/discovery"
+        assert get_discovery_idps(snapshot_path, url) == {
+            "https://idp.univ.fr": "Université"
+        }
+        snapshot_server.documents["/discovery"] = []
+        assert get_discovery_idps(snapshot_path, url) == {}
+
+    def test_uses_snapshot_when_offline(self, snapshot_server, tmp_path):
+        snapshot_path = tmp_path / "discovery.json"
+        url = f"{snapshot_server.url}/discovery"
+        get_discovery_idps(snapshot_path, url)
+        snapshot_server.documents.clear()
+        assert get_discovery_idps(snapshot_path, url) == {
+            "https://idp.univ.fr": "Université"
+        }
+
+
+class TestDomainIndex:
+    def create_index(self):
+        return DomainIndex(
+            {
+                "univ.fr": "Université",
+                "labo.univ.fr": "Labo",
+                "mail.labo.univ.fr": "Labo",
+                "univ.com": "Autre",
+                "autre-univ.fr": "Autre",
+            }
+        )
+
+    def test_exact_match(self):
+        index = self.create_index()
+        assert "Univ.fr." in index
+        assert index["univ.fr"] == "Université"
+        assert "fr" not in index
+
+    def test_overlaps_parent_domains(self):
+        index = self.create_index()
+        assert index.overlaps("smtp.labo.univ.fr") == [
+            ("labo.univ.fr", "Labo"),
+            ("univ.fr", "Université"),
+        ]
+
+    def test_overlaps_subdomains(self):
+        index = self.create_index()
+        assert index.overlaps("labo.univ.fr") == [
+            ("univ.fr", "Université"),
+            ("mail.labo.univ.fr", "Labo"),
+        ]
+        assert index.overlaps("univ.fr") == [
+            ("labo.univ.fr", "Labo"),
+            ("mail.labo.univ.fr", "Labo"),
+        ]
+
+    def test_does_not_overlap_other_domains(self):
+        index = self.create_index()
+        assert index.overlaps("autre.fr") == []
+        assert index.overlaps("niv.fr") == []
+        assert index.overlaps("fr") == []
+
+
+CSV = """EntityID,SIRET,Nom d'établissement,Domaines
+https://idp.univ-exemple.fr,12345678200010,Université Exemple,univ-exemple.fr
+https://idp.ecole-exemple.fr,98765432100015,École Exemple,ecole-exemple.fr
+,11111111111111,Sans entityID,sans-entityid.fr
+https://idp.lycee-exemple.fr,22222222200022,Lycée Exemple,univ-exemple.fr
+"""
+
+
+class TestPipeline:
+    def run(self, monkeypatch, *args):
+        monkeypatch.setattr("sys.argv", ["process_renater_csv.py", *args])
+        process_renater_csv.main()
+
+    def read_output(self, path):
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_checks_next_batch_in_background(self):
+        checked = {}
+
+        def check_batch(batch):
+            checked.setdefault(batch[0], threading.Event()).set()
+            return len(batch)
+
+        batches = iter_checked_batches(iter(range(5)), check_batch, 2)
+        assert next(batches) == ([0, 1], 2)
+        # The following batch was submitted before the first one was yielded
+        assert checked.setdefault(2, threading.Event()).wait(5)
+        assert list(batches) == [([2, 3], 2), ([4], 1)]
+
+    def test_writes_json_lines(self, monkeypatch, tmp_path):
+        csv_path = tmp_path / "idps.csv"
+        csv_path.write_text(CSV, encoding="utf-8")
+        output = tmp_path / "results.jsonl"
+        monkeypatch.setattr(
+            process_renater_csv,
+            "get_grist_idps",
+            lambda _: DomainIndex({"mail.ecole-exemple.fr": "Autre IdP"}),
+        )
+        self.run(
+            monkeypatch,
+            str(csv_path),
+            "--check-grist",
+            "--output",
+            str(output),
+            "--batch-size",
+            "2",
+            "--no-cache",
+        )
+        results = self.read_output(output)
+        assert [r["entity_id"] for r in results] == [
+            "https://idp.univ-exemple.fr",
+            "https://idp.ecole-exemple.fr",
+            "https://idp.lycee-exemple.fr",
+        ]
+        assert [r["success"] for r in results] == [True, False, False]
+        assert "overlaps 'mail.ecole-exemple.fr'" in results[1]["errors"][0]
+        assert "Domain conflict (internal)" in results[2]["errors"][0]
+
+    def test_resumes_from_output(self, monkeypatch, tmp_path, capsys):
+        csv_path = tmp_path / "idps.csv"
+        csv_path.write_text(CSV, encoding="utf-8")
+        output = tmp_path / "results.jsonl"
+        self.run(monkeypatch, str(csv_path), "--output", str(output), "--no-cache")
+        complete = output.read_text(encoding="utf-8")
+        capsys.readouterr()
+
+        # Interrupted while writing the second entry
+        lines = complete.splitlines(keepends=True)
+        output.write_text(lines[0] + lines[1][:10], encoding="utf-8")
+        self.run(
+            monkeypatch,
+            str(csv_path),
+            "--output",
+            str(output),
+            "--resume",
+            "--no-cache",
+        )
+        assert output.read_text(encoding="utf-8") == complete
+        assert json.loads(capsys.readouterr().out) == {
+            "https://idp.univ-exemple.fr": "12345678200010",
+            "https://idp.ecole-exemple.fr": "98765432100015",
+            "https://idp.lycee-exemple.fr": "22222222200022",
+        }
+
+    def test_replaces_siret_map_file(self, monkeypatch, tmp_path):
+        csv_path = tmp_path / "idps.csv"
+        csv_path.write_text(CSV, encoding="utf-8")
+        siret_map = tmp_path / "siret_map.tsv"
+        siret_map.write_text("https://idp.removed.fr\t11111111100011\n", "utf-8")
+        self.run(
+            monkeypatch,
+            str(csv_path),
+            "--siret-map-file",
+            str(siret_map),
+            "--no-cache",
+        )
+        assert siret_map.read_text("utf-8") == (
+            "https://idp.ecole-exemple.fr\t98765432100015\n"
+            "https://idp.lycee-exemple.fr\t22222222200022\n"
+            "https://idp.univ-exemple.fr\t12345678200010\n"
+        )
+
+    def test_load_checkpoint_drops_incomplete_line(self, tmp_path):
+        path = tmp_path / "results.jsonl"
+        path.write_text('{"entity_id": "a"}\n{"entity_id": "b"}\n{"entity_', "utf-8")
+        assert load_checkpoint(path) == [{"entity_id": "a"}, {"entity_id": "b"}]
+        assert path.read_text("utf-8") == '{"entity_id": "a"}\n{"entity_id": "b"}\n'
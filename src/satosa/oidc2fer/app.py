@@ -0,0 +1,112 @@
+"""
+Builds the gateway WSGI app, served by gunicorn through oidc2fer.wsgi.
+"""
+
+import logging
+import logging.config
+import os
+
+import satosa
+from cookies_samesite_compat import CookiesSameSiteCompatMiddleware
+from satosa.exception import SATOSAConfigurationError
+from satosa.proxy_server import ToBytesMiddleware, WsgiApplication
+from whitenoise import WhiteNoise
+
+from oidc2fer.metrics import instrument_endpoints
+from oidc2fer.stage_timing import StageTimings, instrument
+from oidc2fer.state_cookie import StateCookies
+from oidc2fer.state_store import create_store
+from oidc2fer.static_assets import is_fingerprinted
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayApplication(WsgiApplication):
+    """
+    SATOSA's WSGI app, keeping its state in the compact cookies of
+    oidc2fer.state_cookie if STATE_COOKIE is set in the config.
+    """
+
+    def __init__(self, config):
+        state_cookie_config = config.get("STATE_COOKIE")
+        legacy_name = (state_cookie_config or {}).get("legacy_name")
+        if legacy_name and config.get("cookies_samesite_compat"):
+            raise SATOSAConfigurationError(
+                "STATE_COOKIE sends its legacy_name cookie itself, "
+                "remove cookies_samesite_compat"
+            )
+        super().__init__(config)
+        self.state_cookies = None
+        if state_cookie_config is not None:
+            self.state_cookies = StateCookies(
+                config, legacy_name, create_store(state_cookie_config)
+            )
+
+    def _load_state(self, context):
+        if self.state_cookies is None:
+            super()._load_state(context)
+        else:
+            self.state_cookies.load(context)
+
+    def _save_state(self, resp, context):
+        if self.state_cookies is None:
+            super()._save_state(resp, context)
+        else:
+            self.state_cookies.save(resp, context)
+
+
+def make_app(satosa_config):
+    """
+    Returns the app of satosa.proxy_server.make_app, with a GatewayApplication
+    in place of its WsgiApplication.
+    """
+    # The config of the gateway always has LOGGING, SATOSA's default is
+    # not worth copying
+    if satosa_config.get("LOGGING"):
+        logging.config.dictConfig(satosa_config["LOGGING"])
+    logger.info("Running SATOSA version %s", satosa.__version__)
+    return ToBytesMiddleware(
+        CookiesSameSiteCompatMiddleware(
+            GatewayApplication(satosa_config), satosa_config
+        )
+    )
+
+
+def create_app(satosa_config):
+    """
+    Returns the SATOSA app of `satosa_config`, a SATOSAConfig, with the
+    metrics, state cookie and stage timing of its config, wrapped in
+    WhiteNoise to serve the static files of the current directory.
+    """
+    satosa_app = make_app(satosa_config)
+    # make_app wraps the SATOSA app in a couple of WSGI middlewares
+    gateway = satosa_app.app.app
+    instrument_endpoints(gateway)
+
+    stage_timing_config = satosa_config.get("STAGE_TIMING")
+    if stage_timing_config is not None:
+        instrument(
+            gateway,
+            StageTimings(log_interval=stage_timing_config.get("log_interval", 60)),
+            stage_timing_config.get("excluded_modules", ()),
+        )
+
+    # The production image serves the files built by oidc2fer.static_assets,
+    # with their compressed variants
+    static_root = "staticfiles" if os.path.isdir("staticfiles") else "static"
+
+    # Wrap the SATOSA WSGI app in WhiteNoise to serve static files
+    return WhiteNoise(
+        satosa_app,
+        root=os.path.join(os.curdir, static_root),
+        index_file="index.html",
+        max_age=3600,
+        immutable_file_test=is_fingerprinted,
+    )
+
+
+def get_satosa(app):
+    """
+    Returns the SATOSABase of `app`, as returned by create_app.
+    """
+    return app.application.app.app
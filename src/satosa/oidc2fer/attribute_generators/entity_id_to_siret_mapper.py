@@ -1,8 +1,13 @@
 import json
 import logging
+import os
 
 from satosa.micro_services.base import ResponseMicroService
 
+from oidc2fer.metrics import SIRET_MAPPING_MISSES, issuer_label
+
+from .siret_mapping import SiretMappingStore
+
 logger = logging.getLogger(__name__)
 
 
@@ -10,14 +15,22 @@ class EntityIdToSiretMapper(ResponseMicroService):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.attribute = config.get("attribute", "siret")
-        self.mapping = json.loads(config.get("mapping_json", "{}"))
+        if config.get("mapping_path"):
+            self.mapping = SiretMappingStore(
+                config["mapping_path"], config.get("reload_interval", 30)
+            )
+        else:
+            self.mapping = json.loads(
+                config.get("mapping_json", os.environ.get("SIRET_MAP")) or "{}"
+            )
 
     def process(self, context, data):
         entity_id = data.auth_info.issuer
-        if entity_id in self.mapping:
-            siret = self.mapping[entity_id]
+        siret = self.mapping.get(entity_id)
+        if siret is not None:
             logger.info("Mapping entity ID %s to SIRET %s", entity_id, siret)
             data.attributes[self.attribute] = siret
         else:
             logger.warning("No SIRET mapping found for entity ID %s", entity_id)
+            SIRET_MAPPING_MISSES.labels(issuer_label(entity_id)).inc()
         return super().process(context, data)
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import mmap
+import os
+
+from oidc2fer.file_watcher import FileWatcher
+
+logger = logging.getLogger(__name__)
+
+
+class SiretMappingFile:
+    """
+    A read-only mapping from entity IDs to SIRETs, backed by a memory-mapped
+    file of `<entity ID>\\t<SIRET>\\n` lines sorted by entity ID.
+
+    Lookups are binary searches in the mapped file: its pages live in the OS
+    page cache, shared by all the workers of a node, instead of being parsed
+    into a dict in each of them. The file must therefore never be modified in
+    place, but replaced (see write_mapping_file).
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat_result = os.fstat(f.fileno())
+            # Empty files can't be mapped
+            self._data = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.stat_result.st_size
+                else b""
+            )
+        self.version = hashlib.sha256(self._data).hexdigest()[:12]
+        self._length = self._validate()
+
+    def _validate(self):
+        data = self._data
+        length = 0
+        previous = None
+        start = 0
+        while start < len(data):
+            end = data.find(b"\n", start)
+            if end == -1:
+                raise ValueError("the last line is not terminated")
+            length += 1
+            entity_id, tab, siret = data[start:end].partition(b"\t")
+            if not tab or not entity_id or not siret:
+                raise ValueError(f"line {length} is not <entity ID>\\t<SIRET>")
+            if previous is not None and entity_id <= previous:
+                raise ValueError(f"line {length} is not sorted by entity ID")
+            previous = entity_id
+            start = end + 1
+        return length
+
+    def __len__(self):
+        return self._length
+
+    def get(self, entity_id, default=None):
+        key = entity_id.encode()
+        data = self._data
+        # Both bounds are always at the start of a line
+        low, high = 0, len(data)
+        while low < high:
+            start = data.rfind(b"\n", 0, (low + high) // 2) + 1
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            line_entity_id, _, siret = data[start:end].partition(b"\t")
+            if line_entity_id == key:
+                return siret.decode()
+            if line_entity_id < key:
+                low = end + 1
+            else:
+                high = start
+        return default
+
+
+def write_mapping_file(path, mapping):
+    """
+    Atomically replaces `path` with the given mapping, in the format read by
+    SiretMappingFile.
+    """
+    lines = sorted(
+        (entity_id.encode(), siret.encode()) for entity_id, siret in mapping.items()
+    )
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.writelines(b"%s\t%s\n" % line for line in lines)
+    os.replace(temporary_path, path)
+
+
+class SiretMappingStore:
+    """
+    A SiretMappingFile reloaded when the file is replaced. Requests being
+    processed during a reload keep using the previous version.
+    """
+
+    def __init__(self, path, reload_interval):
+        self.path = path
+        self.watcher = FileWatcher(path, reload_interval)
+        self.mapping = self._load()
+
+    def _load(self):
+        mapping = SiretMappingFile(self.path)
+        self.watcher.loaded(mapping.stat_result)
+        logger.info(
+            "Loaded %d SIRET mappings from %s (version %s)",
+            len(mapping),
+            self.path,
+            mapping.version,
+        )
+        return mapping
+
+    def reload(self):
+        try:
+            self.mapping = self._load()
+        except (OSError, ValueError) as e:
+            logger.error(
+                "Failed to load SIRET mappings from %s, keeping version %s: %s",
+                self.path,
+                self.mapping.version,
+                e,
+            )
+
+    @property
+    def version(self):
+        return self.mapping.version
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, entity_id, default=None):
+        if self.watcher.changed():
+            self.reload()
+        return self.mapping.get(entity_id, default)
@@ -0,0 +1,2 @@
+from .flattener import AttributeFlattener
+from .pipeline import AttributePipeline
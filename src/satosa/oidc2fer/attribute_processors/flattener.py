@@ -0,0 +1,45 @@
+import logging
+
+from satosa.micro_services.base import ResponseMicroService
+
+logger = logging.getLogger(__name__)
+
+
+def flatten(values, separator=" ", deduplicate=False, first_only=False):
+    """
+    Returns the single string value of an attribute with the list `values`:
+    the first one with `first_only`, or all of them joined with `separator`,
+    without duplicates with `deduplicate`.
+    """
+    if len(values) == 1 or (first_only and values):
+        return values[0]
+    if deduplicate:
+        values = dict.fromkeys(values)
+    return separator.join(values)
+
+
+class AttributeFlattener(ResponseMicroService):
+    """
+    Flattens the list values of the configured attributes into strings, in a
+    single pass over the attributes of the response.
+    """
+
+    def __init__(self, config, *args, **kwargs):
+        self.attributes = tuple(config["attributes"])
+        self.separator = config.get("separator", " ")
+        self.deduplicate = config.get("deduplicate", False)
+        self.first_only = config.get("first_only", False)
+        super().__init__(*args, **kwargs)
+
+    def process(self, context, data):
+        attributes = data.attributes
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for attribute in self.attributes:
+            values = attributes.get(attribute)
+            if values is None or isinstance(values, str):
+                continue
+            value = flatten(values, self.separator, self.deduplicate, self.first_only)
+            if debug:
+                logger.debug("flattening %s into %s", values, value)
+            attributes[attribute] = value
+        return super().process(context, data)
@@ -0,0 +1,313 @@
+"""
+A response micro-service running the attribute micro-services of a login in a
+single step, from the same plugin configs as the chain of MICRO_SERVICES.
+
+The plugin configs are compiled at startup into a plan: SATOSA's attribute
+filters, attribute authorization, primary identifier and static attributes
+become functions whose regular expressions and options are resolved once,
+instead of on each login. The other micro-services, like the ones of this
+repository which already precompute their state, run as they are. The results
+are the same as with the chain, see tests/oidc2fer/attribute_processors, for
+the versions of SATOSA in COMPILED_SATOSA_VERSIONS only: with another one, all
+the micro-services run as they are.
+"""
+
+import functools
+import logging
+import re
+from importlib import metadata
+from pydoc import locate
+
+from satosa import yaml
+from satosa.context import Context
+from satosa.exception import SATOSAAuthenticationError, SATOSAConfigurationError
+from satosa.micro_services.attribute_authorization import AttributeAuthorization
+from satosa.micro_services.attribute_modifications import (
+    AddStaticAttributes,
+    FilterAttributeValues,
+)
+from satosa.micro_services.base import ResponseMicroService
+from satosa.micro_services.primary_identifier import PrimaryIdentifier
+from satosa.util import get_dict_defaults
+
+logger = logging.getLogger(__name__)
+
+# The versions of SATOSA whose micro-services the compilers mirror, checked by
+# tests/oidc2fer/attribute_processors/test_pipeline.py
+COMPILED_SATOSA_VERSIONS = ("8.5.1",)
+
+# The options of PrimaryIdentifier that can be compiled, the others (per SP or
+# IdP configs, on_error, ignore) keep it running as it is
+PRIMARY_IDENTIFIER_OPTIONS = {
+    "ordered_identifier_candidates",
+    "primary_identifier",
+    "clear_input_attributes",
+    "replace_subject_id",
+}
+
+
+def load_plugin_config(plugin_config):
+    """
+    Returns the plugin config `plugin_config`, or loaded from this YAML file,
+    like SATOSA does for MICRO_SERVICES.
+    """
+    if isinstance(plugin_config, dict):
+        return plugin_config
+    with open(plugin_config, encoding="utf-8") as f:
+        return yaml.load(f)
+
+
+def metadata_scopes(context, issuer):
+    mdstore = context.get_decoration(Context.KEY_METADATA_STORE)
+    if not mdstore:
+        return []
+    return list(mdstore.shibmd_scopes(issuer, "idpsso_descriptor"))
+
+
+def match_scope_value(value, scopes):
+    return any(
+        re.fullmatch(scope["text"], value)
+        if scope["regexp"]
+        else scope["text"] == value
+        for scope in scopes
+    )
+
+
+def match_scope(value, scopes):
+    parts = value.split("@")
+    if len(parts) != 2:
+        logger.info("Discarding invalid scoped value %s", value)
+        return False
+    return match_scope_value(parts[1], scopes)
+
+
+def compile_value_filters(attribute_filters):
+    """
+    Returns the (attribute name, filter type, compiled regexp) of the filters
+    of FilterAttributeValues for an issuer and a requester.
+    """
+    rules = []
+    for attribute_name, filters in attribute_filters.items():
+        # A string is the regexp of the filter
+        by_type = {"regexp": filters} if isinstance(filters, str) else filters
+        for filter_type, filter_value in by_type.items():
+            if filter_type == "regexp":
+                rules.append((attribute_name, filter_type, re.compile(filter_value)))
+            elif filter_type in ("shibmdscope_match_scope", "shibmdscope_match_value"):
+                rules.append((attribute_name, filter_type, None))
+            else:
+                raise SATOSAConfigurationError(f"Unknown filter type {filter_type}")
+    return rules
+
+
+def compile_filter_attribute_values(config):
+    filters = {
+        issuer: {
+            requester: compile_value_filters(attribute_filters)
+            for requester, attribute_filters in requester_filters.items()
+        }
+        for issuer, requester_filters in config["attribute_filters"].items()
+    }
+
+    def filter_attribute_values(context, data):
+        issuer = data.auth_info.issuer
+        attributes = data.attributes
+        scopes = None
+        for requester_filters in (filters.get("", {}), filters.get(issuer, {})):
+            for requester in ("", data.requester):
+                for attribute_name, filter_type, regexp in requester_filters.get(
+                    requester, ()
+                ):
+                    if filter_type == "regexp":
+                        keep = regexp.search
+                    else:
+                        if scopes is None:
+                            scopes = metadata_scopes(context, issuer)
+                        match = (
+                            match_scope
+                            if filter_type == "shibmdscope_match_scope"
+                            else match_scope_value
+                        )
+                        keep = functools.partial(match, scopes=scopes)
+                    names = attributes if attribute_name == "" else (attribute_name,)
+                    for name in names:
+                        if name in attributes:
+                            attributes[name] = list(filter(keep, attributes[name]))
+
+    return filter_attribute_values
+
+
+def compile_attribute_rules(rules):
+    """
+    Compiles the regexps of the rules of AttributeAuthorization, by requester,
+    issuer and attribute.
+    """
+    return {
+        requester: {
+            issuer: {
+                attribute_name: [re.compile(regexp) for regexp in regexps]
+                for attribute_name, regexps in attribute_rules.items()
+            }
+            for issuer, attribute_rules in issuer_rules.items()
+        }
+        for requester, issuer_rules in rules.items()
+    }
+
+
+def matches(values, regexps):
+    # A matching value must also be truthy, like in AttributeAuthorization
+    return any(value for regexp in regexps for value in values if regexp.search(value))
+
+
+def compile_attribute_authorization(config):
+    allow = compile_attribute_rules(config.get("attribute_allow", {}))
+    deny = compile_attribute_rules(config.get("attribute_deny", {}))
+    force_presence_on_allow = config.get("force_attributes_presence_on_allow", False)
+    force_presence_on_deny = config.get("force_attributes_presence_on_deny", False)
+
+    def authorize(context, data):
+        attributes = data.attributes
+        issuer = data.auth_info.issuer
+        for attribute_name, regexps in get_dict_defaults(
+            allow, data.requester, issuer
+        ).items():
+            values = attributes.get(attribute_name)
+            if values is None:
+                if force_presence_on_allow:
+                    raise SATOSAAuthenticationError(context.state, "Permission denied")
+            elif not matches(values, regexps):
+                raise SATOSAAuthenticationError(context.state, "Permission denied")
+        for attribute_name, regexps in get_dict_defaults(
+            deny, data.requester, issuer
+        ).items():
+            values = attributes.get(attribute_name)
+            if values is None:
+                if force_presence_on_deny:
+                    raise SATOSAAuthenticationError(context.state, "Permission denied")
+            elif matches(values, regexps):
+                raise SATOSAAuthenticationError(context.state, "Permission denied")
+
+    return authorize
+
+
+def compile_primary_identifier(config):
+    """
+    Returns None if PrimaryIdentifier must run as it is.
+    """
+    candidates = config["ordered_identifier_candidates"]
+    if not set(config) <= PRIMARY_IDENTIFIER_OPTIONS or any(
+        "name_id" in candidate["attribute_names"] for candidate in candidates
+    ):
+        return None
+    candidates = [
+        (tuple(candidate["attribute_names"]), candidate.get("add_scope"))
+        for candidate in candidates
+    ]
+    primary_identifier = config.get("primary_identifier", "uid")
+    clear_input_attributes = config.get("clear_input_attributes", False)
+    replace_subject_id = config.get("replace_subject_id", False)
+
+    def identify(context, data):
+        try:
+            requester = context.state.state_dict["SATOSA_BASE"]["requester"]
+        except KeyError:
+            logger.error("Unable to determine the entityID for the SP requester")
+            return
+        attributes = data.attributes
+        value = None
+        for attribute_names, scope in candidates:
+            values = [attributes.get(name, [None])[0] for name in attribute_names]
+            if None in values:
+                continue
+            if scope is not None:
+                values.append(
+                    data.auth_info.issuer if scope == "issuer_entityid" else scope
+                )
+            value = "".join(values)
+            break
+        if not value:
+            logger.warning("No primary identifier found for %s", requester)
+        if clear_input_attributes:
+            data.attributes = {}
+        if primary_identifier:
+            data.attributes[primary_identifier] = value
+        if replace_subject_id:
+            data.subject_id = value
+
+    return identify
+
+
+def compile_static_attributes(config):
+    static_attributes = config["static_attributes"]
+
+    def add_static_attributes(context, data):  # pylint: disable=unused-argument
+        data.attributes.update(static_attributes)
+
+    return add_static_attributes
+
+
+COMPILERS = {
+    FilterAttributeValues: compile_filter_attribute_values,
+    AttributeAuthorization: compile_attribute_authorization,
+    PrimaryIdentifier: compile_primary_identifier,
+    AddStaticAttributes: compile_static_attributes,
+}
+
+
+def run_as_is(service):
+    """
+    Returns a step running the micro-service `service`, which ends the plan
+    if it returns a response, like a redirect, instead of the data.
+    """
+    service.next = lambda context, data: data
+
+    def step(context, data):
+        response = service.process(context, data)
+        return None if response is data else response
+
+    return step
+
+
+class AttributePipeline(ResponseMicroService):
+    """
+    Runs the response micro-services of the plugin configs listed in
+    `micro_services`, paths or dicts, as a single micro-service.
+    """
+
+    def __init__(self, config, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = []
+        compilers = COMPILERS
+        satosa_version = metadata.version("SATOSA")
+        if satosa_version not in COMPILED_SATOSA_VERSIONS:
+            logger.warning(
+                "The micro-services of SATOSA %s are not compiled, only those "
+                "of SATOSA %s",
+                satosa_version,
+                ", ".join(COMPILED_SATOSA_VERSIONS),
+            )
+            compilers = {}
+        for plugin_config in map(load_plugin_config, config["micro_services"]):
+            service_class = locate(plugin_config["module"])
+            if service_class is None:
+                raise SATOSAConfigurationError(
+                    f"Can't find module {plugin_config['module']}"
+                )
+            compiler = compilers.get(service_class)
+            step = compiler(plugin_config["config"]) if compiler else None
+            if step is None:
+                service = service_class(
+                    config=plugin_config.get("config"),
+                    name=plugin_config["name"],
+                    base_url=self.base_url,
+                    internal_attributes=kwargs.get("internal_attributes"),
+                )
+                step = run_as_is(service)
+            self.steps.append(step)
+
+    def process(self, context, data):
+        for step in self.steps:
+            response = step(context, data)
+            if response is not None:
+                return response
+        return super().process(context, data)
@@ -1,6 +1,17 @@
-from satosa.exception import SATOSAAuthenticationError
+import logging
+import os
+
+import yaml
+from satosa.exception import SATOSAAuthenticationError, SATOSAConfigurationError
 from satosa.micro_services.base import ResponseMicroService
 
+from oidc2fer.file_watcher import FileWatcher
+from oidc2fer.metrics import AFFILIATION_REJECTIONS, issuer_label
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ISSUER = "default"
+
 
 class AffiliationCheckError(SATOSAAuthenticationError):
     def __init__(self, state, message):
@@ -9,21 +20,100 @@ class AffiliationCheckError(SATOSAAuthenticationError):
         self._message = message + " Error id [{error_id}]"
 
 
+def by_issuer(allowed_values):
+    """
+    `allowed_values` is either a list of values allowed for any issuer, or a
+    mapping from issuer entityID to lists of values, where the "default" key
+    applies to issuers that are not listed.
+    """
+    if isinstance(allowed_values, dict):
+        return allowed_values
+    return {DEFAULT_ISSUER: allowed_values}
+
+
+def build_index(allowed_values):
+    """
+    Builds the mapping from issuer entityID to the set of allowed values.
+    Raises SATOSAConfigurationError if the values of an issuer are a string
+    instead of a list.
+    """
+    index = {}
+    for issuer, values in by_issuer(allowed_values).items():
+        if isinstance(values, str):
+            raise SATOSAConfigurationError(
+                f"The allowed values of {issuer} must be a list, not {values!r}"
+            )
+        index[issuer] = frozenset(value.lower() for value in values or [])
+    index.setdefault(DEFAULT_ISSUER, frozenset())
+    return index
+
+
 class AffiliationChecker(ResponseMicroService):
     def __init__(self, config, *args, **kwargs):
         self.attribute_name = config.get("attribute_name", "eduPersonAffiliation")
-        self.allowed_values = set(config.get("allowed_values", []))
+        self.allowed_values = config.get("allowed_values", [])
+        self.allowed_values_path = config.get("allowed_values_path")
+        self.index = build_index(self.allowed_values)
+        self.watcher = None
+        if self.allowed_values_path:
+            self.watcher = FileWatcher(
+                self.allowed_values_path, config.get("reload_interval", 30)
+            )
+            self.reload()
         super().__init__(*args, **kwargs)
 
+    def reload(self):
+        """
+        Rebuilds the index from `allowed_values_path`, whose entries override
+        the ones from `allowed_values`. The previous index is kept if the file
+        can't be loaded.
+        """
+        try:
+            with open(self.allowed_values_path, encoding="utf-8") as f:
+                stat_result = os.fstat(f.fileno())
+                file_allowed_values = yaml.safe_load(f) or {}
+            index = build_index(
+                {**by_issuer(self.allowed_values), **by_issuer(file_allowed_values)}
+            )
+        except (
+            OSError,
+            yaml.YAMLError,
+            AttributeError,
+            TypeError,
+            SATOSAConfigurationError,
+        ) as e:
+            logger.error(
+                "Failed to load allowed affiliations from %s, keeping the "
+                "previous ones: %s",
+                self.allowed_values_path,
+                e,
+            )
+            return
+        self.watcher.loaded(stat_result)
+        # Swap the whole index at once, concurrent requests see either version
+        self.index = index
+        logger.info(
+            "Loaded allowed affiliations for %d issuers from %s",
+            len(index) - 1,
+            self.allowed_values_path,
+        )
+
     def process(self, context, data):
+        if self.watcher and self.watcher.changed():
+            self.reload()
         if self.attribute_name not in data.attributes:
-            raise AffiliationCheckError(
-                context.state, f"L'attribut {self.attribute_name} est manquant"
-            )
+            self.reject(context, data, f"L'attribut {self.attribute_name} est manquant")
         values = data.attributes[self.attribute_name]
-        if not any(v.lower() in self.allowed_values for v in values):
-            raise AffiliationCheckError(
-                context.state,
+        index = self.index
+        allowed_values = index.get(data.auth_info.issuer, index[DEFAULT_ISSUER])
+        if allowed_values.isdisjoint(value.lower() for value in values):
+            self.reject(
+                context,
+                data,
                 f"Aucune des valeurs pour {self.attribute_name} n'est autorisée: {values}",
             )
         return super().process(context, data)
+
+    def reject(self, context, data, message):
+        AFFILIATION_REJECTIONS.labels(issuer_label(data.auth_info.issuer)).inc()
+        raise AffiliationCheckError(context.state, message)
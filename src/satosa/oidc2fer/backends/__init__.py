@@ -0,0 +1 @@
+from .refreshing_saml2 import RefreshingSAMLBackend
@@ -0,0 +1,37 @@
+import logging
+import os
+
+from satosa.backends.saml2 import SAMLBackend
+
+from oidc2fer.metadata_refresher import MetadataRefresher
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshingSAMLBackend(SAMLBackend):
+    """
+    A SAML backend whose metadata, loaded from the cache file built by
+    oidc2fer.metadata_cache, is refreshed in the background.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, outgoing, internal_attributes, config, base_url, name
+    ):
+        self.metadata_refresher = None
+        refresh_config = config.get("metadata_refresh")
+        if refresh_config:
+            (cache_path,) = config["sp_config"]["metadata"]["mdfile"]
+            cert = refresh_config.get("cert")
+            if not (cert and os.path.exists(cert)):
+                logger.warning("No metadata certificate, metadata is unverified")
+                cert = None
+            self.metadata_refresher = MetadataRefresher(
+                cache_path, {**refresh_config, "cert": cert}
+            )
+            # Downloaded once per node, by the gunicorn master which preloads
+            # the app, and kept if the download fails
+            self.metadata_refresher.refresh(wait=True)
+        super().__init__(outgoing, internal_attributes, config, base_url, name)
+        if self.metadata_refresher:
+            self.metadata_refresher.watch(self.sp)
+            self.metadata_refresher.start()
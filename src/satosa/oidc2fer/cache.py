@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+from oidc2fer.metrics import CACHE_LOOKUPS
+
+
+class TTLCache:
+    """
+    A bounded, thread-safe LRU cache where each entry expires at a given time.
+
+    Expiration times are absolute timestamps, as returned by `clock` (which
+    defaults to `time.time`, to be comparable with the `exp` claim of tokens).
+    The lookups in a cache given a `name` are counted on `/metrics`.
+    """
+
+    def __init__(self, max_size, clock=time.time, name=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lookups = (
+            {result: CACHE_LOOKUPS.labels(name, result) for result in ("hit", "miss")}
+            if name
+            else {}
+        )
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self._count("hit")
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            self._count("miss")
+            return None
+
+    def _count(self, result):
+        if self._lookups:
+            self._lookups[result].inc()
+
+    def set(self, key, value, expires_at):
+        if self.max_size <= 0 or expires_at <= self._clock():
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
@@ -0,0 +1,68 @@
+"""
+The registry of the OIDC clients, loaded once from client_db_path.
+
+pyop looks the clients up on each authorization and token request, compares
+their secret with `!=`, in a time depending on the secret, and their
+redirect URI with a list. Here each client is a read-only mapping, with its
+redirect URIs in a frozenset and its secret as a ClientSecret, which pyop's
+comparison checks in constant time.
+"""
+
+import hashlib
+import hmac
+import json
+from types import MappingProxyType
+
+URI_LISTS = ("redirect_uris", "post_logout_redirect_uris")
+
+
+class ClientSecret:
+    """
+    The secret of a client, as its SHA-256 digest. Comparing it with a string
+    compares their digests in constant time, whatever the string.
+    """
+
+    __slots__ = ("digest",)
+
+    def __init__(self, secret):
+        self.digest = hashlib.sha256(secret.encode()).digest()
+
+    def __eq__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        return hmac.compare_digest(self.digest, hashlib.sha256(other.encode()).digest())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "ClientSecret(***)"
+
+
+def freeze_client(client_id, client_info):
+    if not isinstance(client_info, dict):
+        raise TypeError(f"The client {client_id} isn't a JSON object")
+    frozen = dict(client_info)
+    for name in URI_LISTS:
+        if name in frozen:
+            frozen[name] = frozenset(frozen[name])
+    if "response_types" in frozen:
+        frozen["response_types"] = tuple(frozen["response_types"])
+    if frozen.get("client_secret") is not None:
+        frozen["client_secret"] = ClientSecret(frozen["client_secret"])
+    return MappingProxyType(frozen)
+
+
+def load_clients(stream):
+    """
+    Returns the read-only registry of the clients of the JSON `stream`, an
+    object of the client metadata by client ID, as in client_db_path.
+    """
+    clients = json.load(stream)
+    if not isinstance(clients, dict):
+        raise TypeError("The clients aren't a JSON object")
+    return MappingProxyType(
+        {
+            client_id: freeze_client(client_id, client_info)
+            for client_id, client_info in clients.items()
+        }
+    )
@@ -0,0 +1,49 @@
+import os
+import threading
+import time
+
+
+class FileWatcher:
+    """
+    Tells whether a file changed since it was last loaded, checking its status
+    at most every `interval` seconds so that it can be called on every request.
+
+    Files are expected to be replaced atomically (written to a temporary file,
+    then renamed), which changes their inode even if the mtime is the same.
+
+    When threads of a gthread worker call it at the same time, only one of them
+    checks the file, so that it is reloaded once.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._next_check = 0
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(stat_result):
+        return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+    def loaded(self, stat_result):
+        """
+        Records the status of the file, as it was when it was loaded.
+        """
+        self._loaded = self.signature(stat_result)
+        self._next_check = time.monotonic() + self.interval
+
+    def changed(self):
+        now = time.monotonic()
+        # pylint: disable-next=consider-using-with
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if now < self._next_check:
+                return False
+            self._next_check = now + self.interval
+            return self.signature(os.stat(self.path)) != self._loaded
+        except OSError:
+            return False
+        finally:
+            self._lock.release()
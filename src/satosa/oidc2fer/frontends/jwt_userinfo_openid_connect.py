@@ -1,28 +1,279 @@
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+from importlib import metadata
 from urllib.parse import urlencode
 
+import yaml
 from oic.oic.message import UserInfoErrorResponse
 from pyop.access_token import AccessToken
 from pyop.exceptions import BearerTokenError, InvalidAccessToken
-from satosa.frontends.openid_connect import OpenIDConnectFrontend
+from satosa.frontends import openid_connect
 from satosa.response import Response, Unauthorized
 
+from oidc2fer import stateless_tokens
+from oidc2fer.cache import TTLCache
+from oidc2fer.client_registry import load_clients
+from oidc2fer.file_watcher import FileWatcher
+from oidc2fer.signing_keys import KeyRing, load_key_ring, load_signing_key
+
 logger = logging.getLogger(__name__)
 
+# The versions of SATOSA whose OpenIDConnectFrontend.__init__ loads
+# signing_key_path with openid_connect.rsa_load, checked by
+# tests/oidc2fer/frontends/test_jwt_userinfo_openid_connect.py
+PATCHED_SATOSA_VERSIONS = ("8.5.1",)
+
+# Held while openid_connect.rsa_load is replaced, for frontends initialized in
+# other threads to never restore it to the replacement
+rsa_load_lock = threading.Lock()
+
+
+class StaticDocument:
+    """
+    A JSON document rendered once, served with an ETag for clients to
+    revalidate it without downloading it again.
+    """
+
+    def __init__(self, body, max_age):
+        self.body = body.encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.headers = (
+            ("ETag", self.etag),
+            ("Cache-Control", f"public, max-age={max_age}"),
+        )
+
+    def response(self, context):
+        if_none_match = (context.http_headers or {}).get("HTTP_IF_NONE_MATCH", "")
+        etags = {etag.strip().removeprefix("W/") for etag in if_none_match.split(",")}
+        if self.etag in etags or "*" in etags:
+            return Response(b"", status="304 Not Modified", headers=list(self.headers))
+        return Response(
+            self.body, headers=list(self.headers), content="application/json"
+        )
+
+
+@contextlib.contextmanager
+def rsa_key_loading_skipped():
+    """
+    Makes OpenIDConnectFrontend.__init__ create an empty RSA key instead of
+    loading signing_key_path, which it can only load as an RSA key. With
+    another version of SATOSA than PATCHED_SATOSA_VERSIONS, the key is loaded
+    as it is, and must then be an RSA key.
+    """
+    satosa_version = metadata.version("SATOSA")
+    if satosa_version not in PATCHED_SATOSA_VERSIONS:
+        logger.warning(
+            "The signing key is loaded by SATOSA %s as an RSA key, only SATOSA "
+            "%s loads EC keys",
+            satosa_version,
+            ", ".join(PATCHED_SATOSA_VERSIONS),
+        )
+        yield
+        return
+    with rsa_load_lock:
+        rsa_load = openid_connect.rsa_load
+        openid_connect.rsa_load = lambda path: None
+        try:
+            yield
+        finally:
+            openid_connect.rsa_load = rsa_load
+
+
+# pylint: disable-next=too-many-instance-attributes
+class JWTUserInfoOpenIDConnectFrontend(openid_connect.OpenIDConnectFrontend):
+    def __init__(  # pylint: disable=too-many-arguments
+        self, auth_req_callback_func, internal_attributes, conf, base_url, name
+    ):
+        # The empty key of OpenIDConnectFrontend is replaced by the prepared
+        # RSA or EC key of oidc2fer.signing_keys, or by the current key of the
+        # key ring of signing_keys_path if set
+        with rsa_key_loading_skipped():
+            super().__init__(
+                auth_req_callback_func, internal_attributes, conf, base_url, name
+            )
+        self.signing_keys_path = self.config.get("signing_keys_path")
+        self.key_ring_watcher = None
+        if self.signing_keys_path:
+            self.key_ring_watcher = FileWatcher(
+                self.signing_keys_path, self.config.get("signing_keys_interval", 30)
+            )
+            with open(self.signing_keys_path, encoding="utf-8") as f:
+                self.key_ring_watcher.loaded(os.fstat(f.fileno()))
+                self.key_ring = load_key_ring(f)
+        else:
+            self.key_ring = KeyRing(
+                load_signing_key(
+                    self.config["signing_key_path"],
+                    self.config.get("signing_key_id", ""),
+                )
+            )
+        self.signing_key = self.provider.signing_key = self.key_ring.current
+        self.provider.configuration_information[
+            "id_token_signing_alg_values_supported"
+        ] = self.key_ring.algorithms
+
+        authz_state = self.provider.authz_state
+        token_keys = self.config.get("token_keys")
+        if token_keys:
+            # Like with a stateless db_uri, the user info is kept in the codes
+            # and tokens instead of user_db
+            self.stateless = True
+            stateless_tokens.install(
+                authz_state, stateless_tokens.load_token_keys(token_keys)
+            )
+        self._introspection = threading.local()
+        self._introspect_access_token = authz_state.introspect_access_token
+        authz_state.introspect_access_token = self.introspect_access_token
+
+        self.client_db_path = self.config.get("client_db_path")
+        self.client_db_watcher = None
+        if self.client_db_path and not self.config.get("client_db_uri"):
+            self.client_db_watcher = FileWatcher(
+                self.client_db_path, self.config.get("client_db_interval", 30)
+            )
+            # Loaded by OpenIDConnectFrontend as a dict, and here read-only
+            with open(self.client_db_path, encoding="utf-8") as f:
+                self.client_db_watcher.loaded(os.fstat(f.fileno()))
+                self.provider.clients = load_clients(f)
+
+        self.documents = {}
+        self.render_documents()
+
+        cache_config = self.config.get("userinfo_cache") or {}
+        access_token_lifetime = self.config["provider"].get(
+            "access_token_lifetime", 3600
+        )
+        # A cached response must never outlive the access token it was built for
+        self.userinfo_cache_ttl = min(
+            cache_config.get("ttl", access_token_lifetime), access_token_lifetime
+        )
+        self.userinfo_cache = TTLCache(
+            cache_config.get("max_size", 1024), name="userinfo"
+        )
+
+    def render_documents(self):
+        """
+        Renders the discovery document and the JWK set, which only change with
+        the configuration and the keys.
+        """
+        max_age = self.config.get("discovery_max_age", 300)
+        self.documents = {
+            "provider_config": StaticDocument(
+                self.provider.provider_configuration.to_json(), max_age
+            ),
+            "jwks": StaticDocument(json.dumps(self.key_ring.jwks()), max_age),
+        }
+
+    def reload_key_ring(self):
+        """
+        Switches to the key ring of `signing_keys_path`. The previous key ring
+        is kept if the file can't be loaded.
+        """
+        try:
+            with open(self.signing_keys_path, encoding="utf-8") as f:
+                stat_result = os.fstat(f.fileno())
+                key_ring = load_key_ring(f)
+        except (OSError, ValueError, KeyError, TypeError, yaml.YAMLError) as e:
+            logger.error(
+                "Failed to load the signing keys from %s, keeping the previous "
+                "ones: %s",
+                self.signing_keys_path,
+                e,
+            )
+            return
+        self.key_ring_watcher.loaded(stat_result)
+        self.key_ring = key_ring
+        # Replace the list instead of updating it, like the documents, for
+        # concurrent requests to see either version
+        self.provider.configuration_information[
+            "id_token_signing_alg_values_supported"
+        ] = key_ring.algorithms
+        self.render_documents()
+        # The new keys are published before the current one signs
+        self.signing_key = self.provider.signing_key = key_ring.current
+        self.userinfo_cache.clear()
+        logger.info(
+            "Loaded the signing keys from %s, signing with %s",
+            self.signing_keys_path,
+            key_ring.current.kid,
+        )
+
+    def check_key_ring(self):
+        if self.key_ring_watcher and self.key_ring_watcher.changed():
+            self.reload_key_ring()
+
+    def reload_clients(self):
+        """
+        Switches to the clients of `client_db_path`. The previous clients are
+        kept if the file can't be loaded.
+        """
+        try:
+            with open(self.client_db_path, encoding="utf-8") as f:
+                stat_result = os.fstat(f.fileno())
+                clients = load_clients(f)
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(
+                "Failed to load the clients from %s, keeping the previous ones: %s",
+                self.client_db_path,
+                e,
+            )
+            return
+        self.client_db_watcher.loaded(stat_result)
+        self.provider.clients = clients
+        logger.info("Loaded %d clients from %s", len(clients), self.client_db_path)
+
+    def check_clients(self):
+        if self.client_db_watcher and self.client_db_watcher.changed():
+            self.reload_clients()
+
+    def handle_authn_request(self, context):
+        self.check_clients()
+        return super().handle_authn_request(context)
+
+    def handle_authn_response(self, context, internal_resp):
+        self.check_key_ring()
+        return super().handle_authn_response(context, internal_resp)
+
+    def token_endpoint(self, context):
+        self.check_key_ring()
+        self.check_clients()
+        return super().token_endpoint(context)
+
+    def provider_config(self, context):
+        self.check_key_ring()
+        return self.documents["provider_config"].response(context)
+
+    def jwks(self, context):
+        self.check_key_ring()
+        return self.documents["jwks"].response(context)
 
-class JWTUserInfoOpenIDConnectFrontend(OpenIDConnectFrontend):
     def userinfo_endpoint(self, context):
+        self.check_key_ring()
         headers = {"Authorization": context.request_authorization}
+        request = urlencode(context.request)
+
+        # The access token and the request parameters fully determine the
+        # claims set returned, so they can be used as the cache key
+        cache_key = (context.request_authorization, request)
+        signed_userinfo = self.userinfo_cache.get(cache_key)
+        if signed_userinfo is not None:
+            return Response(signed_userinfo, content="application/jwt")
 
         try:
-            response = self.provider.handle_userinfo_request(
-                request=urlencode(context.request),
-                http_headers=headers,
-            )
-            return Response(
-                response.to_jwt([self.signing_key], self.signing_key.alg),
-                content="application/jwt",
+            response, expires_at = self.handle_userinfo_request(request, headers)
+            signing_key = self.signing_key
+            signed_userinfo = response.to_jwt([signing_key], signing_key.alg)
+            self.userinfo_cache.set(
+                cache_key,
+                signed_userinfo,
+                min(time.time() + self.userinfo_cache_ttl, expires_at),
             )
+            return Response(signed_userinfo, content="application/jwt")
         except (BearerTokenError, InvalidAccessToken) as e:
             error_resp = UserInfoErrorResponse(
                 error="invalid_token", error_description=str(e)
@@ -33,3 +284,23 @@ class JWTUserInfoOpenIDConnectFrontend(OpenIDConnectFrontend):
                 content="application/json",
             )
             return response
+
+    def introspect_access_token(self, access_token):
+        """
+        Introspects `access_token` for pyop, keeping the result for the
+        request being handled.
+        """
+        introspection = self._introspect_access_token(access_token)
+        self._introspection.value = introspection
+        return introspection
+
+    def handle_userinfo_request(self, request, headers):
+        """
+        Returns pyop's userinfo response, and the expiration time of its
+        access token, from the introspection pyop did for the request.
+        """
+        self._introspection.value = None
+        response = self.provider.handle_userinfo_request(
+            request=request, http_headers=headers
+        )
+        return response, self._introspection.value["exp"]
@@ -0,0 +1,55 @@
+import hmac
+import logging
+import os
+
+from satosa.frontends.base import FrontendModule
+from satosa.response import Response, Unauthorized
+
+from oidc2fer import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsFrontend(FrontendModule):
+    """
+    SATOSA frontend exporting the metrics of all the gunicorn workers to be
+    scraped, like the ping frontend answers heartbeat requests.
+
+    The metrics tell the traffic and rejections of each IdP, and are served on
+    the same host as the OIDC endpoints: only the scrapes with the
+    `bearer_token` of the config, METRICS_TOKEN by default, get them, and
+    none if it is unset or empty.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, auth_req_callback_func, internal_attributes, config, base_url, name
+    ):
+        super().__init__(auth_req_callback_func, internal_attributes, base_url, name)
+        self.config = config or {}
+        token = self.config.get("bearer_token", os.environ.get("METRICS_TOKEN"))
+        self.authorization = f"Bearer {token}".encode() if token else None
+        if self.authorization is None:
+            logger.warning("No metrics bearer token, the scrapes are refused")
+
+    def handle_authn_response(self, context, internal_resp):
+        raise NotImplementedError()
+
+    def handle_backend_error(self, exception):
+        raise NotImplementedError()
+
+    def register_endpoints(self, backend_names):
+        return [(f"^{self.name}$", self.metrics_endpoint)]
+
+    def is_authorized(self, context):
+        authorization = (context.request_authorization or "").encode()
+        return self.authorization is not None and hmac.compare_digest(
+            authorization, self.authorization
+        )
+
+    def metrics_endpoint(self, context):
+        if not self.is_authorized(context):
+            return Unauthorized(
+                "Unauthorized", headers=[("WWW-Authenticate", "Bearer")]
+            )
+        content, content_type = metrics.render()
+        return Response(content, content=content_type)
@@ -0,0 +1,290 @@
+"""
+The JSON logs of gunicorn and of the app, see the gunicorn config.
+
+The formatters build each line from the record alone: its time is taken from
+`record.created`, formatted once per second, instead of read from the clock or
+parsed back from the access log line, and the fields that never change are
+serialized once. QueueStreamHandler hands the records over to a thread which
+serializes and writes them, so that a request never waits for stdout.
+SamplingFilter keeps one record in `sample` of a logger, or at most
+`per_second` of them, as set in LOG_LEVELS.
+"""
+
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+
+# The attributes of all the records, the others are the `extra` of the call
+BUILTIN_ATTRS = frozenset(
+    [*logging.makeLogRecord({}).__dict__, "message", "asctime", "taskName"]
+)
+# Raised by json.dumps for the values `default` doesn't handle
+JSON_ERRORS = (TypeError, ValueError, OverflowError)
+
+
+class UTCTime:
+    """
+    Formats the timestamps of the records in ISO 8601, in UTC, the date and
+    time of the current second being formatted once.
+    """
+
+    def __init__(self):
+        self._second = (None, "")
+
+    def __call__(self, created):
+        second = int(created)
+        cached_second, prefix = self._second
+        if second != cached_second:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            # Replaced at once, for the threads to see either second
+            self._second = (second, prefix)
+        return f"{prefix}.{int((created - second) * 1_000_000):06d}+00:00"
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats the dict returned by `json_record` as a JSON line, followed by the
+    static `fields`.
+    """
+
+    def __init__(self, fields=None):
+        super().__init__()
+        self.format_time = UTCTime()
+        # Closes the JSON object of each record
+        self.suffix = f",{json.dumps(fields)[1:]}" if fields else "}"
+
+    def json_record(self, record):
+        raise NotImplementedError
+
+    def format(self, record):
+        # Built in the thread of the request by QueueStreamHandler
+        payload = record.__dict__.get("json_payload")
+        if payload is None:
+            payload = self.json_record(record)
+        try:
+            line = json.dumps(payload, default=str)
+        except JSON_ERRORS:
+            line = json.dumps({name: str(value) for name, value in payload.items()})
+        return line[:-1] + self.suffix
+
+
+class DefaultJSONFormatter(JSONFormatter):
+    """
+    Formats a record with its message, time, extra fields, exception, logger,
+    level and pid, like json_log_formatter did.
+    """
+
+    def json_record(self, record):
+        attributes = record.__dict__
+        payload = {name: attributes[name] for name in attributes.keys() - BUILTIN_ATTRS}
+        payload["message"] = record.getMessage()
+        payload.setdefault("time", self.format_time(record.created))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc_info"] = record.exc_text
+        payload["logger"] = record.name
+        payload["level"] = record.levelname
+        payload["pid"] = record.process
+        return payload
+
+
+class RequestJSONFormatter(JSONFormatter):
+    """
+    Formats the access log records of gunicorn, see
+    https://docs.gunicorn.org/en/stable/settings.html#access-log-format
+    """
+
+    def json_record(self, record):
+        args = record.args
+        path = args["U"]
+        if args["q"]:
+            path += f"?{args['q']}"
+        return {
+            "logger": record.name,
+            "level": record.levelname,
+            "remote_ip": args["h"],
+            "method": args["m"],
+            "path": path,
+            "status": str(args["s"]),
+            "time": self.format_time(record.created),
+            "user_agent": args["a"],
+            "referer": args["f"],
+            "duration_in_ms": args["M"],
+            "pid": record.process,
+        }
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one record in `sample`, and at most `per_second` records each
+    second, of the records below WARNING. The kept records tell the sample
+    rate, and how many records were dropped in the previous second.
+    """
+
+    def __init__(self, sample=1, per_second=None):
+        super().__init__()
+        self.sample = sample
+        self.per_second = per_second
+        self._count = 0
+        self._second = None
+        self._in_second = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            if self.sample > 1:
+                self._count += 1
+                if self._count % self.sample:
+                    return False
+                record.sample_rate = self.sample
+            if self.per_second is not None:
+                second = int(record.created)
+                if second != self._second:
+                    if self._dropped:
+                        record.dropped = self._dropped
+                    self._second, self._in_second, self._dropped = second, 0, 0
+                if self._in_second >= self.per_second:
+                    self._dropped += 1
+                    return False
+                self._in_second += 1
+        return True
+
+
+def logger_config(level):
+    """
+    Returns the dictConfig of a logger of LOG_LEVELS, given its level, or an
+    object of its `level` and its `sample` or `per_second`, see
+    SamplingFilter.
+    """
+    if isinstance(level, str):
+        return {"level": level.upper()}
+    config = {"level": level.get("level", "NOTSET").upper()}
+    if "sample" in level or "per_second" in level:
+        config["filters"] = [
+            SamplingFilter(level.get("sample", 1), level.get("per_second"))
+        ]
+    return config
+
+
+class _QueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room in a full queue, the thread is emptying it
+        self.queue.put(self._sentinel)
+
+
+class QueueStreamHandler(QueueHandler):
+    """
+    Writes the records to `stream` from a thread, which serializes them with
+    the formatter of this handler. Up to `max_size` records wait for the thread,
+    the next ones are dropped, and counted in the next record written, rather
+    than making the request wait.
+
+    The thread is stopped before gunicorn forks the workers, and started again
+    in each of them.
+    """
+
+    def __init__(self, stream=None, max_size=10000):
+        super().__init__(queue.Queue(max_size))
+        self.max_size = max_size
+        self.stream_handler = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.listener = None
+        self._closed = False
+        self.start()
+        _queue_stream_handlers.add(self)
+
+    def start(self):
+        if not self._closed and self.listener is None:
+            self.listener = _QueueListener(self.queue, self.stream_handler)
+            self.listener.start()
+
+    def stop(self):
+        """
+        Writes the records in the queue, and stops the thread.
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def start_in_child(self):
+        # The thread wasn't forked, and the queue may have been locked by
+        # another thread
+        self.listener = None
+        self.queue = queue.Queue(self.max_size)
+        self.start()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.stream_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Returns a copy of `record` with its message and exception resolved, and
+        its JSON payload built if the formatter is a JSONFormatter, in the
+        thread of the request: the arguments it was logged with may change
+        once it returns. The thread only serializes and writes the payload.
+        """
+        record = copy.copy(record)
+        with self.lock:
+            if self.dropped:
+                record.queue_dropped, self.dropped = self.dropped, 0
+        formatter = self.formatter or logging.Formatter()
+        if isinstance(formatter, JSONFormatter):
+            record.json_payload = formatter.json_record(record)
+        record.msg = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = formatter.formatException(record.exc_info)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1 + getattr(record, "queue_dropped", 0)
+
+    def close(self):
+        self._closed = True
+        _queue_stream_handlers.discard(self)
+        self.stop()
+        self.stream_handler.flush()
+        super().close()
+
+
+# The handlers whose thread is stopped before a fork, referenced weakly for
+# the fork hooks, registered once, to never keep a handler alive
+_queue_stream_handlers = weakref.WeakSet()
+
+
+def _stop_queue_stream_handlers():
+    for handler in list(_queue_stream_handlers):
+        handler.stop()
+
+
+def _start_queue_stream_handlers():
+    for handler in list(_queue_stream_handlers):
+        handler.start()
+
+
+def _start_queue_stream_handlers_in_child():
+    for handler in list(_queue_stream_handlers):
+        handler.start_in_child()
+
+
+os.register_at_fork(
+    before=_stop_queue_stream_handlers,
+    after_in_parent=_start_queue_stream_handlers,
+    after_in_child=_start_queue_stream_handlers_in_child,
+)
@@ -0,0 +1,91 @@
+"""
+Caches the federation metadata in a local file: the metadata is downloaded and
+its signature checked once, then its parsed entity descriptors are saved in
+the JSON format of pysaml2's "mdfile" metadata, which the SAML backend loads
+much faster than the XML.
+
+    python -m oidc2fer.metadata_cache /tmp/saml2_metadata.json
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from saml2.config import SPConfig
+from saml2.httpbase import HTTPBase
+from saml2.mdstore import MetaDataExtern, MetaDataFile
+from saml2.sigver import SignatureError, security_context
+
+logger = logging.getLogger(__name__)
+
+
+def load_federation_metadata(source, cert=None):
+    """
+    Downloads and parses the metadata at `source`, a URL or a local path. If
+    `cert` is given, the metadata must be signed with its key.
+    """
+    config = SPConfig().load({"entityid": "urn:oidc2fer:metadata-cache"})
+    security = security_context(config) if cert else None
+    if source.startswith(("https://", "http://")):
+        metadata = MetaDataExtern(
+            config.attribute_converters, source, security, cert, HTTPBase()
+        )
+    else:
+        metadata = MetaDataFile(
+            config.attribute_converters, source, cert=cert, security=security
+        )
+    metadata.load()
+    # pysaml2 only checks the signature of signed metadata
+    if cert and not metadata.signed():
+        raise SignatureError(f"The metadata from {source} is not signed")
+    return metadata
+
+
+def write_metadata_cache(metadata, path):
+    """
+    Atomically replaces `path` with the IdPs of `metadata`, and returns their
+    number.
+    """
+    # The gateway is an SP, it never looks up the other SPs of the federation
+    entities = [
+        (entity_id, entity)
+        for entity_id, entity in metadata.items()
+        if "idpsso_descriptor" in entity
+    ]
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(entities, f, separators=(",", ":"))
+    os.replace(temporary_path, path)
+    return len(entities)
+
+
+def build_metadata_cache(source, path, cert=None):
+    metadata = load_federation_metadata(source, cert)
+    count = write_metadata_cache(metadata, path)
+    logger.info("Cached the metadata of %d IdPs from %s in %s", count, source, path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Caches the federation metadata in a local file."
+    )
+    parser.add_argument("path", help="Path of the cache file to write")
+    parser.add_argument(
+        "--source",
+        default=os.environ.get("SAML2_METADATA_URL"),
+        help="URL or path of the federation metadata (default: SAML2_METADATA_URL)",
+    )
+    parser.add_argument(
+        "--cert", help="Path of the certificate the metadata must be signed with"
+    )
+    args = parser.parse_args()
+    if not args.source:
+        parser.error("--source or SAML2_METADATA_URL is required")
+    logging.basicConfig(level=logging.INFO)
+    build_metadata_cache(args.source, args.path, args.cert)
+
+
+if __name__ == "__main__":
+    main()
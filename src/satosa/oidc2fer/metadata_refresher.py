@@ -0,0 +1,178 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from saml2.mdstore import MetaDataMD
+
+from oidc2fer import workers
+from oidc2fer.file_watcher import FileWatcher
+from oidc2fer.metadata_cache import build_metadata_cache
+from oidc2fer.metrics import (
+    METADATA_REFRESH_DURATION,
+    METADATA_REFRESH_FAILURES,
+    METADATA_RELOAD_DURATION,
+    METADATA_STALENESS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataRefresher:
+    """
+    Keeps the metadata of a SAML entity up to date in a background thread.
+
+    Once per node, the worker holding a lock on the cache file downloads the
+    federation metadata every `interval` seconds, and replaces the cache file
+    if it is valid. In every worker, the metadata store of the entity then
+    switches to the new cache file at once, so that requests never see a
+    partially loaded store. If the metadata can't be downloaded or validated,
+    the last known good cache file stays in use.
+    """
+
+    def __init__(self, cache_path, config):
+        """
+        `config` holds the `source` of the metadata, URL or path, the `cert`
+        it must be signed with if any, and the `interval`, `check_interval`
+        and `retry_interval` in seconds.
+        """
+        self.entity = None
+        self.cache_path = cache_path
+        self.config = {
+            "cert": None,
+            "interval": 3600,
+            "check_interval": 30,
+            "retry_interval": 300,
+            **config,
+        }
+        # The thread already checks every check_interval seconds
+        self.watcher = FileWatcher(cache_path, 0)
+        self.metrics = {
+            "loaded_at": time.time(),
+            "refresh_duration": None,
+            "reload_duration": None,
+            "refresh_failures": 0,
+        }
+        self._next_attempt = 0
+        self._thread = None
+
+    def watch(self, entity):
+        """
+        Keeps the metadata store of `entity`, loaded from the cache file, up
+        to date.
+        """
+        self.entity = entity
+        self.watcher.loaded(os.stat(self.cache_path))
+
+    def refresh(self, wait=False):
+        """
+        Replaces the cache file with a fresh download, if it is older than
+        `interval` and no other process on the node is already doing it. With
+        `wait`, waits for the other process instead, to use its download.
+        """
+        with open(f"{self.cache_path}.lock", "a", encoding="utf-8") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return
+            if (
+                self.staleness() < self.config["interval"]
+                or time.monotonic() < self._next_attempt
+            ):
+                return
+            started_at = time.perf_counter()
+            try:
+                build_metadata_cache(
+                    self.config["source"], self.cache_path, self.config["cert"]
+                )
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Anything can go wrong with a remote document, and the thread
+                # must keep going with the last known good metadata
+                self.metrics["refresh_failures"] += 1
+                METADATA_REFRESH_FAILURES.inc()
+                self._next_attempt = time.monotonic() + self.config["retry_interval"]
+                logger.exception(
+                    "Failed to refresh the metadata from %s, keeping %s",
+                    self.config["source"],
+                    self.cache_path,
+                )
+            finally:
+                duration = time.perf_counter() - started_at
+                self.metrics["refresh_duration"] = duration
+                METADATA_REFRESH_DURATION.observe(duration)
+
+    def reload(self):
+        """
+        Switches the metadata store of the entity to the current cache file.
+        """
+        stat_result = os.stat(self.cache_path)
+        started_at = time.perf_counter()
+        metadata = MetaDataMD(self.entity.metadata.attrc, self.cache_path)
+        metadata.load()
+        store = self.entity.metadata
+        # Replace the dict instead of updating it, requests being processed
+        # keep using the previous one
+        store.metadata = {**store.metadata, self.cache_path: metadata}
+        self.entity.sourceid = store.construct_source_id()
+        self.watcher.loaded(stat_result)
+        self.metrics["loaded_at"] = time.time()
+        self.metrics["reload_duration"] = time.perf_counter() - started_at
+        METADATA_RELOAD_DURATION.observe(self.metrics["reload_duration"])
+        logger.info(
+            "Reloaded the metadata of %d IdPs from %s",
+            len(metadata),
+            self.cache_path,
+            extra=self.stats(),
+        )
+
+    def staleness(self):
+        """
+        Returns the number of seconds since the cache file was last refreshed.
+        """
+        try:
+            return time.time() - os.stat(self.cache_path).st_mtime
+        except FileNotFoundError:
+            return float("inf")
+
+    def stats(self):
+        return {
+            "metadata_staleness_seconds": self.staleness(),
+            "metadata_loaded_seconds_ago": time.time() - self.metrics["loaded_at"],
+            "metadata_refresh_duration_seconds": self.metrics["refresh_duration"],
+            "metadata_reload_duration_seconds": self.metrics["reload_duration"],
+            "metadata_refresh_failures": self.metrics["refresh_failures"],
+        }
+
+    def run_once(self):
+        """
+        Refreshes the cache file if needed, switches to it if it changed, and
+        updates the metrics of the metadata.
+        """
+        self.refresh()
+        if self.watcher.changed():
+            try:
+                self.reload()
+            except (OSError, ValueError) as e:
+                logger.error("Failed to reload %s: %s", self.cache_path, e)
+        METADATA_STALENESS.set(self.staleness())
+
+    def run(self):
+        while True:
+            time.sleep(self.config["check_interval"])
+            try:
+                self.run_once()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Metadata refresh failed")
+
+    def start(self):
+        """
+        Starts the background thread in each gunicorn worker.
+        """
+        workers.in_each_worker(self._start_thread)
+
+    def _start_thread(self):
+        self._thread = threading.Thread(
+            target=self.run, name="metadata-refresher", daemon=True
+        )
+        self._thread.start()
@@ -0,0 +1,182 @@
+"""
+The Prometheus metrics of the gateway, exported by the metrics frontend.
+
+Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set by the gunicorn config: each
+worker then writes its metrics to files in this directory, and the metrics of
+all the workers are added up when scraped.
+"""
+
+import functools
+import inspect
+import math
+import os
+import threading
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    math.inf,
+)
+
+# Upper bounds of the buckets of the metadata refreshes, in seconds: the
+# metadata of a whole federation takes seconds to download and load
+METADATA_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, math.inf)
+
+# The most IdP entityIDs a worker labels its counters with, the next ones being
+# counted under OTHER_ISSUER: each label value is a series in each worker file
+MAX_ISSUERS = 100
+OTHER_ISSUER = "other"
+
+REQUESTS = Counter(
+    "oidc2fer_requests",
+    "Requests handled, by endpoint and outcome (success or error).",
+    ["endpoint", "outcome"],
+)
+REQUEST_DURATION = Histogram(
+    "oidc2fer_request_duration_seconds",
+    "Time spent in each endpoint.",
+    ["endpoint"],
+    buckets=BUCKETS,
+)
+STAGE_DURATION = Histogram(
+    "oidc2fer_stage_duration_seconds",
+    "Time spent in each stage of a request, without the stages it calls.",
+    ["stage"],
+    buckets=BUCKETS,
+)
+AFFILIATION_REJECTIONS = Counter(
+    "oidc2fer_affiliation_rejections",
+    "Users rejected because of their affiliation, by IdP entityID, see issuer_label.",
+    ["issuer"],
+)
+CACHE_LOOKUPS = Counter(
+    "oidc2fer_cache_lookups",
+    "Lookups in the caches, by cache and result (hit or miss).",
+    ["cache", "result"],
+)
+SIRET_MAPPING_MISSES = Counter(
+    "oidc2fer_siret_mapping_misses",
+    "Responses from IdPs without a SIRET mapping, by IdP entityID, see issuer_label.",
+    ["issuer"],
+)
+# Set by each worker after checking the metadata, the latest check being the
+# highest value
+METADATA_STALENESS = Gauge(
+    "oidc2fer_metadata_staleness_seconds",
+    "Seconds since the federation metadata cache was last refreshed.",
+    multiprocess_mode="livemax",
+)
+METADATA_REFRESH_DURATION = Histogram(
+    "oidc2fer_metadata_refresh_duration_seconds",
+    "Time spent downloading and validating the federation metadata.",
+    buckets=METADATA_BUCKETS,
+)
+METADATA_RELOAD_DURATION = Histogram(
+    "oidc2fer_metadata_reload_duration_seconds",
+    "Time spent switching to a refreshed federation metadata cache.",
+    buckets=METADATA_BUCKETS,
+)
+METADATA_REFRESH_FAILURES = Counter(
+    "oidc2fer_metadata_refresh_failures",
+    "Federation metadata that couldn't be downloaded or validated.",
+)
+
+_issuers = set()
+_issuers_lock = threading.Lock()
+
+
+def issuer_label(issuer):
+    """
+    Returns the label of the IdP `issuer` in the counters: its entityID, or
+    OTHER_ISSUER once MAX_ISSUERS other IdPs have been counted.
+    """
+    issuer = issuer or ""
+    if issuer in _issuers:
+        return issuer
+    with _issuers_lock:
+        if len(_issuers) < MAX_ISSUERS:
+            _issuers.add(issuer)
+            return issuer
+    return OTHER_ISSUER
+
+
+def qualified_name(module_name, func):
+    func = inspect.unwrap(func)
+    # The SAML backend binds its endpoints with functools.partial
+    return f"{module_name}.{getattr(func, 'func', func).__name__}"
+
+
+def count_requests(endpoint, func):
+    """
+    Wraps the endpoint function `func` to count its requests by outcome and
+    record its duration. Authentication errors raised by the backend or the
+    micro-services are errors, even if the frontend then redirects the user
+    agent to the client.
+    """
+
+    @functools.wraps(func)
+    def counted(*args, **kwargs):
+        outcome = "error"
+        started_at = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+            status = getattr(response, "status", "200 OK")
+            if int(status.split()[0]) < 400:
+                outcome = "success"
+            return response
+        finally:
+            REQUEST_DURATION.labels(endpoint).observe(time.perf_counter() - started_at)
+            REQUESTS.labels(endpoint, outcome).inc()
+
+    return counted
+
+
+def instrument_endpoints(satosa):
+    """
+    Counts the requests to the endpoints of the backends and frontends of
+    `satosa`, a SATOSABase.
+    """
+    router = satosa.module_router
+    for modules in (router.backends, router.frontends):
+        for name, module in modules.items():
+            module["endpoints"] = [
+                (regex, count_requests(qualified_name(name, spec), spec))
+                for regex, spec in module["endpoints"]
+            ]
+
+
+def render():
+    """
+    Returns the metrics of all the workers, or of this process when not
+    running under gunicorn, and their content type.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry).decode(), CONTENT_TYPE_LATEST
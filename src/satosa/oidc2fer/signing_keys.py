@@ -0,0 +1,182 @@
+"""
+The signing keys of the OIDC frontend, RSA (RS256) or EC P-256 (ES256),
+depending on their PEM file.
+
+pyjwkest signs in pure Python, or with pycryptodome for RSA, which costs a few
+milliseconds per token. The private key is therefore also prepared once, when
+the app is loaded, as an OpenSSL key from cryptography, which signs the ID
+tokens and userinfo responses instead. An ES256 signature is then much cheaper
+than an RS256 one.
+
+The prepared keys sign through the signers of jwkest.jws.SIGNER_ALGS, for the
+versions of pyjwkest in PATCHED_PYJWKEST_VERSIONS only: with another one, the
+keys sign with pyjwkest as they are.
+"""
+
+import functools
+import logging
+from importlib import metadata
+
+import yaml
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from jwkest import jws
+from jwkest.jwk import ECKey, RSAKey, import_rsa_key
+
+ALGORITHMS = ("RS256", "ES256")
+KEY_STATUSES = ("current", "next", "previous")
+
+# The versions of pyjwkest whose SIGNER_ALGS and JWS.sign_compact the prepared
+# keys are signed through, checked by tests/oidc2fer/test_signing_keys.py
+PATCHED_PYJWKEST_VERSIONS = ("1.4.4",)
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedPrivateKey:
+    """
+    A private key signing with OpenSSL.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def sign(self, message):
+        if isinstance(self.key, rsa.RSAPrivateKey):
+            return self.key.sign(message, padding.PKCS1v15(), hashes.SHA256())
+        r, s = decode_dss_signature(self.key.sign(message, ec.ECDSA(hashes.SHA256())))
+        # JWS signatures are the concatenated big-endian r and s, see RFC 7518
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+
+class PreparedRSAKey(RSAKey):
+    prepared = None
+
+    def get_key(self, private=False, **kwargs):
+        if private and self.prepared:
+            return self.prepared
+        return super().get_key(private=private, **kwargs)
+
+
+class PreparedECKey(ECKey):
+    prepared = None
+
+    def get_key(self, private=False, **kwargs):
+        if private and self.prepared:
+            return self.prepared
+        return super().get_key(private=private, **kwargs)
+
+
+class PreparedKeySigner:
+    """
+    Signs with prepared keys, and with the pyjwkest `signer` otherwise, which
+    also verifies the signatures.
+    """
+
+    def __init__(self, signer):
+        self.signer = signer
+
+    def sign(self, message, key):
+        if isinstance(key, PreparedPrivateKey):
+            return key.sign(message)
+        return self.signer.sign(message, key)
+
+    def verify(self, message, signature, key):
+        return self.signer.verify(message, signature, key)
+
+
+@functools.cache
+def register_signers():
+    """
+    Makes pyjwkest sign with the prepared keys, once, and returns whether it
+    does.
+    """
+    pyjwkest_version = metadata.version("pyjwkest")
+    if pyjwkest_version not in PATCHED_PYJWKEST_VERSIONS:
+        logger.warning(
+            "The keys are not prepared with pyjwkest %s, only with pyjwkest %s",
+            pyjwkest_version,
+            ", ".join(PATCHED_PYJWKEST_VERSIONS),
+        )
+        return False
+    for alg in ALGORITHMS:
+        if not isinstance(jws.SIGNER_ALGS[alg], PreparedKeySigner):
+            jws.SIGNER_ALGS[alg] = PreparedKeySigner(jws.SIGNER_ALGS[alg])
+    return True
+
+
+def load_signing_key(path, kid=""):
+    """
+    Returns the pyjwkest key of the RSA or EC P-256 private key in the PEM
+    file at `path`, prepared to sign with OpenSSL if pyjwkest allows it.
+    """
+    with open(path, "rb") as f:
+        pem = f.read()
+    key = serialization.load_pem_private_key(pem, password=None)
+    if isinstance(key, rsa.RSAPrivateKey):
+        signing_key = PreparedRSAKey(
+            key=import_rsa_key(pem), use="sig", alg="RS256", kid=kid
+        )
+    elif isinstance(key, ec.EllipticCurvePrivateKey) and isinstance(
+        key.curve, ec.SECP256R1
+    ):
+        numbers = key.private_numbers()
+        signing_key = PreparedECKey(
+            x=numbers.public_numbers.x,
+            y=numbers.public_numbers.y,
+            d=numbers.private_value,
+            crv="P-256",
+            use="sig",
+            alg="ES256",
+            kid=kid,
+        )
+    else:
+        raise ValueError(f"{path} is neither an RSA nor an EC P-256 private key")
+    if register_signers():
+        signing_key.prepared = PreparedPrivateKey(key)
+    return signing_key
+
+
+class KeyRing:
+    """
+    The `current` key signs the tokens, the `next` keys are published ahead
+    of their use, for relying parties to know them when they start signing,
+    and the `previous` keys stay published until the tokens they signed
+    expire. Rotating a key then never invalidates tokens in flight.
+    """
+
+    def __init__(self, current, next_keys=(), previous_keys=()):
+        self.current = current
+        self.next_keys = tuple(next_keys)
+        self.previous_keys = tuple(previous_keys)
+
+    @property
+    def published_keys(self):
+        return (self.current, *self.next_keys, *self.previous_keys)
+
+    @property
+    def algorithms(self):
+        """
+        The algorithms of the current and next keys, the current one first.
+        """
+        return list(dict.fromkeys(key.alg for key in (self.current, *self.next_keys)))
+
+    def jwks(self):
+        return {"keys": [key.serialize() for key in self.published_keys]}
+
+
+def load_key_ring(stream):
+    """
+    Loads the key ring from YAML `stream`, a list of keys with their `kid`,
+    the `path` of their PEM file and their `status`, current, next or
+    previous, with exactly one current key.
+    """
+    keys = {status: [] for status in KEY_STATUSES}
+    for entry in yaml.safe_load(stream) or []:
+        if entry["status"] not in keys:
+            raise ValueError(f"Unknown status {entry['status']} of key {entry['kid']}")
+        keys[entry["status"]].append(load_signing_key(entry["path"], entry["kid"]))
+    if len(keys["current"]) != 1:
+        raise ValueError("The key ring must have exactly one current key")
+    return KeyRing(keys["current"][0], keys["next"], keys["previous"])
@@ -0,0 +1,178 @@
+"""
+Times each stage of the requests handled by SATOSA: the endpoints of the
+backends and frontends, the response micro-services and the handling of the
+authentication response by the frontend.
+
+The time of a stage excludes the time of the stages it calls, e.g. the time of
+the SAML backend ACS endpoint is the time spent validating the SAML response,
+without the micro-services and the frontend it then hands the response to.
+Timings are recorded by stage in a histogram exported by the metrics frontend,
+and by stage and IdP entityID in histograms logged every `log_interval`
+seconds: the IdPs of the federation would multiply the exported series.
+"""
+
+import functools
+import logging
+import threading
+import time
+
+from oidc2fer.metrics import BUCKETS, STAGE_DURATION, qualified_name
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    A histogram of the timings logged at the end of each interval.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, upper_bound in enumerate(BUCKETS):
+            if seconds <= upper_bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the `q` quantile, or the
+        largest observed value if it is lower.
+        """
+        rank = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(BUCKETS, self.counts, strict=True):
+            cumulative += count
+            if cumulative >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+
+class StageTimings:
+    """
+    Records the time spent in each stage in the Prometheus `histogram`, and
+    by IdP entityID in histograms logged every `log_interval` seconds.
+    """
+
+    def __init__(
+        self, histogram=STAGE_DURATION, log_interval=60, clock=time.perf_counter
+    ):
+        self.histogram = histogram
+        self.log_interval = log_interval
+        self._clock = clock
+        self._interval_histograms = {}
+        self._next_log = time.monotonic() + log_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, stage, issuer, seconds):
+        self.histogram.labels(stage).observe(seconds)
+        key = (stage, issuer)
+        with self._lock:
+            if key not in self._interval_histograms:
+                self._interval_histograms[key] = Histogram()
+            self._interval_histograms[key].observe(seconds)
+
+    def time(self, stage, func):
+        """
+        Wraps `func` so that the time spent in it, minus the time spent in the
+        stages it calls, is recorded under `stage`.
+        """
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            local = self._local
+            if not hasattr(local, "stack"):
+                local.stack = []
+            if not local.stack:
+                local.issuer = ""
+                local.timings = []
+            for arg in args:
+                issuer = getattr(getattr(arg, "auth_info", None), "issuer", None)
+                if issuer:
+                    local.issuer = issuer
+            # The time spent in the stages called by this one
+            nested = [0.0]
+            local.stack.append(nested)
+            started_at = self._clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = self._clock() - started_at
+                local.stack.pop()
+                local.timings.append((stage, elapsed - nested[0]))
+                if local.stack:
+                    local.stack[-1][0] += elapsed
+                else:
+                    # The issuer is only known once the backend has parsed the
+                    # response, so it is applied when the request is done
+                    for timed_stage, seconds in local.timings:
+                        self.observe(timed_stage, local.issuer, seconds)
+                    self.log_if_due()
+
+        return timed
+
+    def log_if_due(self):
+        with self._lock:
+            if time.monotonic() < self._next_log:
+                return
+            self._next_log = time.monotonic() + self.log_interval
+            histograms, self._interval_histograms = self._interval_histograms, {}
+        for (stage, issuer), histogram in sorted(histograms.items()):
+            logger.info(
+                "Stage timings",
+                extra={
+                    "stage": stage,
+                    "issuer": issuer,
+                    "count": histogram.count,
+                    "mean_ms": round(1000 * histogram.sum / histogram.count, 3),
+                    "p50_ms": round(1000 * histogram.quantile(0.5), 3),
+                    "p95_ms": round(1000 * histogram.quantile(0.95), 3),
+                    "p99_ms": round(1000 * histogram.quantile(0.99), 3),
+                    "max_ms": round(1000 * histogram.max, 3),
+                },
+            )
+
+
+def instrument(satosa, timings, excluded_modules=()):
+    """
+    Times the endpoints of the backends and frontends of `satosa`, a
+    SATOSABase, its response micro-services and the handling of
+    authentication responses by its frontends.
+    """
+    router = satosa.module_router
+    for modules in (router.backends, router.frontends):
+        for name, module in modules.items():
+            if name in excluded_modules:
+                continue
+            module["endpoints"] = [
+                (regex, timings.time(qualified_name(name, spec), spec))
+                for regex, spec in module["endpoints"]
+            ]
+    for name, module in router.frontends.items():
+        if name not in excluded_modules:
+            frontend = module["instance"]
+            frontend.handle_authn_response = timings.time(
+                qualified_name(name, frontend.handle_authn_response),
+                frontend.handle_authn_response,
+            )
+
+    micro_services = satosa.response_micro_services
+    for micro_service in micro_services:
+        micro_service.process = timings.time(
+            qualified_name(micro_service.name, micro_service.process),
+            micro_service.process,
+        )
+    # Each micro-service calls the next one through the bound method it was
+    # linked with, the last one keeps calling the frontend
+    for micro_service, next_micro_service in zip(
+        micro_services, micro_services[1:], strict=False
+    ):
+        micro_service.next = next_micro_service.process
@@ -0,0 +1,428 @@
+"""
+A compact encoding of the SATOSA state cookie.
+
+SATOSA serializes the state as JSON, compresses it with LZMA, encrypts it with
+AES-CBC, then compresses and base64-encodes it again, on every hop of a login.
+Here the fields the gateway always stores (session ID, router, requester, the
+OIDC authorization request and the SAML relay state) are encoded by their
+position in SCHEMA, and the parameters of the authorization request by their
+position in OIDC_PARAMETERS, the rest of the state as JSON. The payload is
+encrypted and authenticated at once with AES-GCM.
+
+The copy of the cookie without SameSite, for the user agents which reject
+SameSite=None, is only sent to them, or to replace a copy the user agent sent.
+Cookies in SATOSA's encoding are still read, for the logins in flight while
+the gateway is upgraded.
+
+With a store, see oidc2fer.state_store, the cookie only holds an opaque ID of
+the state, and the encoded state is kept in the store.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import uuid
+from urllib.parse import parse_qsl, urlencode
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from satosa.cookies import SimpleCookie
+from satosa.exception import SATOSAStateError
+from satosa.state import State
+
+logger = logging.getLogger(__name__)
+
+VERSION = "1"
+NONCE_SIZE = 12
+# The prefix of the IDs of the states kept in a store
+STORED_PREFIX = "s."
+STATE_ID_KEY = "oidc2fer.state_id"
+
+# The fields of the state and their encoding, never reorder them: their
+# position is their tag in the cookies in flight
+SCHEMA = (
+    (("SESSION_ID",), "uuid"),
+    (("ROUTER",), "str"),
+    (("SATOSA_BASE", "requester"), "str"),
+    (("OIDC", "oidc_request"), "query"),
+    (("Saml2", "relay_state"), "str"),
+    (("force_authn",), "json"),
+)
+# The rest of the state, as JSON
+REST_TAG = 0
+# The parameters of the authorization requests, same as SCHEMA
+OIDC_PARAMETERS = (
+    "client_id",
+    "redirect_uri",
+    "response_type",
+    "scope",
+    "state",
+    "nonce",
+    "claims",
+    "acr_values",
+    "prompt",
+    "max_age",
+    "login_hint",
+    "ui_locales",
+    "response_mode",
+    "code_challenge",
+    "code_challenge_method",
+)
+UNKNOWN_PARAMETER = 0
+
+# The user agents rejecting or mishandling SameSite=None cookies, see
+# https://www.chromium.org/updates/same-site/incompatible-clients
+INCOMPATIBLE_USER_AGENTS = (
+    re.compile(r"\(iP.+; CPU .*OS 12[_\d]*.*\) AppleWebKit/"),
+    # Safari and the embedded browsers, any browser on macOS 10.14 here
+    re.compile(r"\(Macintosh;.*Mac OS X 10_14[_\d]*.*\) AppleWebKit/"),
+    re.compile(r"Chrom(?:e|ium)/(?:5[1-9]|6[0-6])\."),
+    # UC Browser before 12.13.2
+    re.compile(r"UCBrowser/(?:\d\.|1[01]\.|12\.(?:\d|1[0-2])\.|12\.13\.[01]\b)"),
+)
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def decode_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_bytes(value):
+    return encode_varint(len(value)) + value
+
+
+def decode_bytes(data, offset):
+    length, offset = decode_varint(data, offset)
+    if offset + length > len(data):
+        raise ValueError("Truncated state")
+    return data[offset : offset + length], offset + length
+
+
+def encode_query(query):
+    """
+    Encodes the parameters of the urlencoded `query`, or returns None if it
+    wouldn't be urlencoded back the same.
+    """
+    parameters = parse_qsl(query, keep_blank_values=True)
+    if urlencode(parameters) != query:
+        return None
+    encoded = bytearray()
+    for name, value in parameters:
+        if name in OIDC_PARAMETERS:
+            encoded += encode_varint(OIDC_PARAMETERS.index(name) + 1)
+        else:
+            encoded += encode_varint(UNKNOWN_PARAMETER)
+            encoded += encode_bytes(name.encode())
+        encoded += encode_bytes(value.encode())
+    return bytes(encoded)
+
+
+def decode_query(data):
+    parameters = []
+    offset = 0
+    while offset < len(data):
+        tag, offset = decode_varint(data, offset)
+        if tag == UNKNOWN_PARAMETER:
+            name, offset = decode_bytes(data, offset)
+            name = name.decode()
+        else:
+            name = OIDC_PARAMETERS[tag - 1]
+        value, offset = decode_bytes(data, offset)
+        parameters.append((name, value.decode()))
+    return urlencode(parameters)
+
+
+def encode_uuid(value):
+    """
+    Returns the 16 bytes of the UUID URN `value`, or None if it wouldn't be
+    formatted back the same.
+    """
+    try:
+        encoded = uuid.UUID(value).bytes
+    except ValueError:
+        return None
+    return encoded if uuid.UUID(bytes=encoded).urn == value else None
+
+
+def encode_value(value, kind):
+    """
+    Returns the bytes of `value`, or None if it can't be encoded as `kind`.
+    """
+    if kind == "json":
+        return json.dumps(value, separators=(",", ":")).encode()
+    if not isinstance(value, str):
+        return None
+    if kind == "uuid":
+        return encode_uuid(value)
+    if kind == "query":
+        return encode_query(value)
+    return value.encode()
+
+
+def decode_value(data, kind):
+    if kind == "json":
+        return json.loads(data)
+    if kind == "uuid":
+        return uuid.UUID(bytes=data).urn
+    if kind == "query":
+        return decode_query(data)
+    return data.decode()
+
+
+def find_container(state, path):
+    """
+    Returns the dict holding the value at `path` in the nested dict `state`,
+    or None if there is no such value.
+    """
+    *parents, name = path
+    container = state
+    for parent in parents:
+        container = container.get(parent)
+        if not isinstance(container, dict):
+            return None
+    return container if name in container else None
+
+
+def set_path(state, path, value):
+    *parents, name = path
+    container = state
+    for parent in parents:
+        container = container.setdefault(parent, {})
+    container[name] = value
+
+
+def encode_payload(state):
+    """
+    Returns the bytes of the dict `state`, its fields of SCHEMA tagged by their
+    position, the rest as JSON.
+    """
+    rest = json.loads(json.dumps(state))
+    encoded = bytearray()
+    emptied = set()
+    for tag, (path, kind) in enumerate(SCHEMA, start=1):
+        container = find_container(rest, path)
+        if container is None:
+            continue
+        value_bytes = encode_value(container[path[-1]], kind)
+        if value_bytes is not None:
+            del container[path[-1]]
+            encoded += encode_varint(tag) + encode_bytes(value_bytes)
+            if not container and len(path) > 1:
+                emptied.add(path[0])
+    # The dicts emptied above are created back when decoding
+    for name in emptied:
+        del rest[name]
+    if rest:
+        rest_bytes = json.dumps(rest, separators=(",", ":")).encode()
+        encoded += encode_varint(REST_TAG) + encode_bytes(rest_bytes)
+    return bytes(encoded)
+
+
+def decode_payload(data):
+    state = {}
+    fields = []
+    offset = 0
+    while offset < len(data):
+        tag, offset = decode_varint(data, offset)
+        value, offset = decode_bytes(data, offset)
+        if tag == REST_TAG:
+            state = json.loads(value)
+        elif tag <= len(SCHEMA):
+            fields.append((tag, value))
+        else:
+            raise ValueError(f"Unknown state field {tag}")
+    for tag, value in fields:
+        path, kind = SCHEMA[tag - 1]
+        set_path(state, path, decode_value(value, kind))
+    return state
+
+
+def derive_key(encryption_key):
+    # Not the key of SATOSA's AES-CBC encryption of the same state
+    return hashlib.sha256(b"oidc2fer state cookie\0" + encryption_key.encode()).digest()
+
+
+def encode_state(state, encryption_key):
+    """
+    Returns the cookie value of the dict `state`, encrypted and authenticated
+    with `encryption_key`.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = AESGCM(derive_key(encryption_key)).encrypt(
+        nonce, encode_payload(state), VERSION.encode()
+    )
+    value = base64.urlsafe_b64encode(nonce + ciphertext).rstrip(b"=").decode()
+    return f"{VERSION}.{value}"
+
+
+def decode_state(value, encryption_key):
+    """
+    Returns the dict of the cookie value `value`, or raises ValueError if it
+    can't be decrypted or authenticated.
+    """
+    version, _, encoded = value.partition(".")
+    if version != VERSION:
+        raise ValueError(f"Unknown state version {version}")
+    data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    try:
+        payload = AESGCM(derive_key(encryption_key)).decrypt(
+            data[:NONCE_SIZE], data[NONCE_SIZE:], VERSION.encode()
+        )
+    except InvalidTag as e:
+        raise ValueError("The state can't be authenticated") from e
+    return decode_payload(payload)
+
+
+def needs_legacy_cookie(user_agent):
+    """
+    Tells whether the user agent may drop a SameSite=None cookie. Without a
+    user agent, the legacy cookie is sent anyway.
+    """
+    if not user_agent:
+        return True
+    return any(pattern.search(user_agent) for pattern in INCOMPATIBLE_USER_AGENTS)
+
+
+class StateCookies:
+    """
+    Loads and saves the state of the requests of SATOSA in the cookie
+    COOKIE_STATE_NAME, and in its copy without SameSite `legacy_name`, if any.
+    """
+
+    def __init__(self, config, legacy_name=None, store=None):
+        """
+        `config` is the SATOSA config, for its COOKIE_* options and the
+        STATE_ENCRYPTION_KEY. With a `store`, the cookies only hold the ID of
+        the state in the store.
+        """
+        self.name = config["COOKIE_STATE_NAME"]
+        self.legacy_name = legacy_name
+        self.store = store
+        self.encryption_key = config["STATE_ENCRYPTION_KEY"]
+        self.attributes = {
+            "path": "/",
+            "secure": config.get("COOKIE_SECURE", True),
+            "httponly": config.get("COOKIE_HTTPONLY", ""),
+            "samesite": config.get("COOKIE_SAMESITE", "None"),
+            "max-age": config.get("COOKIE_MAX_AGE", ""),
+        }
+
+    def decode(self, value):
+        """
+        Returns the State of the cookie value `value`, in the compact encoding
+        or in SATOSA's.
+        """
+        if value.startswith(f"{VERSION}."):
+            state = State()
+            state.data = decode_state(value, self.encryption_key)
+            return state
+        if value.startswith(STORED_PREFIX) and self.store:
+            data = self.store.get(value.removeprefix(STORED_PREFIX))
+            if data is None:
+                raise ValueError("Unknown or expired state")
+            state = State()
+            state.data = decode_payload(data)
+            return state
+        return State(value, self.encryption_key)
+
+    def load(self, context):
+        """
+        Loads the state of the request into `context`, or a new state if the
+        request has none or it can't be read.
+        """
+        cookie = SimpleCookie(context.cookie or "")
+        morsel = cookie.get(self.name) or cookie.get(self.legacy_name or "")
+        state = None
+        if morsel is not None and morsel.value:
+            try:
+                state = self.decode(morsel.value)
+            except (SATOSAStateError, ValueError, IndexError, UnicodeDecodeError) as e:
+                logger.info("Ignoring the invalid state cookie: %s", e)
+            except sqlite3.Error as e:
+                logger.warning("Can't read the state from the store: %s", e)
+            else:
+                if morsel.value.startswith(STORED_PREFIX):
+                    context.decorate(
+                        STATE_ID_KEY, morsel.value.removeprefix(STORED_PREFIX)
+                    )
+        context.state = state or State()
+
+    def cookie_header(self, name, value, samesite):
+        cookie = SimpleCookie()
+        cookie[name] = value
+        for attribute, attribute_value in self.attributes.items():
+            cookie[name][attribute] = attribute_value
+        cookie[name]["samesite"] = samesite
+        if value == "":
+            cookie[name]["max-age"] = 0
+        return tuple(cookie.output().split(": ", 1))
+
+    def store_state(self, context):
+        """
+        Saves the state of `context` in the store, returns the value of the
+        cookie, or None if there is no state to keep.
+        """
+        state = context.state
+        state_id = context.get_decoration(STATE_ID_KEY)
+        if state.delete:
+            if state_id:
+                self.store.delete(state_id)
+            return ""
+        # The requests of the relying parties and the health checks carry no
+        # state, not worth storing
+        if not state_id and state.data.keys() <= {"SESSION_ID"}:
+            return None
+        state_id = state_id or secrets.token_urlsafe(24)
+        self.store.set(state_id, encode_payload(state.data))
+        return f"{STORED_PREFIX}{state_id}"
+
+    def save(self, response, context):
+        """
+        Saves the state of `context` in the cookies of `response`.
+        """
+        state = context.state
+        if self.store:
+            value = self.store_state(context)
+            if value is None:
+                return
+        else:
+            value = (
+                "" if state.delete else encode_state(state.data, self.encryption_key)
+            )
+        names = {self.name, self.legacy_name}
+        response.headers = [
+            (header, header_value)
+            for header, header_value in response.headers
+            if header != "Set-Cookie" or header_value.partition("=")[0] not in names
+        ]
+        response.headers.append(
+            self.cookie_header(self.name, value, self.attributes["samesite"])
+        )
+        if self.legacy_name and (
+            needs_legacy_cookie((context.http_headers or {}).get("HTTP_USER_AGENT"))
+            or self.legacy_name in SimpleCookie(context.cookie or "")
+        ):
+            response.headers.append(self.cookie_header(self.legacy_name, value, ""))
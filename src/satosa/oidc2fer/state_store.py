@@ -0,0 +1,123 @@
+"""
+Stores of the state of the logins, for the state cookie to only hold its ID,
+see oidc2fer.state_cookie. The states expire after `ttl` seconds without a
+hop, the time a user may take to log in at their IdP.
+
+    STATE_COOKIE:
+      store: sqlite
+      path: /dev/shm/oidc2fer-state.sqlite
+      ttl: 900
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from oidc2fer import workers
+from oidc2fer.cache import TTLCache
+
+DEFAULT_TTL = 900
+
+
+class MemoryStateStore:
+    """
+    Keeps the states in the process, up to `max_size` of them. The hops of a
+    login must then reach the same process: a single worker, or sticky
+    sessions, gunicorn refusing to start several workers.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=10000, clock=time.time):
+        workers.single_worker(
+            "the memory state store keeps the states in each worker, use the sqlite one"
+        )
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = TTLCache(max_size, clock)
+
+    def get(self, state_id):
+        return self.cache.get(state_id)
+
+    def set(self, state_id, data):
+        self.cache.set(state_id, data, self.clock() + self.ttl)
+
+    def delete(self, state_id):
+        self.cache.delete(state_id)
+
+
+class SQLiteStateStore:
+    """
+    Keeps the states in the SQLite database at `path`, in WAL mode so that the
+    gunicorn workers of a node read it while one of them writes. On /dev/shm,
+    it lives in shared memory. The expired states are deleted every
+    `cleanup_interval` seconds.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, cleanup_interval=60, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.clock = clock
+        self._next_cleanup = 0
+        self._local = threading.local()
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS states"
+                " (id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        # Losing the last states on a power failure is fine, not fsyncing them
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @property
+    def connection(self):
+        """
+        The connection of the current thread, never one inherited from the
+        gunicorn master.
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = self.connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, state_id):
+        row = self.connection.execute(
+            "SELECT data FROM states WHERE id = ? AND expires_at > ?",
+            (state_id, self.clock()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, state_id, data):
+        now = self.clock()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO states VALUES (?, ?, ?)",
+            (state_id, data, now + self.ttl),
+        )
+        if now >= self._next_cleanup:
+            self._next_cleanup = now + self.cleanup_interval
+            self.connection.execute("DELETE FROM states WHERE expires_at <= ?", (now,))
+
+    def delete(self, state_id):
+        self.connection.execute("DELETE FROM states WHERE id = ?", (state_id,))
+
+
+def create_store(config):
+    """
+    Returns the store of the STATE_COOKIE `config`, or None if the state is
+    kept in the cookie.
+    """
+    store = config.get("store")
+    ttl = config.get("ttl", DEFAULT_TTL)
+    if store is None:
+        return None
+    if store == "memory":
+        return MemoryStateStore(ttl, config.get("max_size", 10000))
+    if store == "sqlite":
+        return SQLiteStateStore(config["path"], ttl)
+    raise ValueError(f"Unknown state store {store}")
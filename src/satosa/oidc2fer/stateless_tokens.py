@@ -0,0 +1,194 @@
+"""
+The stateless storage of the authorization codes, access tokens and refresh
+tokens of the OIDC frontend, in place of pyop's.
+
+pyop's stateless storage serializes the payload of a token as JSON, encrypts
+it with AES-CBC, without authenticating it, and decrypts it again on each
+lookup, several times per request. Here the JSON is deflated with a preset
+dictionary of the usual payloads, then encrypted and authenticated with
+AES-GCM, with a cipher prepared once per key. The tokens are prefixed with the
+ID of their key, for the keys to rotate, and each thread keeps the payload it
+decrypted last.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from pyop.storage import StatelessWrapper
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+NONCE_SIZE = 12
+# A 2 KiB window fits the payloads and the dictionary, and is much cheaper to
+# set up than the default 32 KiB one
+WBITS = -11
+# The usual payloads, for deflate to refer to. Never change it without
+# changing FORMAT: the tokens in flight are deflated with it.
+ZDICT = json.dumps(
+    {
+        "used": False,
+        "iat": 0,
+        "exp": 0,
+        "sub": "",
+        "client_id": "",
+        "aud": [""],
+        "scope": "openid email given_name usual_name uid siret",
+        "granted_scope": "openid email given_name usual_name uid siret",
+        "token_type": "Bearer",
+        "auth_req": {
+            "client_id": "",
+            "redirect_uri": "https://",
+            "response_type": "code",
+            "scope": "openid email given_name usual_name uid siret",
+            "state": "",
+            "nonce": "",
+            "claims": "",
+            "acr_values": "eidas1",
+            "prompt": "login consent",
+        },
+        "user_info": {
+            "given_name": "",
+            "email": "",
+            "usual_name": "",
+            "uid": "",
+            "acr": "eidas1",
+            "siret": "",
+        },
+        "extra_id_token_claims": {},
+        "access_token": "",
+    },
+    separators=(",", ":"),
+).encode()
+COLLECTIONS = {
+    "authorization_codes": "authz_codes",
+    "access_tokens": "access_tokens",
+    "refresh_tokens": "refresh_tokens",
+}
+
+
+def serialize_payload(payload):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, WBITS, zdict=ZDICT)
+    data = json.dumps(payload, separators=(",", ":")).encode()
+    return bytes([FORMAT]) + compressor.compress(data) + compressor.flush()
+
+
+def deserialize_payload(data):
+    if data[:1] != bytes([FORMAT]):
+        raise ValueError(f"Unknown token format {data[:1]!r}")
+    decompressor = zlib.decompressobj(WBITS, zdict=ZDICT)
+    try:
+        return json.loads(decompressor.decompress(data[1:]) + decompressor.flush())
+    except zlib.error as e:
+        raise ValueError(str(e)) from e
+
+
+def derive_key(secret):
+    # Not the key of pyop's AES-CBC encryption of the same db_uri secret
+    return hashlib.sha256(b"oidc2fer tokens\0" + secret.encode()).digest()
+
+
+class TokenCodec:
+    """
+    Encrypts the payloads of the tokens with the first of `keys`, a list of
+    (key ID, secret) pairs, and decrypts them with any of them: a new key is
+    added first, and the previous one kept until its tokens expire.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("No token key")
+        for kid, secret in keys:
+            if not kid or "." in kid:
+                raise ValueError(f"Invalid token key ID {kid!r}")
+            if not secret:
+                raise ValueError(f"The token key {kid} is empty")
+        self.kid = keys[0][0]
+        self.ciphers = {kid: AESGCM(derive_key(secret)) for kid, secret in keys}
+
+    def encode(self, payload, collection):
+        """
+        Returns the token of the dict `payload`, bound to `collection`.
+        """
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = self.ciphers[self.kid].encrypt(
+            nonce, serialize_payload(payload), f"{self.kid}.{collection}".encode()
+        )
+        value = base64.urlsafe_b64encode(nonce + ciphertext).rstrip(b"=").decode()
+        return f"{self.kid}.{value}"
+
+    def decode(self, token, collection):
+        """
+        Returns the payload of `token`, or raises ValueError if it wasn't
+        encoded for `collection` with one of the keys.
+        """
+        kid, _, encoded = token.partition(".")
+        cipher = self.ciphers.get(kid)
+        if cipher is None:
+            raise ValueError(f"Unknown token key {kid}")
+        data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        try:
+            payload = cipher.decrypt(
+                data[:NONCE_SIZE], data[NONCE_SIZE:], f"{kid}.{collection}".encode()
+            )
+        except InvalidTag as e:
+            raise ValueError("The token can't be authenticated") from e
+        return deserialize_payload(payload)
+
+
+def load_token_keys(entries):
+    """
+    Returns the codec of the `token_keys` config, a list of keys with their
+    `kid` and their `key`, the secret they are derived from.
+    """
+    return TokenCodec([(str(entry["kid"]), entry["key"]) for entry in entries])
+
+
+class StatelessTokenDB(StatelessWrapper):
+    """
+    The tokens of `collection`, as a StatelessWrapper for pyop's
+    AuthorizationState to pack the payloads into them. The unauthenticated
+    tokens of pyop's stateless storage are not read: they can be forged.
+    """
+
+    # pylint: disable-next=super-init-not-called
+    def __init__(self, collection, codec):
+        self.collection = collection
+        self.codec = codec
+        self._last = threading.local()
+
+    def pack(self, value):
+        return self.codec.encode(value, self.collection) if value else None
+
+    def _unpack(self, value):
+        if not value:
+            return None
+        last = self._last
+        if getattr(last, "token", None) != value:
+            try:
+                last.payload = self.codec.decode(value, self.collection)
+            except ValueError as e:
+                logger.warning("Invalid token for %s: %s", self.collection, e)
+                return None
+            last.token = value
+        # pyop marks the codes as used in the payload it looked up
+        return dict(last.payload)
+
+
+def install(authz_state, codec):
+    """
+    Makes pyop's `authz_state` keep its codes and tokens in the stateless
+    tokens of `codec`. Those issued before are no longer accepted, they
+    expire within a minute anyway.
+    """
+    for attribute, collection in COLLECTIONS.items():
+        setattr(authz_state, attribute, StatelessTokenDB(collection, codec))
+    authz_state.stateless = True
+    authz_state.subject_identifiers = {}
@@ -0,0 +1,108 @@
+"""
+Builds the static files served by oidc2fer.wsgi: each file is copied along
+with a fingerprinted copy, named after the hash of its content, which can be
+cached forever. References to fingerprinted files in the HTML files are
+rewritten, and the mapping from original to fingerprinted names is saved in a
+manifest. Every file is then compressed with gzip and brotli, so that
+WhiteNoise serves the compressed variants without compressing them again.
+
+The original names are kept, as some of them are referenced from outside,
+like the logo in the federation metadata.
+
+    python -m oidc2fer.static_assets static staticfiles
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from whitenoise.compress import Compressor
+
+MANIFEST_NAME = "staticfiles.json"
+
+# Matches the names of fingerprinted files, like images/logo.0123456789ab.svg
+FINGERPRINTED_RE = re.compile(r"\.[0-9a-f]{12}\.[^./]+$")
+
+# Matches the URLs of the src and href attributes of HTML files
+REFERENCE_RE = re.compile(r'(?P<attribute>(?:src|href)=")(?P<url>[^"]+)(?=")')
+
+
+def is_fingerprinted(path, url=None):  # pylint: disable=unused-argument
+    """
+    Tells WhiteNoise which files can be cached forever.
+    """
+    return FINGERPRINTED_RE.search(path) is not None
+
+
+def fingerprinted_name(name, content):
+    root, extension = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+
+def rewrite_references(html, manifest):
+    def replace(match):
+        url = match["url"]
+        name = manifest.get(url.lstrip("/"))
+        if name is None:
+            return match[0]
+        return match["attribute"] + ("/" if url.startswith("/") else "") + name
+
+    return REFERENCE_RE.sub(replace, html)
+
+
+def build_static(source, target):
+    """
+    Replaces `target` with the static files of `source`, their fingerprinted
+    copies and their compressed variants, and returns the manifest.
+    """
+    names = sorted(
+        os.path.relpath(os.path.join(directory, filename), source)
+        for directory, _, filenames in os.walk(source)
+        for filename in filenames
+    )
+    shutil.rmtree(target, ignore_errors=True)
+    manifest = {}
+    # HTML files are entry points, always requested by their original name
+    html_names = [name for name in names if name.endswith(".html")]
+    for name in names:
+        os.makedirs(os.path.dirname(os.path.join(target, name)), exist_ok=True)
+        shutil.copy2(os.path.join(source, name), os.path.join(target, name))
+        if name not in html_names:
+            with open(os.path.join(source, name), "rb") as f:
+                content = f.read()
+            manifest[name] = fingerprinted_name(name, content)
+            shutil.copy2(
+                os.path.join(source, name), os.path.join(target, manifest[name])
+            )
+    for name in html_names:
+        path = os.path.join(target, name)
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(rewrite_references(html, manifest))
+    with open(os.path.join(target, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    compressor = Compressor(quiet=True)
+    for directory, _, filenames in os.walk(target):
+        for filename in filenames:
+            if compressor.should_compress(filename):
+                compressor.compress(os.path.join(directory, filename))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds the static files served by the gateway."
+    )
+    parser.add_argument("source", help="Directory of the static files")
+    parser.add_argument("target", help="Directory to write the built files to")
+    args = parser.parse_args()
+    build_static(args.source, args.target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Gunicorn preloads the app in its master process, before forking the workers:
+the parsed configuration, keys, client db and metadata are then built once,
+and shared by the workers until they modify them.
+
+Resources that can't be shared between processes, like threads, are created
+in each worker by the callbacks given to `in_each_worker`, which the gunicorn
+config starts after forking each worker. State kept in a process, which the
+other workers can't see, is declared with `single_worker`, and the gunicorn
+config then refuses to start several workers.
+"""
+
+import threading
+
+_callbacks = []
+_started = threading.Event()
+_single_worker_reasons = set()
+
+
+def in_each_worker(callback):
+    """
+    Calls `callback` in each worker, once it is forked, or now if this process
+    is already a worker (when the app is not preloaded).
+    """
+    _callbacks.append(callback)
+    if _started.is_set():
+        callback()
+
+
+def start():
+    """
+    Runs the callbacks in a new worker, called by the gunicorn post_fork hook.
+    """
+    _started.set()
+    for callback in _callbacks:
+        callback()
+
+
+def single_worker(reason):
+    """
+    Declares that the app must run in a single worker, because of `reason`,
+    like a state kept in the process.
+    """
+    _single_worker_reasons.add(reason)
+
+
+def check(num_workers):
+    """
+    Raises RuntimeError if the app must run in a single worker and gunicorn
+    is about to start `num_workers`, called by the gunicorn on_starting hook
+    once the app is preloaded.
+    """
+    if num_workers > 1 and _single_worker_reasons:
+        raise RuntimeError(
+            f"Can't run {num_workers} workers: "
+            + ", ".join(sorted(_single_worker_reasons))
+        )
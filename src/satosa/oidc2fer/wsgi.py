@@ -1,9 +1,8 @@
 import os
 
-from satosa.wsgi import app as satosa_app
-from whitenoise import WhiteNoise
+from satosa.satosa_config import SATOSAConfig
 
-# Wrap the SATOSA WSGI app in WhiteNoise to serve static files
-app = WhiteNoise(
-    satosa_app, root=os.path.join(os.curdir, "static"), index_file="index.html"
-)
+from oidc2fer.app import create_app
+
+satosa_config = SATOSAConfig(os.environ.get("SATOSA_CONFIG", "proxy_conf.yaml"))
+app = create_app(satosa_config)
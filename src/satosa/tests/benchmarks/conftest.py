@@ -0,0 +1,232 @@
+"""
+Builds the gateway in-process from proxy_conf.yaml, with local stand-ins for
+everything it normally reaches over the network: generated keys, a stub SAML
+IdP signing its assertions, a stub discovery service and a local client db.
+"""
+
+import contextlib
+import json
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import pytest
+from saml2.metadata import create_metadata_string
+from satosa.satosa_config import SATOSAConfig
+from stub_idp import StubIdP, create_key_pair
+from werkzeug.test import Client
+
+from oidc2fer.app import create_app, get_satosa
+from oidc2fer.metadata_cache import build_metadata_cache
+
+SATOSA_DIR = Path(__file__).resolve().parents[2]
+
+BASE_URL = "https://oidc2fer.example.com"
+SP_ENTITY_ID = f"{BASE_URL}/Saml2/proxy_saml2_backend.xml"
+DISCOVERY_URL = "https://discovery.example.fr/"
+IDP_ENTITY_ID = "https://idp.example.fr/idp/shibboleth"
+OTHER_IDP_ENTITY_ID = "https://idp.autre-exemple.fr/idp/shibboleth"
+CLIENT_ID = "oidc-test-client"
+CLIENT_SECRET = "oidc-test-secret"
+REDIRECT_URI = "https://oidc-test-client.example.com/redirect_uri"
+SIRET = "12345678200010"
+METRICS_TOKEN = "metrics-token"
+
+
+class LoginFlow:
+    """
+    Drives one OIDC → SAML → OIDC login through the gateway, one hop at a
+    time. Each hop takes the output of the previous one.
+    """
+
+    STAGES = ["authorize", "discovery", "acs", "token", "userinfo"]
+
+    def __init__(self, app, idp):
+        self.client = Client(app)
+        self.idp = idp
+
+    def authorize(self, _=None):
+        query = urlencode(
+            {
+                "client_id": CLIENT_ID,
+                "redirect_uri": REDIRECT_URI,
+                "response_type": "code",
+                "scope": "openid email given_name usual_name uid siret",
+                "state": "state",
+                "nonce": "nonce",
+            }
+        )
+        response = self.client.get(f"{BASE_URL}/Saml2/OIDC/authorization?{query}")
+        assert response.status_code == 303, response.text
+        return response.location
+
+    def discovery(self, location):
+        # The user picks the IdP in the discovery service, which sends them back
+        return_url = parse_qs(urlparse(location).query)["return"][0]
+        query = urlencode({"entityID": IDP_ENTITY_ID})
+        response = self.client.get(f"{return_url}?{query}")
+        assert response.status_code == 303, response.text
+        return response.location
+
+    def acs(self, location):
+        acs_url, form = self.idp.login(location)
+        response = self.client.post(acs_url, data=form)
+        assert response.status_code == 303, response.text
+        return response.location
+
+    def token(self, location):
+        code = parse_qs(urlparse(location).query)["code"][0]
+        response = self.client.post(
+            f"{BASE_URL}/OIDC/token",
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": REDIRECT_URI,
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET,
+            },
+        )
+        assert response.status_code == 200, response.text
+        return response.json["access_token"]
+
+    def userinfo(self, access_token):
+        response = self.client.get(
+            f"{BASE_URL}/OIDC/userinfo",
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        assert response.status_code == 200, response.text
+        return response.text
+
+    def run_until(self, stage):
+        """
+        Runs all the hops before `stage`, and returns the input of `stage`.
+        """
+        result = None
+        for previous_stage in self.STAGES[: self.STAGES.index(stage)]:
+            result = getattr(self, previous_stage)(result)
+        return result
+
+
+@pytest.fixture(scope="session", name="stub_idp")
+def fixture_stub_idp(tmp_path_factory):
+    return StubIdP(tmp_path_factory.mktemp("idp"), IDP_ENTITY_ID)
+
+
+def write_client_db(directory):
+    client_db = directory / "client_db.json"
+    client_db.write_text(
+        json.dumps(
+            {
+                CLIENT_ID: {
+                    "response_types": ["code"],
+                    "redirect_uris": [REDIRECT_URI],
+                    "client_secret": CLIENT_SECRET,
+                    "token_endpoint_auth_method": "client_secret_post",
+                }
+            }
+        )
+    )
+    return str(client_db)
+
+
+def write_federation_metadata(directory, idps):
+    """
+    Writes the metadata of each IdP, and the cache of all of them as built
+    when gunicorn starts, and returns their paths.
+    """
+    paths = []
+    entities = []
+    for idp in idps:
+        path = directory / f"{urlparse(idp.config['entityid']).hostname}.xml"
+        path.write_text(idp.metadata)
+        paths.append(str(path))
+        build_metadata_cache(str(path), str(path.with_suffix(".json")))
+        entities.extend(json.loads(path.with_suffix(".json").read_text()))
+    cache_path = directory / "saml2_metadata.json"
+    cache_path.write_text(json.dumps(entities))
+    return paths, str(cache_path)
+
+
+def load_config(directory, idps):
+    """
+    Loads proxy_conf.yaml, replacing the files written by the entrypoint and
+    the remote federation metadata with local stand-ins in `directory`.
+    """
+    backend_key, backend_cert = create_key_pair(directory, "backend", "oidc2fer")
+    frontend_key, _ = create_key_pair(directory, "frontend", "oidc2fer")
+    federation, federation_cache = write_federation_metadata(directory, idps)
+
+    environ = {
+        "BASE_URL": BASE_URL,
+        "STATE_ENCRYPTION_KEY": os.urandom(32).hex(),
+        "SAML2_DISCOVERY_URL": DISCOVERY_URL,
+        "SAML2_METADATA_URL": Path(federation[0]).as_uri(),
+        "SAML2_ENTITY_ID": SP_ENTITY_ID,
+        "OIDC_DB_URI": "stateless://:STATE-ENCRYPTION-KEY@localhost",
+    }
+    with pytest.MonkeyPatch.context() as mp, contextlib.chdir(SATOSA_DIR):
+        for name, value in environ.items():
+            mp.setenv(name, value)
+        config = SATOSAConfig("proxy_conf.yaml")
+
+    (backend,) = config["BACKEND_MODULES"]
+    sp_config = backend["config"]["sp_config"]
+    sp_config["key_file"] = backend_key
+    sp_config["cert_file"] = backend_cert
+    sp_config["metadata"] = {"mdfile": [federation_cache]}
+    for frontend in config["FRONTEND_MODULES"]:
+        if frontend["name"] == "OIDC":
+            frontend["config"]["signing_key_path"] = frontend_key
+            frontend["config"]["client_db_path"] = write_client_db(directory)
+        elif frontend["name"] == "metrics":
+            frontend["config"] = {"bearer_token": METRICS_TOKEN}
+    for service in config["MICRO_SERVICES"]:
+        if service["name"] == "EntityIdToSiretMapper":
+            service["config"]["mapping_json"] = json.dumps({IDP_ENTITY_ID: SIRET})
+    return config
+
+
+@pytest.fixture(scope="session", name="gateway")
+def fixture_gateway(tmp_path_factory, stub_idp):
+    """
+    The gateway WSGI app, as built by oidc2fer.wsgi in production.
+    """
+    if shutil.which("xmlsec1") is None:
+        pytest.skip("Signing and verifying SAML messages needs xmlsec1")
+
+    directory = tmp_path_factory.mktemp("gateway")
+    # With a single IdP in the federation, the discovery service is skipped
+    other_idp = StubIdP(directory, OTHER_IDP_ENTITY_ID, "autre-exemple.fr")
+    config = load_config(directory, [stub_idp, other_idp])
+    with contextlib.chdir(SATOSA_DIR):
+        app = create_app(config)
+
+    saml2_backend = get_satosa(app).module_router.backends["Saml2"]["instance"]
+    stub_idp.trust(
+        create_metadata_string(None, config=saml2_backend.sp.config).decode()
+    )
+    return app
+
+
+@pytest.fixture(scope="session", name="config_path")
+def fixture_config_path(tmp_path_factory, stub_idp):
+    """
+    The path of the gateway config, for SATOSA_CONFIG in another process.
+    """
+    directory = tmp_path_factory.mktemp("config")
+    config = load_config(directory, [stub_idp])
+    path = directory / "proxy_conf.json"
+    # The plugin configs are loaded in the dict, which SATOSAConfig reads back
+    path.write_text(json.dumps(config._config))  # pylint: disable=protected-access
+    return str(path)
+
+
+@pytest.fixture(name="new_login_flow")
+def fixture_new_login_flow(gateway, stub_idp):
+    return lambda: LoginFlow(gateway, stub_idp)
+
+
+def pytest_generate_tests(metafunc):
+    if "stage" in metafunc.fixturenames:
+        metafunc.parametrize("stage", LoginFlow.STAGES)
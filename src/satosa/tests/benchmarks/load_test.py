@@ -0,0 +1,246 @@
+"""
+Drives complete OIDC → SAML → OIDC logins against a running gateway, without a
+browser, and reports the latency percentiles and the errors of each hop:
+
+    python tests/benchmarks/load_test.py --flows 5000 --concurrency 500 \
+        https://satosa.traefik.me
+
+The gateway must be configured with the stub federation of stub_idp.py, see
+`make load-test`. Each login runs in its own session, with its own
+connections, like a new user agent would.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+
+HOPS = ["authorize", "wayf", "discovery", "idp", "acs", "token", "userinfo"]
+
+
+class HopError(Exception):
+    pass
+
+
+class FormParser(HTMLParser):
+    """
+    Reads the action and the fields of the form the IdP posts to the ACS.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.fields = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.action = attrs.get("action")
+        elif tag == "input" and attrs.get("name"):
+            self.fields[attrs["name"]] = attrs.get("value", "")
+
+
+def expect(response, status_code):
+    if response.status_code != status_code:
+        raise HopError(f"HTTP {response.status_code}")
+    return response
+
+
+class Login:
+    """
+    One login, each hop taking the output of the previous one.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.session = requests.Session()
+        self.timeout = options.timeout
+
+    def get(self, url, **kwargs):
+        return self.session.get(
+            url, allow_redirects=False, timeout=self.timeout, **kwargs
+        )
+
+    def authorize(self, _):
+        query = urlencode(
+            {
+                "client_id": self.options.client_id,
+                "redirect_uri": self.options.redirect_uri,
+                "response_type": "code",
+                "scope": self.options.scope,
+                "state": "state",
+                "nonce": "nonce",
+            }
+        )
+        url = f"{self.options.base_url}/Saml2/OIDC/authorization?{query}"
+        return expect(self.get(url), 303).headers["Location"]
+
+    def wayf(self, location):
+        return expect(self.get(location), 302).headers["Location"]
+
+    def discovery(self, location):
+        return expect(self.get(location), 303).headers["Location"]
+
+    def idp(self, location):
+        form = FormParser()
+        form.feed(expect(self.get(location), 200).text)
+        if not form.action:
+            raise HopError("No form")
+        return form.action, form.fields
+
+    def acs(self, form):
+        action, fields = form
+        response = self.session.post(
+            action, data=fields, allow_redirects=False, timeout=self.timeout
+        )
+        return expect(response, 303).headers["Location"]
+
+    def token(self, location):
+        code = parse_qs(urlparse(location).query)["code"][0]
+        response = self.session.post(
+            f"{self.options.base_url}/OIDC/token",
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": self.options.redirect_uri,
+                "client_id": self.options.client_id,
+                "client_secret": self.options.client_secret,
+            },
+            timeout=self.timeout,
+        )
+        return expect(response, 200).json()["access_token"]
+
+    def userinfo(self, access_token):
+        response = self.get(
+            f"{self.options.base_url}/OIDC/userinfo",
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        return expect(response, 200).text
+
+
+class Results:
+    """
+    The durations and the errors of each hop, shared by the threads.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record(self, hop, duration):
+        with self._lock:
+            self.durations[hop].append(duration)
+
+    def error(self, hop, error):
+        with self._lock:
+            name = str(error) if isinstance(error, HopError) else type(error).__name__
+            self.errors[hop][name] += 1
+
+    def summary(self):
+        return {
+            hop: {
+                "count": len(self.durations[hop]),
+                "errors": dict(self.errors[hop]),
+                **percentiles(self.durations[hop]),
+            }
+            for hop in HOPS
+        }
+
+
+def percentiles(durations):
+    """
+    Returns the p50, p95 and p99 of `durations`, in milliseconds.
+    """
+    if len(durations) < 2:
+        values = [durations[0] if durations else float("nan")] * 3
+    else:
+        quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+        values = [quantiles[49], quantiles[94], quantiles[98]]
+    return {
+        name: round(value * 1000, 1)
+        for name, value in zip(("p50", "p95", "p99"), values, strict=True)
+    }
+
+
+def run_login(options, results):
+    login = Login(options)
+    result = None
+    with login.session:
+        for hop in HOPS:
+            started_at = time.perf_counter()
+            try:
+                result = getattr(login, hop)(result)
+            except (requests.RequestException, HopError, KeyError, ValueError) as e:
+                results.error(hop, e)
+                return False
+            results.record(hop, time.perf_counter() - started_at)
+    return True
+
+
+def report(summary, flows, duration, out):
+    succeeded = summary[HOPS[-1]]["count"]
+    out.write(
+        f"{succeeded}/{flows} logins in {duration:.1f}s "
+        f"({succeeded / duration:.1f} logins/s)\n\n"
+    )
+    out.write(
+        f"{'hop':<10}{'count':>8}{'errors':>8}{'p50':>11}{'p95':>11}{'p99':>11}\n"
+    )
+    for hop, stats in summary.items():
+        out.write(
+            f"{hop:<10}{stats['count']:>8}{sum(stats['errors'].values()):>8}"
+            f"{stats['p50']:>9}ms{stats['p95']:>9}ms{stats['p99']:>9}ms\n"
+        )
+    for hop, stats in summary.items():
+        for error, count in stats["errors"].items():
+            out.write(f"{hop}: {count} × {error}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("base_url", help="the BASE_URL of the gateway")
+    parser.add_argument("--flows", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--client-id", default="oidc-test-client")
+    parser.add_argument("--client-secret", default="oidc-test-secret")
+    parser.add_argument(
+        "--redirect-uri", default="https://oidc-test-client.traefik.me/redirect_uri"
+    )
+    parser.add_argument(
+        "--scope", default="openid email given_name usual_name uid siret"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args(argv)
+    options.base_url = options.base_url.rstrip("/")
+
+    results = Results()
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        for _ in range(options.flows):
+            executor.submit(run_login, options, results)
+    duration = time.perf_counter() - started_at
+
+    summary = results.summary()
+    report(summary, options.flows, duration, sys.stdout)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {"flows": options.flows, "duration": duration, "hops": summary},
+                f,
+                indent=2,
+            )
+    return 0 if summary[HOPS[-1]]["count"] == options.flows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
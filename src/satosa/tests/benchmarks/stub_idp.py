@@ -0,0 +1,252 @@
+"""
+Stub SAML IdPs standing in for the RENATER federation: in-process for the
+benchmarks (see conftest.py), and as a WSGI app for the load tests against a
+running stack (see load_test.py), which serves their metadata, their SSO
+endpoints and a discovery service (WAYF):
+
+    STUB_BASE_URL=http://stub-idp:8000 \
+    SP_METADATA_URL=http://app-dev:8000/Saml2/proxy_saml2_backend.xml \
+    gunicorn --chdir tests/benchmarks --preload "stub_idp:make_app()"
+
+The app is preloaded for all the workers to sign with the same keys.
+"""
+
+import base64
+import datetime
+import html
+import itertools
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.config import IdPConfig
+from saml2.metadata import create_metadata_string
+from saml2.saml import NAME_FORMAT_URI, NAMEID_FORMAT_TRANSIENT
+from saml2.server import Server
+
+USER_IDENTITY = {
+    "eduPersonPrincipalName": ["enseignant1@example.fr"],
+    "eduPersonAffiliation": ["member", "employee"],
+    "mail": ["georges.grospieds@example.fr"],
+    "givenName": ["Georges"],
+    "sn": ["Grospieds"],
+}
+
+AUTO_POST_FORM = """<!DOCTYPE html>
+<html>
+<body onload="document.forms[0].submit()">
+<form method="post" action="{action}">
+{inputs}
+</form>
+</body>
+</html>
+"""
+
+
+def create_key_pair(directory, name, common_name):
+    """
+    Writes a private key and a matching self-signed certificate to
+    `<directory>/<name>.key` and `<directory>/<name>.crt`.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.UTC)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .sign(key, hashes.SHA256())
+    )
+    key_path = directory / f"{name}.key"
+    cert_path = directory / f"{name}.crt"
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        )
+    )
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    return str(key_path), str(cert_path)
+
+
+class StubIdP:
+    """
+    A SAML IdP answering any AuthnRequest with a signed response for
+    USER_IDENTITY, like the RENATER test IdP does after a successful login.
+    """
+
+    def __init__(self, directory, entity_id, scope="example.fr", sso_url=None):
+        parsed = urlparse(entity_id)
+        host = parsed.hostname
+        name = re.sub(r"\W", "_", f"{host}{parsed.path}")
+        key_file, cert_file = create_key_pair(directory, name, host)
+        self.config = {
+            "entityid": entity_id,
+            "key_file": key_file,
+            "cert_file": cert_file,
+            "service": {
+                "idp": {
+                    "endpoints": {
+                        "single_sign_on_service": [
+                            (
+                                sso_url
+                                or f"https://{host}/idp/profile/SAML2/Redirect/SSO",
+                                BINDING_HTTP_REDIRECT,
+                            )
+                        ],
+                    },
+                    "scope": [scope],
+                    "name_id_format": [NAMEID_FORMAT_TRANSIENT],
+                    "policy": {
+                        "default": {
+                            "lifetime": {"minutes": 15},
+                            "name_form": NAME_FORMAT_URI,
+                        },
+                    },
+                },
+            },
+        }
+        self.metadata = create_metadata_string(
+            None, config=IdPConfig().load(self.config)
+        ).decode()
+        self.server = None
+
+    def trust(self, sp_metadata):
+        config = {**self.config, "metadata": {"inline": [sp_metadata]}}
+        self.server = Server(config=IdPConfig().load(config))
+
+    def respond(self, query):
+        """
+        Returns the ACS URL and the form the user agent would post to it, for
+        the SAMLRequest and RelayState of `query`.
+        """
+        request = self.server.parse_authn_request(
+            query["SAMLRequest"], BINDING_HTTP_REDIRECT
+        )
+        response_args = self.server.response_args(request.message)
+        response = self.server.create_authn_response(
+            USER_IDENTITY,
+            userid=USER_IDENTITY["eduPersonPrincipalName"][0],
+            authn={"class_ref": "urn:oasis:names:tc:SAML:2.0:ac:classes:Password"},
+            sign_response=True,
+            sign_assertion=True,
+            **response_args,
+        )
+        form = {
+            "SAMLResponse": base64.b64encode(str(response).encode()).decode(),
+            "RelayState": query["RelayState"],
+        }
+        return response_args["destination"], form
+
+    def login(self, location):
+        """
+        Handles the redirection of the user agent to the IdP, and returns the
+        ACS URL and the form the user agent would post to it.
+        """
+        return self.respond(dict(parse_qsl(urlparse(location).query)))
+
+
+class StubFederation:
+    """
+    The WSGI app of `idp_count` stub IdPs under `base_url`, with their
+    metadata at /metadata, their SSO endpoints at /idp/<n>/sso and a WAYF at
+    /wayf picking them in turn. The IdPs trust the SP whose metadata is at
+    `sp_metadata_url`, fetched on the first login since the gateway itself
+    needs the federation metadata to start.
+    """
+
+    def __init__(self, base_url, sp_metadata_url, idp_count=2):
+        directory = Path(tempfile.mkdtemp(prefix="stub-idp-"))
+        self.idps = {
+            f"/idp/{n}/sso": StubIdP(
+                directory, f"{base_url}/idp/{n}", sso_url=f"{base_url}/idp/{n}/sso"
+            )
+            for n in range(1, idp_count + 1)
+        }
+        self.sp_metadata_url = sp_metadata_url
+        self.metadata = "".join(
+            [
+                '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">',
+                *(
+                    re.sub(r"^<\?xml[^>]*\?>", "", idp.metadata)
+                    for idp in self.idps.values()
+                ),
+                "</md:EntitiesDescriptor>",
+            ]
+        ).encode()
+        self._entity_ids = itertools.cycle(
+            [idp.config["entityid"] for idp in self.idps.values()]
+        )
+        self._lock = threading.Lock()
+        self._trusted = False
+
+    def trust_sp(self):
+        with self._lock:
+            if not self._trusted:
+                response = requests.get(self.sp_metadata_url, timeout=10)
+                response.raise_for_status()
+                for idp in self.idps.values():
+                    idp.trust(response.text)
+                self._trusted = True
+
+    def wayf(self, query):
+        """
+        Sends the user agent back to the SP, like the discovery service does
+        once the user picked their IdP.
+        """
+        with self._lock:
+            entity_id = next(self._entity_ids)
+        return_url = query["return"]
+        separator = "&" if "?" in return_url else "?"
+        param = urlencode({query.get("returnIDParam", "entityID"): entity_id})
+        return "302 Found", [("Location", f"{return_url}{separator}{param}")], b""
+
+    def sso(self, idp, query):
+        self.trust_sp()
+        action, form = idp.respond(query)
+        inputs = "\n".join(
+            f'<input type="hidden" name="{name}" value="{html.escape(value)}"/>'
+            for name, value in form.items()
+        )
+        body = AUTO_POST_FORM.format(action=html.escape(action), inputs=inputs)
+        return "200 OK", [("Content-Type", "text/html; charset=utf-8")], body.encode()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        query = dict(parse_qsl(environ.get("QUERY_STRING", "")))
+        if path == "/metadata":
+            status, headers, body = (
+                "200 OK",
+                [("Content-Type", "application/samlmetadata+xml")],
+                self.metadata,
+            )
+        elif path == "/wayf":
+            status, headers, body = self.wayf(query)
+        elif path in self.idps:
+            status, headers, body = self.sso(self.idps[path], query)
+        else:
+            status, headers, body = "404 Not Found", [], b""
+        start_response(status, [*headers, ("Content-Length", str(len(body)))])
+        return [body]
+
+
+def make_app():
+    return StubFederation(
+        os.environ.get("STUB_BASE_URL", "http://stub-idp:8000"),
+        os.environ["SP_METADATA_URL"],
+        int(os.environ.get("STUB_IDP_COUNT", "2")),
+    )
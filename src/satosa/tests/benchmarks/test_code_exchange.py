@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+from conftest import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI
+from oic.oic.message import AuthorizationRequest
+from satosa.context import Context
+
+from oidc2fer.app import get_satosa
+
+BENCH_ROUNDS = int(os.environ.get("BENCH_ROUNDS", "200"))
+
+
+@pytest.fixture(name="oidc_frontend")
+def fixture_oidc_frontend(gateway):
+    return get_satosa(gateway).module_router.frontends["OIDC"]["instance"]
+
+
+def create_code(frontend):
+    """
+    Returns a code, as issued by the authentication response of a login.
+    """
+    auth_req = AuthorizationRequest(
+        client_id=CLIENT_ID,
+        redirect_uri=REDIRECT_URI,
+        response_type="code",
+        scope=["openid", "email", "uid"],
+        nonce="nonce",
+    )
+    authz_state = frontend.provider.authz_state
+    sub = authz_state.get_subject_identifier("public", "enseignant1@example.fr")
+    return authz_state.create_authorization_code(
+        auth_req,
+        sub,
+        user_info={"email": "georges.grospieds@example.fr", "uid": sub},
+    )
+
+
+def token_context(code):
+    context = Context()
+    context.request_authorization = ""
+    context.request = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": REDIRECT_URI,
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+    }
+    return context
+
+
+def test_code_exchange(oidc_frontend):
+    response = oidc_frontend.token_endpoint(token_context(create_code(oidc_frontend)))
+    assert response.status == "200 OK"
+    assert "access_token" in json.loads(response.message)
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+@pytest.mark.parametrize("clients", ["registry", "dict"])
+def test_benchmark_code_exchange(benchmark, monkeypatch, oidc_frontend, clients):
+    """
+    Measures the token endpoint exchanging a fresh code, with the clients in
+    the registry of oidc2fer.client_registry, or in the plain dict pyop used
+    to look them up in. The throughput is the ops of the results.
+    """
+    if clients == "dict":
+        with open(oidc_frontend.client_db_path, encoding="utf-8") as f:
+            monkeypatch.setattr(oidc_frontend.provider, "clients", json.load(f))
+
+    def setup():
+        return (token_context(create_code(oidc_frontend)),), {}
+
+    benchmark.group = "code exchange"
+    benchmark.extra_info["clients"] = clients
+    response = benchmark.pedantic(
+        oidc_frontend.token_endpoint, setup=setup, rounds=BENCH_ROUNDS
+    )
+    assert response.status == "200 OK"
@@ -0,0 +1,376 @@
+"""
+Load tests of the gateway under gunicorn, run with the config of the image
+(docker/files/usr/local/etc/gunicorn/satosa.py), with the port and number of
+workers overridden by GUNICORN_CMD_ARGS like in the deployments:
+- checking the hooks of the config: gunicorn refuses to start several workers
+  with the memory state store, the metrics directory is cleared at startup,
+  each worker starts its threads after the fork and logs through its own
+  QueueStreamHandler thread, and the live gauges of a dead worker are removed
+  from the metrics
+- measuring the throughput of the gthread workers while slow clients upload
+  SAML responses to the ACS, holding some of their threads
+- comparing the startup and memory of the workers with and without preloading
+  the app in the master
+
+Run with `BENCH=1 pytest tests/benchmarks/test_gunicorn.py` to print the
+throughput, latency, startup time and memory of each mode.
+"""
+
+import contextlib
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from conftest import METRICS_TOKEN
+
+SATOSA_DIR = Path(__file__).resolve().parents[2]
+GUNICORN_CONFIG = (
+    SATOSA_DIR.parents[1] / "docker/files/usr/local/etc/gunicorn/satosa.py"
+)
+
+WORKERS = 2
+SLOW_CLIENTS = 2
+FAST_CLIENTS = 8
+DURATION = float(os.environ.get("BENCH_DURATION", "5"))
+
+pytestmark = pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def run_gunicorn(
+    config_path, directory, gunicorn_config=GUNICORN_CONFIG, log_path=os.devnull
+):
+    """
+    Runs gunicorn with `gunicorn_config`, sharing the metrics of its workers
+    in `directory`/prometheus and writing its logs to `log_path`.
+    """
+    port = free_port()
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, "-m", "gunicorn", "-c", str(gunicorn_config)],
+            cwd=SATOSA_DIR,
+            env={
+                **os.environ,
+                "SATOSA_CONFIG": config_path,
+                "PROMETHEUS_MULTIPROC_DIR": str(directory / "prometheus"),
+                "GUNICORN_CMD_ARGS": f"--bind=127.0.0.1:{port} --workers={WORKERS}",
+            },
+            stdout=log,
+            stderr=subprocess.DEVNULL,
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(300):
+            with contextlib.suppress(OSError):
+                urllib.request.urlopen(f"{base_url}/ping", timeout=1).close()
+                break
+            time.sleep(0.1)
+        yield process, port, base_url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def worker_pids(pid):
+    """
+    Returns the pids of the workers of the gunicorn master `pid`.
+    """
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def workers_rss(pid):
+    """
+    Returns the resident memory of the workers of the gunicorn master `pid`,
+    in MiB.
+    """
+    rss_kib = 0
+    for child in worker_pids(pid):
+        with open(f"/proc/{child}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kib += int(line.split()[1])
+    return rss_kib / 1024
+
+
+def workers_memory(pid):
+    """
+    Returns the proportional set size of each worker of the gunicorn master
+    `pid`, which splits the pages shared between processes among them, and
+    their private memory, in MiB.
+    """
+    children = worker_pids(pid)
+    pss_kib = private_kib = 0
+    for child in children:
+        with open(f"/proc/{child}/smaps_rollup", encoding="utf-8") as f:
+            for line in f:
+                field, value = line.split()[:2]
+                if field == "Pss:":
+                    pss_kib += int(value)
+                elif field in ("Private_Clean:", "Private_Dirty:"):
+                    private_kib += int(value)
+    return {
+        "pss_mib_per_worker": pss_kib / 1024 / len(children),
+        "private_mib_per_worker": private_kib / 1024 / len(children),
+    }
+
+
+def cpu_seconds(pid):
+    """
+    Returns the CPU time used by the gunicorn master `pid` and its workers.
+    """
+    ticks = 0
+    for process_pid in [pid, *worker_pids(pid)]:
+        with open(f"/proc/{process_pid}/stat", encoding="utf-8") as f:
+            # The command name, in parentheses, may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def read_logs(log_path):
+    with open(log_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.startswith("{")]
+
+
+def upload_slowly(port, stop):
+    """
+    Posts a SAML response to the ACS a few bytes at a time, like a client on
+    a bad connection, until `stop` is set.
+    """
+    body_length = 100_000
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(
+            b"POST /Saml2/acs/post HTTP/1.1\r\n"
+            b"Host: 127.0.0.1\r\n"
+            b"Content-Type: application/x-www-form-urlencoded\r\n"
+            + f"Content-Length: {body_length}\r\n\r\n".encode()
+            + b"SAMLResponse="
+        )
+        while not stop.wait(0.1):
+            sock.sendall(b"A" * 10)
+
+
+def request_repeatedly(base_url, deadline):
+    latencies = []
+    errors = 0
+    while time.monotonic() < deadline:
+        started_at = time.perf_counter()
+        try:
+            with urllib.request.urlopen(
+                f"{base_url}/.well-known/openid-configuration", timeout=DURATION
+            ) as response:
+                response.read()
+            latencies.append(time.perf_counter() - started_at)
+        except OSError:
+            errors += 1
+    return latencies, errors
+
+
+def scrape(base_url):
+    request = urllib.request.Request(
+        f"{base_url}/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"}
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.read().decode()
+
+
+def run_load(config_path, directory):
+    with run_gunicorn(config_path, directory) as (process, port, base_url):
+        # Warm up every worker, so that their memory can be compared
+        with ThreadPoolExecutor(FAST_CLIENTS) as executor:
+            warm_up_deadline = time.monotonic() + 1
+            list(
+                executor.map(
+                    lambda _: request_repeatedly(base_url, warm_up_deadline),
+                    range(FAST_CLIENTS),
+                )
+            )
+        stop = threading.Event()
+        with ThreadPoolExecutor(SLOW_CLIENTS + FAST_CLIENTS) as executor:
+            for _ in range(SLOW_CLIENTS):
+                executor.submit(upload_slowly, port, stop)
+            # Let the slow clients take their threads first
+            time.sleep(0.5)
+            deadline = time.monotonic() + DURATION
+            results = list(
+                executor.map(
+                    lambda _: request_repeatedly(base_url, deadline),
+                    range(FAST_CLIENTS),
+                )
+            )
+            rss = workers_rss(process.pid)
+            stop.set()
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        "throughput": len(latencies) / DURATION,
+        "p50_ms": 1000 * statistics.median(latencies) if latencies else None,
+        "p95_ms": 1000 * latencies[int(0.95 * len(latencies))] if latencies else None,
+        "errors": sum(result[1] for result in results),
+        "rss_mib": rss,
+    }
+
+
+def measure_startup(config_path, directory, gunicorn_config):
+    started_at = time.perf_counter()
+    with run_gunicorn(config_path, directory, gunicorn_config) as (
+        process,
+        _,
+        base_url,
+    ):
+        first_response = time.perf_counter() - started_at
+        # The workers are booted once they stop using the CPU
+        cpu = cpu_seconds(process.pid)
+        while True:
+            time.sleep(0.2)
+            previous_cpu, cpu = cpu, cpu_seconds(process.pid)
+            if cpu == previous_cpu:
+                break
+        booted = time.perf_counter() - started_at - 0.2
+        deadline = time.monotonic() + 1
+        with ThreadPoolExecutor(FAST_CLIENTS) as executor:
+            list(
+                executor.map(
+                    lambda _: request_repeatedly(base_url, deadline),
+                    range(FAST_CLIENTS),
+                )
+            )
+        return {
+            "first_response_s": first_response,
+            "booted_s": booted,
+            "startup_cpu_s": cpu,
+            **workers_memory(process.pid),
+        }
+
+
+def test_runs_the_hooks_of_the_config(config_path, tmp_path):
+    # Check the metadata every second, for the workers to set their staleness
+    # gauge, which is live and removed when they exit
+    config = json.loads(Path(config_path).read_text(encoding="utf-8"))
+    (backend,) = config["BACKEND_MODULES"]
+    backend["config"]["metadata_refresh"]["check_interval"] = 1
+    config_path = tmp_path / "proxy_conf.json"
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+    (tmp_path / "prometheus").mkdir()
+    (tmp_path / "prometheus" / "counter_1.db").write_bytes(b"stale")
+    log_path = tmp_path / "gunicorn.log"
+
+    def gauge_path(pid):
+        return tmp_path / "prometheus" / f"gauge_livemax_{pid}.db"
+
+    with run_gunicorn(str(config_path), tmp_path, log_path=log_path) as (
+        process,
+        _,
+        base_url,
+    ):
+        assert not (tmp_path / "prometheus" / "counter_1.db").exists()
+
+        # The metadata refresher threads are started by the post_fork hook
+        wait_until(lambda: len(worker_pids(process.pid)) == WORKERS)
+        pids = worker_pids(process.pid)
+        wait_until(lambda: all(gauge_path(pid).exists() for pid in pids))
+        assert "oidc2fer_metadata_staleness_seconds" in scrape(base_url)
+
+        # Each worker logs through its own thread, started after the fork
+        for _ in range(10):
+            with urllib.request.urlopen(
+                f"{base_url}/.well-known/openid-configuration", timeout=5
+            ) as response:
+                response.read()
+        wait_until(
+            lambda: (
+                sum(
+                    line["logger"] == "gunicorn.access" and line["pid"] in pids
+                    for line in read_logs(log_path)
+                )
+                == 10
+            )
+        )
+        assert {
+            line["pid"]
+            for line in read_logs(log_path)
+            if line.get("message", "").startswith("Booting worker")
+        } == set(pids)
+
+        # The live gauges of a dead worker are removed by the child_exit hook
+        os.kill(pids[0], signal.SIGKILL)
+        wait_until(lambda: not gauge_path(pids[0]).exists())
+        wait_until(lambda: len(worker_pids(process.pid)) == WORKERS)
+        assert gauge_path(pids[1]).exists()
+
+
+def test_refuses_several_workers_with_the_memory_state_store(config_path, tmp_path):
+    config = json.loads(Path(config_path).read_text(encoding="utf-8"))
+    config["STATE_COOKIE"] = {"store": "memory"}
+    config_path = tmp_path / "proxy_conf.json"
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+    result = subprocess.run(
+        [sys.executable, "-m", "gunicorn", "-c", str(GUNICORN_CONFIG)],
+        cwd=SATOSA_DIR,
+        env={
+            **os.environ,
+            "SATOSA_CONFIG": str(config_path),
+            "PROMETHEUS_MULTIPROC_DIR": str(tmp_path / "prometheus"),
+            "GUNICORN_CMD_ARGS": f"--bind=127.0.0.1:{free_port()} --workers={WORKERS}",
+        },
+        capture_output=True,
+        timeout=60,
+        check=False,
+    )
+    assert result.returncode == 1
+    assert b"memory state store" in result.stderr
+
+
+def test_gthread_workers_serve_requests_during_slow_uploads(
+    config_path, tmp_path, capsys
+):
+    result = run_load(config_path, tmp_path)
+    with capsys.disabled():
+        sys.stdout.write(f"\ngthread {json.dumps(result)}")
+    assert result["errors"] == 0
+    assert result["throughput"] > 0
+
+
+def test_preloading_shares_memory_between_workers(config_path, tmp_path, capsys):
+    no_preload_config = tmp_path / "gunicorn_no_preload.py"
+    no_preload_config.write_text(
+        GUNICORN_CONFIG.read_text() + "\npreload_app = False\n"
+    )
+    gunicorn_configs = {"no-preload": no_preload_config, "preload": GUNICORN_CONFIG}
+    results = {}
+    for mode, gunicorn_config in gunicorn_configs.items():
+        (tmp_path / mode).mkdir()
+        results[mode] = measure_startup(config_path, tmp_path / mode, gunicorn_config)
+    with capsys.disabled():
+        for mode, result in results.items():
+            sys.stdout.write(f"\n{mode:10} {json.dumps(result)}")
+    assert (
+        results["preload"]["private_mib_per_worker"]
+        < results["no-preload"]["private_mib_per_worker"]
+    )
@@ -0,0 +1,57 @@
+import json
+import math
+from urllib.parse import parse_qs, urlparse
+
+from load_test import Results, percentiles
+from stub_idp import StubFederation
+from werkzeug.test import Client
+
+from oidc2fer.metadata_cache import build_metadata_cache
+
+STUB_BASE_URL = "http://stub-idp:8000"
+
+
+class TestLoadTest:
+    def test_percentiles(self):
+        durations = [n / 1000 for n in range(1, 101)]
+        assert percentiles(durations) == {"p50": 50.5, "p95": 95.1, "p99": 99.0}
+        assert math.isnan(percentiles([])["p50"])
+
+    def test_counts_errors_per_hop(self):
+        results = Results()
+        results.record("authorize", 0.01)
+        results.error("wayf", ConnectionError())
+        summary = results.summary()
+        assert summary["authorize"]["count"] == 1
+        assert summary["wayf"]["errors"] == {"ConnectionError": 1}
+
+
+class TestStubFederation:
+    def create_federation(self):
+        return StubFederation(STUB_BASE_URL, "http://app-dev:8000/metadata", 2)
+
+    def test_serves_metadata_of_each_idp(self, tmp_path):
+        client = Client(self.create_federation())
+        path = tmp_path / "idps.xml"
+        path.write_bytes(client.get("/metadata").data)
+        build_metadata_cache(str(path), str(tmp_path / "idps.json"))
+        entity_ids = [
+            entity_id
+            for entity_id, _ in json.loads((tmp_path / "idps.json").read_text())
+        ]
+        assert entity_ids == [f"{STUB_BASE_URL}/idp/1", f"{STUB_BASE_URL}/idp/2"]
+
+    def test_wayf_picks_idps_in_turn(self):
+        client = Client(self.create_federation())
+        picked = []
+        for _ in range(3):
+            response = client.get(
+                "/wayf?entityID=sp&return=https://gw.example.com/Saml2/disco"
+            )
+            assert response.status_code == 302
+            picked.append(parse_qs(urlparse(response.location).query)["entityID"][0])
+        assert picked == [
+            f"{STUB_BASE_URL}/idp/1",
+            f"{STUB_BASE_URL}/idp/2",
+            f"{STUB_BASE_URL}/idp/1",
+        ]
@@ -0,0 +1,125 @@
+import datetime
+import logging
+import os
+
+import json_log_formatter
+import pytest
+
+from oidc2fer.logs import DefaultJSONFormatter, QueueStreamHandler, RequestJSONFormatter
+
+ACCESS_ARGS = {
+    "h": "10.0.0.1",
+    "m": "GET",
+    "U": "/Saml2/OIDC/authorization",
+    "q": "client_id=6925fb8143c76eded44d32b40c0cb1006065f7f003de52712b78985704f3995",
+    "s": 303,
+    "t": "[18/Oct/2026:15:19:00 +0000]",
+    "a": "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0",
+    "f": "https://auth.agentconnect.gouv.fr/",
+    "M": 12,
+}
+
+
+class LegacyRequestJSONFormatter(json_log_formatter.JSONFormatter):
+    """
+    The access log formatter of the gunicorn config before oidc2fer.logs.
+    """
+
+    def json_record(self, message, extra, record):
+        response_time = datetime.datetime.strptime(
+            record.args["t"], "[%d/%b/%Y:%H:%M:%S %z]"
+        )
+        url = record.args["U"]
+        if record.args["q"]:
+            url += f"?{record.args['q']}"
+        return {
+            "logger": record.name,
+            "level": record.levelname,
+            "remote_ip": record.args["h"],
+            "method": record.args["m"],
+            "path": url,
+            "status": str(record.args["s"]),
+            "time": response_time.isoformat(),
+            "user_agent": record.args["a"],
+            "referer": record.args["f"],
+            "duration_in_ms": record.args["M"],
+            "pid": record.process,
+        }
+
+
+class LegacyDefaultJSONFormatter(json_log_formatter.JSONFormatter):
+    """
+    The app log formatter of the gunicorn config before oidc2fer.logs.
+    """
+
+    def json_record(self, message, extra, record):
+        payload = super().json_record(message, extra, record)
+        payload["logger"] = record.name
+        payload["level"] = record.levelname
+        payload["pid"] = record.process
+        return payload
+
+
+def create_access_record():
+    return logging.LogRecord(
+        "gunicorn.access", logging.INFO, __file__, 1, "%(h)s", (ACCESS_ARGS,), None
+    )
+
+
+def create_app_record():
+    record = logging.LogRecord(
+        "oidc2fer.attribute_generators.entity_id_to_siret_mapper",
+        logging.INFO,
+        __file__,
+        1,
+        "SIRET %s found for %s",
+        ("12345678200010", "https://idp.example.fr/idp/shibboleth"),
+        None,
+    )
+    record.idp = "https://idp.example.fr/idp/shibboleth"
+    return record
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+class TestLogFormatterBenchmark:
+    @pytest.mark.parametrize(
+        "formatter_class",
+        [LegacyRequestJSONFormatter, RequestJSONFormatter],
+        ids=["json_log_formatter", "oidc2fer"],
+    )
+    def test_access_record(self, benchmark, formatter_class):
+        benchmark.group = "access log formatter"
+        formatter = formatter_class()
+        record = create_access_record()
+        benchmark(formatter.format, record)
+
+    @pytest.mark.parametrize(
+        "formatter_class",
+        [LegacyDefaultJSONFormatter, DefaultJSONFormatter],
+        ids=["json_log_formatter", "oidc2fer"],
+    )
+    def test_app_record(self, benchmark, formatter_class):
+        benchmark.group = "app log formatter"
+        formatter = formatter_class()
+        record = create_app_record()
+        benchmark(formatter.format, record)
+
+    @pytest.mark.parametrize("handler_class", ["stream", "queue"])
+    def test_handler(self, benchmark, handler_class):
+        """
+        The time a request spends logging a record, formatted and written to
+        /dev/null by it or by the thread of QueueStreamHandler.
+        """
+        benchmark.group = "log handler"
+        with open(os.devnull, "w", encoding="utf-8") as stream:
+            if handler_class == "stream":
+                handler = logging.StreamHandler(stream)
+            else:
+                handler = QueueStreamHandler(stream, max_size=1_000_000)
+            handler.setFormatter(DefaultJSONFormatter())
+            try:
+                benchmark(handler.handle, create_app_record())
+            finally:
+                handler.close()
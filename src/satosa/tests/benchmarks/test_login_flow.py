@@ -0,0 +1,64 @@
+import base64
+import json
+import os
+
+import pytest
+
+BENCH_ROUNDS = int(os.environ.get("BENCH_ROUNDS", "50"))
+
+
+def jwt_payload(token):
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+
+
+def test_login_flow(new_login_flow):
+    login_flow = new_login_flow()
+    userinfo = jwt_payload(login_flow.userinfo(login_flow.run_until("userinfo")))
+    assert {
+        "sub": "enseignant1@example.fr",
+        "uid": "enseignant1@example.fr",
+        "email": "georges.grospieds@example.fr",
+        "given_name": "Georges",
+        "usual_name": "Grospieds",
+        "siret": "12345678200010",
+    }.items() <= userinfo.items()
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+def test_benchmark_stage(benchmark, new_login_flow, stage):
+    """
+    Measures one hop of the login flow, each round running on a fresh flow.
+
+    Run with `BENCH=1 pytest tests/benchmarks --benchmark-json=benchmark.json`
+    to get machine-readable latency (stats) and throughput (ops) per stage.
+    """
+
+    def setup():
+        login_flow = new_login_flow()
+        return (login_flow, login_flow.run_until(stage)), {}
+
+    def hop(login_flow, previous_result):
+        return getattr(login_flow, stage)(previous_result)
+
+    benchmark.group = "login flow"
+    benchmark.extra_info["stage"] = stage
+    benchmark.pedantic(hop, setup=setup, rounds=BENCH_ROUNDS)
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+def test_benchmark_userinfo_replay(benchmark, new_login_flow):
+    """
+    Measures userinfo requests replaying the same access token, the way
+    test_benchmark_userinfo in test_e2e.py does against a running stack.
+    """
+    login_flow = new_login_flow()
+    access_token = login_flow.token(login_flow.run_until("token"))
+
+    benchmark.group = "login flow"
+    benchmark.extra_info["stage"] = "userinfo (replay)"
+    benchmark(login_flow.userinfo, access_token)
@@ -0,0 +1,85 @@
+import json
+import os
+from urllib.parse import urlencode
+
+import pytest
+from satosa.state import State
+
+from oidc2fer.state_cookie import decode_state, encode_state
+
+ENCRYPTION_KEY = os.urandom(32).hex()
+# The authorization request of ProConnect, with its claims and ACR values
+OIDC_REQUEST = urlencode(
+    {
+        "client_id": "6925fb8143c76eded44d32b40c0cb1006065f7f003de52712b78985704f39950",
+        "redirect_uri": "https://auth.agentconnect.gouv.fr/api/v2/oidc-callback",
+        "response_type": "code",
+        "scope": "openid given_name usual_name email uid siret",
+        "state": "f9d2c9d7f5a6c6b1b64a3fd0e1d6b2a19a0b7c1d2e3f4a5b6c7d8e9f0a1b2c3d",
+        "nonce": "7c1d2e3f4a5b6c7d8e9f0a1b2c3df9d2c9d7f5a6c6b1b64a3fd0e1d6b2a19a0b",
+        "claims": json.dumps({"id_token": {"amr": {"essential": True}}}),
+        "acr_values": "eidas1",
+        "prompt": "login consent",
+    }
+)
+# The state saved by each hop of a login, the ACS deletes it
+HOP_STATES = {
+    "authorize": {
+        "SESSION_ID": "urn:uuid:6570fd03-b4f6-491f-8bd8-b1f17bb28e52",
+        "OIDC": {"oidc_request": OIDC_REQUEST},
+        "SATOSA_BASE": {"requester": "oidc-test-client"},
+        "ROUTER": "OIDC",
+        "force_authn": None,
+    },
+    "discovery": {
+        "SESSION_ID": "urn:uuid:6570fd03-b4f6-491f-8bd8-b1f17bb28e52",
+        "OIDC": {"oidc_request": OIDC_REQUEST},
+        "SATOSA_BASE": {"requester": "oidc-test-client"},
+        "ROUTER": "OIDC",
+        "force_authn": None,
+        "Saml2": {"relay_state": "kWRJ7urVt596vYIQ"},
+    },
+}
+
+
+def satosa_encode(state_dict):
+    state = State()
+    state.data = state_dict
+    return state.urlstate(ENCRYPTION_KEY)
+
+
+def satosa_decode(value):
+    return State(value, ENCRYPTION_KEY).data
+
+
+CODECS = {
+    "satosa": (satosa_encode, satosa_decode),
+    "compact": (
+        lambda state: encode_state(state, ENCRYPTION_KEY),
+        lambda value: decode_state(value, ENCRYPTION_KEY),
+    ),
+}
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("operation", ["encode", "decode"])
+@pytest.mark.parametrize("hop", HOP_STATES)
+def test_benchmark_state_cookie(benchmark, hop, operation, codec):
+    """
+    Measures encoding the state cookie of each hop, or decoding it on the next
+    hop, with SATOSA's codec and the compact one. The cookie sizes are in the
+    extra_info of the results.
+    """
+    encode, decode = CODECS[codec]
+    value = encode(HOP_STATES[hop])
+    assert decode(value) == HOP_STATES[hop]
+
+    benchmark.group = f"state cookie {operation}"
+    benchmark.extra_info.update({"hop": hop, "codec": codec, "bytes": len(value)})
+    if operation == "encode":
+        benchmark(encode, HOP_STATES[hop])
+    else:
+        benchmark(decode, value)
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from pyop.storage import StatelessWrapper
+
+from oidc2fer.stateless_tokens import StatelessTokenDB, TokenCodec
+
+ENCRYPTION_KEY = os.urandom(32).hex()
+AUTH_REQ = {
+    "client_id": "6925fb8143c76eded44d32b40c0cb1006065f7f003de52712b78985704f39950",
+    "redirect_uri": "https://auth.agentconnect.gouv.fr/api/v2/oidc-callback",
+    "response_type": "code",
+    "scope": "openid given_name usual_name email uid siret",
+    "state": "f9d2c9d7f5a6c6b1b64a3fd0e1d6b2a19a0b7c1d2e3f4a5b6c7d8e9f0a1b2c3d",
+    "nonce": "7c1d2e3f4a5b6c7d8e9f0a1b2c3df9d2c9d7f5a6c6b1b64a3fd0e1d6b2a19a0b",
+    "acr_values": "eidas1",
+}
+USER_INFO = {
+    "given_name": "Georges",
+    "email": "georges.grospieds@example.fr",
+    "usual_name": "Grospieds",
+    "uid": "enseignant1@example.fr",
+    "acr": "eidas1",
+    "siret": "12345678200010",
+}
+# The payloads pyop packs into the code and the access token of a login
+PAYLOADS = {
+    "authz_codes": {
+        "used": False,
+        "exp": 1792336800,
+        "sub": "enseignant1@example.fr",
+        "granted_scope": AUTH_REQ["scope"],
+        "auth_req": AUTH_REQ,
+        "user_info": USER_INFO,
+        "extra_id_token_claims": {},
+    },
+    "access_tokens": {
+        "iat": 1792336740,
+        "exp": 1792336800,
+        "sub": "enseignant1@example.fr",
+        "client_id": AUTH_REQ["client_id"],
+        "aud": [AUTH_REQ["client_id"]],
+        "scope": AUTH_REQ["scope"],
+        "granted_scope": AUTH_REQ["scope"],
+        "token_type": "Bearer",
+        "auth_req": AUTH_REQ,
+        "user_info": USER_INFO,
+    },
+}
+
+
+def create_pyop_db(collection):
+    db = StatelessWrapper(collection, ENCRYPTION_KEY)
+    # pylint: disable-next=protected-access
+    return db.pack, db._unpack
+
+
+def create_oidc2fer_db(collection):
+    codec = TokenCodec([("1", ENCRYPTION_KEY)])
+    db = StatelessTokenDB(collection, codec)
+    # Without the payload kept by the thread, as for the first lookup
+    return db.pack, lambda token: codec.decode(token, collection)
+
+
+DBS = {"pyop": create_pyop_db, "oidc2fer": create_oidc2fer_db}
+
+
+@pytest.mark.skipif(
+    "BENCH" not in os.environ, reason="Benchmark runs only if requested"
+)
+@pytest.mark.parametrize("db", DBS)
+@pytest.mark.parametrize("operation", ["issue", "verify"])
+@pytest.mark.parametrize("collection", PAYLOADS)
+def test_benchmark_stateless_token(benchmark, collection, operation, db):
+    """
+    Measures issuing the code or the access token of a login, or verifying
+    it, with pyop's stateless storage and oidc2fer's. The token lengths are in
+    the extra_info of the results.
+    """
+    pack, unpack = DBS[db](collection)
+    payload = PAYLOADS[collection]
+    token = pack(payload)
+    assert unpack(token) == payload
+
+    benchmark.group = f"stateless token {operation}"
+    benchmark.extra_info.update(
+        {"collection": collection, "db": db, "length": len(token)}
+    )
+    if operation == "issue":
+        benchmark(pack, payload)
+    else:
+        benchmark(unpack, token)
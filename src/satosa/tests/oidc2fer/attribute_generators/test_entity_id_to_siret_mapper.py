@@ -1,13 +1,24 @@
 import json
+from pathlib import Path
 
+from prometheus_client import REGISTRY
+from satosa import yaml
 from satosa.context import Context
 from satosa.internal import AuthenticationInformation, InternalData
 
 from oidc2fer.attribute_generators import EntityIdToSiretMapper
+from oidc2fer.attribute_generators.siret_mapping import write_mapping_file
+
+PLUGIN_CONFIG_PATH = (
+    Path(__file__).resolve().parents[3]
+    / "plugins"
+    / "microservices"
+    / "siret_mapping.yaml"
+)
 
 
 class TestEntityIdToSiretMapper:
-    def create_mapper(self):
+    def create_mapper(self, **config):
         mapper = EntityIdToSiretMapper(
             config={
                 "attribute": "siret",
@@ -16,6 +27,7 @@ class TestEntityIdToSiretMapper:
                         "https://idp.example.fr": "12345678200010",
                     }
                 ),
+                **config,
             },
             name="siret_mapper",
             base_url="https://satosa.example.com",
@@ -40,3 +52,50 @@ class TestEntityIdToSiretMapper:
         ctx = Context()
         mapper.process(ctx, resp)
         assert "siret" not in resp.attributes
+
+    def test_counts_misses_by_entityid(self):
+        mapper = self.create_mapper()
+        resp = InternalData(
+            auth_info=AuthenticationInformation(issuer="https://idp.inconnu.fr")
+        )
+        mapper.process(Context(), resp)
+        assert (
+            REGISTRY.get_sample_value(
+                "oidc2fer_siret_mapping_misses_total",
+                {"issuer": "https://idp.inconnu.fr"},
+            )
+            == 1
+        )
+
+    def test_sets_siret_from_mapping_file(self, tmp_path):
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, {"https://idp.univ.fr": "11122233300044"})
+        mapper = self.create_mapper(mapping_path=str(path))
+        resp = InternalData(
+            auth_info=AuthenticationInformation(issuer="https://idp.univ.fr")
+        )
+        ctx = Context()
+        mapper.process(ctx, resp)
+        assert resp.attributes["siret"] == "11122233300044"
+
+    def test_reads_mapping_from_environment(self, monkeypatch):
+        monkeypatch.setenv("SIRET_MAP", '{"https://idp.univ.fr": "11122233300044"}')
+        mapper = EntityIdToSiretMapper(
+            config={"attribute": "siret"},
+            name="siret_mapper",
+            base_url="https://satosa.example.com",
+        )
+        assert mapper.mapping == {"https://idp.univ.fr": "11122233300044"}
+
+    def test_loads_plugin_config_with_mapping_path(self, tmp_path, monkeypatch):
+        monkeypatch.delenv("SIRET_MAP", raising=False)
+        with open(PLUGIN_CONFIG_PATH, encoding="utf-8") as f:
+            config = yaml.load(f)["config"]
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, {"https://idp.univ.fr": "11122233300044"})
+        mapper = EntityIdToSiretMapper(
+            config={**config, "mapping_path": str(path)},
+            name="siret_mapper",
+            base_url="https://satosa.example.com",
+        )
+        assert mapper.mapping.get("https://idp.univ.fr") == "11122233300044"
@@ -0,0 +1,96 @@
+import pytest
+
+from oidc2fer.attribute_generators.siret_mapping import (
+    SiretMappingFile,
+    SiretMappingStore,
+    write_mapping_file,
+)
+
+MAPPING = {
+    "https://idp.example.fr/idp/shibboleth": "12345678200010",
+    "https://idp.autre-exemple.fr/idp/shibboleth": "98765432100015",
+    "https://idp.univ.fr/idp/shibboleth": "11122233300044",
+    "urn:mace:idp.école.fr": "55566677700088",
+}
+
+
+class TestSiretMappingFile:
+    def create_mapping_file(self, tmp_path, mapping):
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, mapping)
+        return SiretMappingFile(path)
+
+    def test_finds_every_entity_id(self, tmp_path):
+        mapping_file = self.create_mapping_file(tmp_path, MAPPING)
+        assert len(mapping_file) == len(MAPPING)
+        for entity_id, siret in MAPPING.items():
+            assert mapping_file.get(entity_id) == siret
+
+    def test_misses_unknown_entity_ids(self, tmp_path):
+        mapping_file = self.create_mapping_file(tmp_path, MAPPING)
+        for entity_id in [
+            "",
+            "https://idp.example.fr",
+            "https://idp.example.fr/idp/shibboleth/",
+            "https://idp.zzz.fr/idp/shibboleth",
+            "a",
+        ]:
+            assert mapping_file.get(entity_id) is None
+
+    def test_empty_file(self, tmp_path):
+        mapping_file = self.create_mapping_file(tmp_path, {})
+        assert len(mapping_file) == 0
+        assert mapping_file.get("https://idp.example.fr/idp/shibboleth") is None
+
+    def test_version_changes_with_content(self, tmp_path):
+        version = self.create_mapping_file(tmp_path, MAPPING).version
+        assert self.create_mapping_file(tmp_path, MAPPING).version == version
+        assert self.create_mapping_file(tmp_path, {}).version != version
+
+    @pytest.mark.parametrize(
+        "content",
+        [
+            "https://b.fr\t1\nhttps://a.fr\t2\n",
+            "https://a.fr\t1\nhttps://a.fr\t2\n",
+            "https://a.fr 1\n",
+            "https://a.fr\t1",
+        ],
+    )
+    def test_rejects_invalid_file(self, tmp_path, content):
+        path = tmp_path / "siret_map.tsv"
+        path.write_text(content)
+        with pytest.raises(ValueError):
+            SiretMappingFile(path)
+
+
+class TestSiretMappingStore:
+    def test_reloads_replaced_file(self, tmp_path):
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, {"https://idp.example.fr": "12345678200010"})
+        store = SiretMappingStore(path, reload_interval=0)
+        version = store.version
+
+        write_mapping_file(path, MAPPING)
+        assert store.get("https://idp.example.fr") is None
+        assert store.get("https://idp.univ.fr/idp/shibboleth") == "11122233300044"
+        assert len(store) == len(MAPPING)
+        assert store.version != version
+
+    def test_keeps_mapping_when_reload_fails(self, tmp_path):
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, {"https://idp.example.fr": "12345678200010"})
+        store = SiretMappingStore(path, reload_interval=0)
+
+        invalid_path = tmp_path / "invalid.tsv"
+        invalid_path.write_text("https://b.fr\t1\nhttps://a.fr\t2\n")
+        invalid_path.replace(path)
+        assert store.get("https://idp.example.fr") == "12345678200010"
+        assert len(store) == 1
+
+    def test_does_not_reload_before_interval(self, tmp_path):
+        path = tmp_path / "siret_map.tsv"
+        write_mapping_file(path, {"https://idp.example.fr": "12345678200010"})
+        store = SiretMappingStore(path, reload_interval=3600)
+
+        write_mapping_file(path, {})
+        assert store.get("https://idp.example.fr") == "12345678200010"
@@ -0,0 +1,65 @@
+import logging
+
+from satosa.context import Context
+from satosa.internal import InternalData
+
+from oidc2fer.attribute_processors import AttributeFlattener
+
+
+class TestAttributeFlattener:
+    def create_flattener(self, **config):
+        flattener = AttributeFlattener(
+            config={"attributes": ["uid", "usual_name"], **config},
+            name="test_flattener",
+            base_url="https://satosa.example.com",
+        )
+        flattener.next = lambda ctx, data: data
+        return flattener
+
+    def process(self, flattener, attributes):
+        internal_data = InternalData()
+        internal_data.attributes = attributes
+        return flattener.process(Context(), internal_data).attributes
+
+    def test_flattens_values(self):
+        attributes = self.process(
+            self.create_flattener(),
+            {"uid": ["albert"], "usual_name": ["Albert", "Betty"]},
+        )
+        assert attributes == {"uid": "albert", "usual_name": "Albert Betty"}
+
+    def test_keeps_single_value(self):
+        value = "Albert"
+        attributes = self.process(self.create_flattener(), {"usual_name": [value]})
+        assert attributes["usual_name"] is value
+
+    def test_leaves_string_alone(self):
+        attributes = self.process(self.create_flattener(), {"uid": "AlreadyFlat"})
+        assert attributes == {"uid": "AlreadyFlat"}
+
+    def test_ignores_missing_and_other_attributes(self):
+        attributes = self.process(self.create_flattener(), {"mail": ["a", "b"]})
+        assert attributes == {"mail": ["a", "b"]}
+
+    def test_joins_with_separator_without_duplicates(self):
+        attributes = self.process(
+            self.create_flattener(separator=", ", deduplicate=True),
+            {"usual_name": ["Albert", "Betty", "Albert"]},
+        )
+        assert attributes["usual_name"] == "Albert, Betty"
+
+    def test_keeps_first_value_only(self):
+        attributes = self.process(
+            self.create_flattener(first_only=True),
+            {"usual_name": ["Albert", "Betty"]},
+        )
+        assert attributes["usual_name"] == "Albert"
+
+    def test_flattens_empty_list(self):
+        attributes = self.process(self.create_flattener(), {"usual_name": []})
+        assert attributes["usual_name"] == ""
+
+    def test_logs_values_in_debug(self, caplog):
+        with caplog.at_level(logging.DEBUG):
+            self.process(self.create_flattener(), {"usual_name": ["Albert", "Betty"]})
+        assert "into Albert Betty" in caplog.text
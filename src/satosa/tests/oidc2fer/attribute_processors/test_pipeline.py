@@ -0,0 +1,325 @@
+import copy
+import json
+from pathlib import Path
+from pydoc import locate
+
+import pytest
+from satosa import yaml
+from satosa.context import Context
+from satosa.exception import SATOSAAuthenticationError, SATOSAConfigurationError
+from satosa.internal import AuthenticationInformation, InternalData
+from satosa.response import Redirect
+from satosa.state import State
+
+from oidc2fer.attribute_processors import AttributePipeline
+from oidc2fer.attribute_processors import pipeline as pipeline_module
+
+SATOSA_DIR = Path(__file__).resolve().parents[3]
+MICRO_SERVICES = [
+    "filter_attributes",
+    "attribute_authorization",
+    "affiliation_checker",
+    "primary_identifier",
+    "static_attributes",
+    "attribute_flattener",
+    "siret_mapping",
+]
+SIRET_MAP = {
+    "https://idp.example.fr": "12345678200010",
+    "https://idp.labo.fr": "98765432100015",
+}
+SCOPES = {
+    "https://idp.example.fr": [{"text": "example.fr", "regexp": False}],
+    "https://idp.labo.fr": [{"text": r".*\.univ\.fr", "regexp": True}],
+    "https://idp.unmapped.fr": [{"text": "unmapped.fr", "regexp": False}],
+}
+LOGINS = {
+    "employee": (
+        "https://idp.example.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont@example.fr"],
+            "eduPersonAffiliation": ["member", "employee"],
+            "usual_name": ["Dupont"],
+            "mail": ["jean.dupont@example.fr"],
+        },
+    ),
+    "several_names": (
+        "https://idp.example.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont@example.fr"],
+            "eduPersonAffiliation": ["staff"],
+            "usual_name": ["Dupont", "Martin"],
+        },
+    ),
+    "regexp_scope": (
+        "https://idp.labo.fr",
+        {
+            "eduPersonPrincipalName": ["amartin@chimie.univ.fr"],
+            "eduPersonAffiliation": ["researcher@univ.fr"],
+        },
+    ),
+    "wrong_scope": (
+        "https://idp.example.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont@autre.fr"],
+            "eduPersonAffiliation": ["employee"],
+        },
+    ),
+    "unscoped_principal_name": (
+        "https://idp.example.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont"],
+            "eduPersonAffiliation": ["employee"],
+        },
+    ),
+    "missing_principal_name": (
+        "https://idp.example.fr",
+        {"eduPersonAffiliation": ["employee"]},
+    ),
+    "student": (
+        "https://idp.example.fr",
+        {
+            "eduPersonPrincipalName": ["etudiant@example.fr"],
+            "eduPersonAffiliation": ["student"],
+        },
+    ),
+    "missing_affiliation": (
+        "https://idp.example.fr",
+        {"eduPersonPrincipalName": ["jdupont@example.fr"]},
+    ),
+    "unmapped_idp": (
+        "https://idp.unmapped.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont@unmapped.fr"],
+            "eduPersonAffiliation": ["faculty"],
+        },
+    ),
+    "unknown_idp": (
+        "https://idp.inconnu.fr",
+        {
+            "eduPersonPrincipalName": ["jdupont@inconnu.fr"],
+            "eduPersonAffiliation": ["faculty"],
+        },
+    ),
+}
+
+# Other configs of the stock micro-services, with the options and rules that
+# the configs of plugins/microservices don't use
+OTHER_CONFIGS = {
+    "filter_attributes": {
+        "attribute_filters": {
+            "": {"client-id": {"": "^[^ ]+$", "mail": {"regexp": "@example.fr$"}}},
+            "https://idp.example.fr": {
+                "": {"eduPersonAffiliation": {"shibmdscope_match_value": None}}
+            },
+            "https://idp.labo.fr": {
+                "other-client-id": {"eduPersonAffiliation": "^researcher"},
+                "": {"eduPersonAffiliation": {"shibmdscope_match_scope": None}},
+            },
+        }
+    },
+    "attribute_authorization": {
+        "attribute_allow": {
+            "client-id": {
+                "https://idp.example.fr": {
+                    "eduPersonAffiliation": ["^(member|employee|staff)$"]
+                }
+            }
+        },
+        "attribute_deny": {
+            "default": {
+                "default": {"eduPersonAffiliation": ["^student$"]},
+                "https://idp.labo.fr": {"eduPersonPrincipalName": ["@chimie"]},
+            }
+        },
+        "force_attributes_presence_on_deny": True,
+    },
+    "primary_identifier": {
+        "ordered_identifier_candidates": [
+            {"attribute_names": ["mail"]},
+            {
+                "attribute_names": ["usual_name", "eduPersonAffiliation"],
+                "add_scope": "issuer_entityid",
+            },
+            {"attribute_names": ["eduPersonPrincipalName"], "add_scope": "@fer"},
+        ],
+        "primary_identifier": "id",
+        "clear_input_attributes": True,
+        "replace_subject_id": False,
+    },
+}
+
+
+class FakeMetadataStore:
+    def shibmd_scopes(self, entity_id, typ):  # pylint: disable=unused-argument
+        return iter(SCOPES.get(entity_id, []))
+
+
+def load_plugin_configs(monkeypatch):
+    monkeypatch.setenv("SIRET_MAP", json.dumps(SIRET_MAP))
+    plugin_configs = []
+    for name in MICRO_SERVICES:
+        path = SATOSA_DIR / "plugins" / "microservices" / f"{name}.yaml"
+        with open(path, encoding="utf-8") as f:
+            plugin_configs.append(yaml.load(f))
+    return plugin_configs
+
+
+def create_chain(plugin_configs):
+    """
+    Links the micro-services like SATOSA does, returns the first one.
+    """
+    services = [
+        locate(plugin_config["module"])(
+            config=copy.deepcopy(plugin_config["config"]),
+            name=plugin_config["name"],
+            base_url="https://satosa.example.com",
+        )
+        for plugin_config in plugin_configs
+    ]
+    for service, next_service in zip(services, services[1:], strict=False):
+        service.next = next_service.process
+    services[-1].next = lambda ctx, data: data
+    return services[0]
+
+
+def create_pipeline(plugin_configs):
+    pipeline = AttributePipeline(
+        config={"micro_services": copy.deepcopy(plugin_configs)},
+        name="AttributePipeline",
+        base_url="https://satosa.example.com",
+    )
+    pipeline.next = lambda ctx, data: data
+    return pipeline
+
+
+def run(service, issuer, attributes, requester="client-id"):
+    """
+    Returns the resulting attributes and subject ID, or the error.
+    """
+    context = Context()
+    context.state = State()
+    if requester:
+        context.state["SATOSA_BASE"] = {"requester": requester}
+    context.decorate(Context.KEY_METADATA_STORE, FakeMetadataStore())
+    data = InternalData(auth_info=AuthenticationInformation(issuer=issuer))
+    data.requester = requester
+    data.subject_id = "transient-id"
+    data.attributes = copy.deepcopy(attributes)
+    try:
+        result = service.process(context, data)
+    except SATOSAAuthenticationError as e:
+        return type(e), str(e)
+    if result is not data:
+        return result
+    return data.attributes, data.subject_id
+
+
+class TestAttributePipelineParity:
+    @pytest.mark.parametrize("login", LOGINS)
+    def test_same_result_as_chain(self, monkeypatch, login):
+        plugin_configs = load_plugin_configs(monkeypatch)
+        issuer, attributes = LOGINS[login]
+        assert run(create_pipeline(plugin_configs), issuer, attributes) == run(
+            create_chain(plugin_configs), issuer, attributes
+        )
+
+    def test_same_result_as_chain_without_requester(self, monkeypatch):
+        plugin_configs = load_plugin_configs(monkeypatch)
+        issuer, attributes = LOGINS["employee"]
+        assert run(
+            create_pipeline(plugin_configs), issuer, attributes, requester=None
+        ) == run(create_chain(plugin_configs), issuer, attributes, requester=None)
+
+    def test_same_result_as_chain_with_other_filters(self, monkeypatch):
+        plugin_configs = load_plugin_configs(monkeypatch)
+        plugin_configs[0]["config"]["attribute_filters"] = {
+            "": {"client-id": {"": "^[^ ]+$", "mail": {"regexp": "@example.fr$"}}},
+            "https://idp.example.fr": {
+                "": {"eduPersonAffiliation": {"shibmdscope_match_value": None}}
+            },
+        }
+        issuer, attributes = LOGINS["employee"]
+        attributes = {
+            **attributes,
+            "eduPersonAffiliation": ["employee", "example.fr"],
+            "mail": ["jean.dupont@example.fr", "jean@autre.fr", "jean dupont"],
+        }
+        assert run(create_pipeline(plugin_configs), issuer, attributes) == run(
+            create_chain(plugin_configs), issuer, attributes
+        )
+
+
+class TestCompiledStepParity:
+    """
+    Runs each stock micro-service alone and the step it is compiled to.
+    """
+
+    @pytest.mark.parametrize("login", LOGINS)
+    @pytest.mark.parametrize("other_config", [False, True], ids=["file", "other"])
+    @pytest.mark.parametrize("name", OTHER_CONFIGS)
+    def test_same_result_as_micro_service(self, monkeypatch, name, other_config, login):
+        plugin_config = load_plugin_configs(monkeypatch)[MICRO_SERVICES.index(name)]
+        if other_config:
+            plugin_config["config"] = OTHER_CONFIGS[name]
+        pipeline = create_pipeline([plugin_config])
+        assert pipeline.steps[0].__qualname__.startswith("compile_")
+        issuer, attributes = LOGINS[login]
+        for requester in ("client-id", "other-client-id"):
+            assert run(pipeline, issuer, attributes, requester) == run(
+                create_chain([plugin_config]), issuer, attributes, requester
+            )
+
+
+class TestAttributePipeline:
+    def test_loads_plugin_config_files(self, monkeypatch):
+        monkeypatch.setenv("SIRET_MAP", json.dumps(SIRET_MAP))
+        monkeypatch.chdir(SATOSA_DIR)
+        with open(
+            "plugins/microservices/attribute_pipeline.yaml", encoding="utf-8"
+        ) as f:
+            plugin_config = yaml.load(f)
+        pipeline = AttributePipeline(
+            config=plugin_config["config"],
+            name=plugin_config["name"],
+            base_url="https://satosa.example.com",
+        )
+        assert len(pipeline.steps) == len(MICRO_SERVICES)
+
+    def test_runs_primary_identifier_as_is_with_on_error(self, monkeypatch):
+        plugin_configs = load_plugin_configs(monkeypatch)[3:4]
+        plugin_configs[0]["config"]["on_error"] = "https://erreur.example.com"
+        issuer, attributes = LOGINS["missing_principal_name"]
+
+        response = run(create_pipeline(plugin_configs), issuer, attributes)
+        assert isinstance(response, Redirect)
+        assert response.message.startswith("https://erreur.example.com?sp=client-id")
+
+    def test_rejects_unknown_filter_type(self):
+        plugin_config = {
+            "module": "satosa.micro_services.attribute_modifications."
+            "FilterAttributeValues",
+            "name": "AttributeFilter",
+            "config": {"attribute_filters": {"": {"": {"mail": {"unknown": "x"}}}}},
+        }
+        with pytest.raises(SATOSAConfigurationError):
+            create_pipeline([plugin_config])
+
+    def test_rejects_unknown_module(self):
+        plugin_config = {
+            "module": "satosa.micro_services.unknown.Unknown",
+            "name": "Unknown",
+            "config": {},
+        }
+        with pytest.raises(SATOSAConfigurationError, match="Can't find module"):
+            create_pipeline([plugin_config])
+
+    def test_runs_as_is_with_other_satosa_version(self, monkeypatch):
+        monkeypatch.setattr(pipeline_module, "COMPILED_SATOSA_VERSIONS", ("8.4.0",))
+        plugin_configs = load_plugin_configs(monkeypatch)
+        pipeline = create_pipeline(plugin_configs)
+        assert all(step.__name__ == "step" for step in pipeline.steps)
+        issuer, attributes = LOGINS["employee"]
+        assert run(pipeline, issuer, attributes) == run(
+            create_chain(plugin_configs), issuer, attributes
+        )
@@ -1,6 +1,9 @@
+import os
+
 import pytest
+from prometheus_client import REGISTRY
 from satosa.context import Context
-from satosa.exception import SATOSAAuthenticationError
+from satosa.exception import SATOSAAuthenticationError, SATOSAConfigurationError
 from satosa.internal import AuthenticationInformation, InternalData
 
 from oidc2fer.authorization import AffiliationChecker
@@ -64,3 +67,114 @@ class TestAffiliationChecker:
             ctx = Context()
             ctx.state = {}
             authz_service.process(ctx, resp)
+
+
+class TestAffiliationCheckerPerIssuer:
+    def create_affiliation_checker(self, **config):
+        affiliation_checker = AffiliationChecker(
+            config={
+                "attribute_name": "eduPersonAffiliation",
+                "allowed_values": {
+                    "default": ["employee"],
+                    "https://idp.univ.fr": ["staff@univ.fr", "Faculty"],
+                },
+                **config,
+            },
+            name="test_affiliation_checker",
+            base_url="https://satosa.example.com",
+        )
+        affiliation_checker.next = lambda ctx, data: data
+        return affiliation_checker
+
+    def process(self, authz_service, issuer, values):
+        resp = InternalData(auth_info=AuthenticationInformation(issuer=issuer))
+        resp.attributes = {"eduPersonAffiliation": values}
+        ctx = Context()
+        ctx.state = {}
+        authz_service.process(ctx, resp)
+
+    def test_uses_default_for_unknown_issuer(self):
+        authz_service = self.create_affiliation_checker()
+        self.process(authz_service, "https://idp.example.fr", ["employee"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.example.fr", ["staff"])
+
+    def test_uses_issuer_allowed_values(self):
+        authz_service = self.create_affiliation_checker()
+        self.process(authz_service, "https://idp.univ.fr", ["FACULTY"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.univ.fr", ["employee"])
+
+    def test_scoped_allowed_value_requires_scope(self):
+        authz_service = self.create_affiliation_checker()
+        self.process(authz_service, "https://idp.univ.fr", ["Staff@Univ.fr"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.univ.fr", ["staff"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.univ.fr", ["staff@other.fr"])
+
+    def test_counts_rejections_by_issuer(self):
+        authz_service = self.create_affiliation_checker()
+        labels = {"issuer": "https://idp.rejets.fr"}
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.rejets.fr", ["staff"])
+        assert (
+            REGISTRY.get_sample_value("oidc2fer_affiliation_rejections_total", labels)
+            == 1
+        )
+
+    def test_unscoped_allowed_value_requires_no_scope(self):
+        authz_service = self.create_affiliation_checker()
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(
+                authz_service, "https://idp.example.fr", ["employee@example.fr"]
+            )
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.univ.fr", ["faculty@univ.fr"])
+
+    def test_refuses_string_allowed_values(self):
+        with pytest.raises(SATOSAConfigurationError, match="must be a list"):
+            self.create_affiliation_checker(allowed_values={"https://idp.fr": "staff"})
+        with pytest.raises(SATOSAConfigurationError, match="must be a list"):
+            self.create_affiliation_checker(allowed_values="staff")
+
+    def test_loads_allowed_values_file(self, tmp_path):
+        path = tmp_path / "allowed_affiliations.yaml"
+        path.write_text("https://idp.example.fr:\n  - student\n")
+        authz_service = self.create_affiliation_checker(allowed_values_path=str(path))
+        self.process(authz_service, "https://idp.example.fr", ["student"])
+        self.process(authz_service, "https://idp.univ.fr", ["faculty"])
+
+    def test_reloads_allowed_values_file(self, tmp_path):
+        path = tmp_path / "allowed_affiliations.yaml"
+        path.write_text("https://idp.example.fr:\n  - student\n")
+        authz_service = self.create_affiliation_checker(
+            allowed_values_path=str(path), reload_interval=0
+        )
+        path.write_text("https://idp.example.fr:\n  - alum\n")
+        os.utime(path, (0, 0))
+        self.process(authz_service, "https://idp.example.fr", ["alum"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.example.fr", ["student"])
+
+    def test_keeps_index_when_reload_fails(self, tmp_path):
+        path = tmp_path / "allowed_affiliations.yaml"
+        path.write_text("https://idp.example.fr:\n  - student\n")
+        authz_service = self.create_affiliation_checker(
+            allowed_values_path=str(path), reload_interval=0
+        )
+        path.write_text("https://idp.example.fr: [student\n")
+        os.utime(path, (0, 0))
+        self.process(authz_service, "https://idp.example.fr", ["student"])
+
+    def test_keeps_index_when_reloaded_values_are_a_string(self, tmp_path):
+        path = tmp_path / "allowed_affiliations.yaml"
+        path.write_text("https://idp.example.fr:\n  - student\n")
+        authz_service = self.create_affiliation_checker(
+            allowed_values_path=str(path), reload_interval=0
+        )
+        path.write_text("https://idp.example.fr: s\n")
+        os.utime(path, (0, 0))
+        self.process(authz_service, "https://idp.example.fr", ["student"])
+        with pytest.raises(SATOSAAuthenticationError):
+            self.process(authz_service, "https://idp.example.fr", ["s"])
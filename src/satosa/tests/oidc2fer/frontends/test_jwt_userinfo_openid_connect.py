@@ -0,0 +1,403 @@
+import json
+import time
+from unittest import mock
+
+import pytest
+import yaml
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jwkest.jwk import load_jwks, rsa_load
+from jwkest.jws import JWS, factory
+from oic.oic.message import AuthorizationRequest
+from prometheus_client import REGISTRY
+from satosa.context import Context
+from satosa.frontends import openid_connect
+
+from oidc2fer.frontends import jwt_userinfo_openid_connect
+from oidc2fer.frontends.jwt_userinfo_openid_connect import (
+    JWTUserInfoOpenIDConnectFrontend,
+)
+
+INTERNAL_ATTRIBUTES = {
+    "attributes": {
+        "mail": {"openid": ["email"]},
+        "uid": {"openid": ["uid"]},
+    }
+}
+
+
+@pytest.fixture(name="signing_key_path")
+def fixture_signing_key_path(tmp_path):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = tmp_path / "frontend.key"
+    path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        )
+    )
+    return str(path)
+
+
+@pytest.fixture(name="ec_signing_key_path")
+def fixture_ec_signing_key_path(tmp_path):
+    key = ec.generate_private_key(ec.SECP256R1())
+    path = tmp_path / "frontend-ec.key"
+    path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return str(path)
+
+
+class TestJWTUserInfoOpenIDConnectFrontend:  # pylint: disable=too-many-public-methods
+    def create_frontend(self, signing_key_path, userinfo_cache=None, **kwargs):
+        config = {
+            "signing_key_path": signing_key_path,
+            "signing_key_id": "frontend.key1",
+            **kwargs,
+            "db_uri": "stateless://:STATE-ENCRYPTION-KEY@localhost",
+            "sub_mirror_public": True,
+            "provider": {
+                "response_types_supported": ["code"],
+                "subject_types_supported": ["public"],
+                "scopes_supported": ["openid", "email", "uid"],
+                "access_token_lifetime": 60,
+                "extra_scopes": {"uid": ["uid"]},
+            },
+        }
+        if userinfo_cache is not None:
+            config["userinfo_cache"] = userinfo_cache
+        return JWTUserInfoOpenIDConnectFrontend(
+            None, INTERNAL_ATTRIBUTES, config, "https://satosa.example.com", "OIDC"
+        )
+
+    def create_access_token(self, frontend):
+        auth_req = AuthorizationRequest(
+            client_id="client",
+            redirect_uri="https://client.example.com/cb",
+            response_type="code",
+            scope=["openid", "email", "uid"],
+        )
+        # This is what the token endpoint does when exchanging a code
+        # pylint: disable-next=protected-access
+        return frontend.provider.authz_state._create_access_token(
+            "user@example.fr",
+            auth_req.to_dict(),
+            " ".join(auth_req["scope"]),
+            user_info={"email": "user@example.fr", "uid": "user@example.fr"},
+        ).value
+
+    def userinfo_context(self, access_token):
+        context = Context()
+        context.request = {}
+        context.request_authorization = f"Bearer {access_token}"
+        return context
+
+    def test_returns_signed_userinfo(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        access_token = self.create_access_token(frontend)
+        response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert response.status == "200 OK"
+        assert ("Content-Type", "application/jwt") in response.headers
+        assert response.message.count(".") == 2
+
+    def test_caches_signed_userinfo(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        access_token = self.create_access_token(frontend)
+        first = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        with mock.patch.object(
+            frontend.provider, "handle_userinfo_request"
+        ) as handle_userinfo_request:
+            second = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        handle_userinfo_request.assert_not_called()
+        assert second.message == first.message
+        assert frontend.userinfo_cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    def test_introspects_access_token_once(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        access_token = self.create_access_token(frontend)
+        # pylint: disable-next=protected-access
+        introspect = frontend._introspect_access_token
+        with mock.patch.object(
+            frontend, "_introspect_access_token", wraps=introspect
+        ) as introspect:
+            frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        introspect.assert_called_once_with(access_token)
+        assert len(frontend.userinfo_cache) == 1
+
+    def test_counts_cache_lookups(self, signing_key_path):
+        def count(result):
+            return (
+                REGISTRY.get_sample_value(
+                    "oidc2fer_cache_lookups_total",
+                    {"cache": "userinfo", "result": result},
+                )
+                or 0
+            )
+
+        frontend = self.create_frontend(signing_key_path)
+        access_token = self.create_access_token(frontend)
+        hits, misses = count("hit"), count("miss")
+        frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert (count("hit") - hits, count("miss") - misses) == (1, 1)
+
+    def test_cache_is_keyed_on_access_token(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        frontend.userinfo_endpoint(
+            self.userinfo_context(self.create_access_token(frontend))
+        )
+        frontend.userinfo_endpoint(
+            self.userinfo_context(self.create_access_token(frontend))
+        )
+        assert frontend.userinfo_cache.stats() == {"hits": 0, "misses": 2, "size": 2}
+
+    def test_cache_does_not_outlive_access_token(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path, {"ttl": 3600})
+        assert frontend.userinfo_cache_ttl == 60
+        access_token = self.create_access_token(frontend)
+        frontend.userinfo_endpoint(self.userinfo_context(access_token))
+
+        later = time.time() + 61
+        with (
+            mock.patch("time.time", return_value=later),
+            mock.patch.object(frontend.userinfo_cache, "_clock", return_value=later),
+        ):
+            response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert response.status == "401 Unauthorized"
+
+    def test_does_not_cache_errors(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        response = frontend.userinfo_endpoint(self.userinfo_context("invalid"))
+        assert response.status == "401 Unauthorized"
+        assert len(frontend.userinfo_cache) == 0
+
+    def test_cache_can_be_disabled(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path, {"max_size": 0})
+        access_token = self.create_access_token(frontend)
+        frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert frontend.userinfo_cache.stats() == {"hits": 0, "misses": 2, "size": 0}
+
+    def test_returns_userinfo_of_stateless_token(self, signing_key_path):
+        frontend = self.create_frontend(
+            signing_key_path, token_keys=[{"kid": "1", "key": "secret"}]
+        )
+        access_token = self.create_access_token(frontend)
+        assert access_token.startswith("1.")
+        response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert response.status == "200 OK"
+
+    def test_signs_userinfo_with_ec_key(self, ec_signing_key_path):
+        frontend = self.create_frontend(ec_signing_key_path)
+        access_token = self.create_access_token(frontend)
+        response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        jwks = frontend.jwks(Context()).message.decode()
+        assert factory(response.message).jwt.headers["alg"] == "ES256"
+        claims = JWS().verify_compact(response.message, load_jwks(jwks))
+        assert claims["uid"] == "user@example.fr"
+
+    def test_restores_rsa_key_loading(self, ec_signing_key_path):
+        self.create_frontend(ec_signing_key_path)
+        assert openid_connect.rsa_load is rsa_load
+
+    def test_loads_rsa_key_with_other_satosa_version(
+        self, signing_key_path, monkeypatch
+    ):
+        monkeypatch.setattr(
+            jwt_userinfo_openid_connect, "PATCHED_SATOSA_VERSIONS", ("8.4.0",)
+        )
+        with mock.patch.object(
+            openid_connect, "rsa_load", wraps=rsa_load
+        ) as satosa_rsa_load:
+            frontend = self.create_frontend(signing_key_path)
+        satosa_rsa_load.assert_called_once_with(signing_key_path)
+        access_token = self.create_access_token(frontend)
+        response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert response.status == "200 OK"
+
+    def test_announces_signing_algorithm(self, ec_signing_key_path):
+        frontend = self.create_frontend(ec_signing_key_path)
+        response = frontend.provider_config(Context())
+        configuration = json.loads(response.message)
+        assert configuration["id_token_signing_alg_values_supported"] == ["ES256"]
+
+    def test_serves_documents_with_etag(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        for endpoint in (frontend.provider_config, frontend.jwks):
+            response = endpoint(Context())
+            headers = dict(response.headers)
+            assert response.status == "200 OK"
+            assert headers["Cache-Control"] == "public, max-age=300"
+
+            context = Context()
+            context.http_headers = {"HTTP_IF_NONE_MATCH": f"W/{headers['ETag']}"}
+            not_modified = endpoint(context)
+            assert not_modified.status == "304 Not Modified"
+            assert not not_modified.message
+
+    def test_renders_documents_once(self, signing_key_path):
+        frontend = self.create_frontend(signing_key_path)
+        expected = frontend.provider.provider_configuration.to_json().encode()
+        with mock.patch.object(
+            type(frontend.provider), "provider_configuration"
+        ) as provider_configuration:
+            response = frontend.provider_config(Context())
+        assert response.message == expected
+        assert not provider_configuration.mock_calls
+
+    def write_ring(self, path, keys):
+        # Replaced atomically, like the deployments do
+        path.with_suffix(".tmp").write_text(
+            yaml.safe_dump(
+                [
+                    {"kid": kid, "path": key_path, "status": status}
+                    for kid, key_path, status in keys
+                ]
+            )
+        )
+        path.with_suffix(".tmp").rename(path)
+
+    def create_ring_frontend(self, ring_path, signing_key_path):
+        return self.create_frontend(
+            signing_key_path, signing_keys_path=str(ring_path), signing_keys_interval=0
+        )
+
+    def published_kids(self, frontend):
+        jwks = json.loads(frontend.jwks(Context()).message)
+        return [key["kid"] for key in jwks["keys"]]
+
+    def test_signs_with_current_key(
+        self, tmp_path, signing_key_path, ec_signing_key_path
+    ):
+        ring_path = tmp_path / "signing_keys.yaml"
+        self.write_ring(
+            ring_path,
+            [
+                ("key1", signing_key_path, "current"),
+                ("key2", ec_signing_key_path, "next"),
+            ],
+        )
+        frontend = self.create_ring_frontend(ring_path, ec_signing_key_path)
+        access_token = self.create_access_token(frontend)
+        response = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert factory(response.message).jwt.headers["kid"] == "key1"
+        assert self.published_kids(frontend) == ["key1", "key2"]
+        configuration = json.loads(frontend.provider_config(Context()).message)
+        assert configuration["id_token_signing_alg_values_supported"] == [
+            "RS256",
+            "ES256",
+        ]
+
+    def test_rotates_without_restart(
+        self, tmp_path, signing_key_path, ec_signing_key_path
+    ):
+        ring_path = tmp_path / "signing_keys.yaml"
+        self.write_ring(
+            ring_path,
+            [
+                ("key1", signing_key_path, "current"),
+                ("key2", ec_signing_key_path, "next"),
+            ],
+        )
+        frontend = self.create_ring_frontend(ring_path, ec_signing_key_path)
+        access_token = self.create_access_token(frontend)
+        before = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        etag = dict(frontend.jwks(Context()).headers)["ETag"]
+
+        self.write_ring(
+            ring_path,
+            [
+                ("key2", ec_signing_key_path, "current"),
+                ("key1", signing_key_path, "previous"),
+            ],
+        )
+        jwks_response = frontend.jwks(Context())
+        after = frontend.userinfo_endpoint(self.userinfo_context(access_token))
+        assert dict(jwks_response.headers)["ETag"] != etag
+        assert self.published_kids(frontend) == ["key2", "key1"]
+        assert factory(after.message).jwt.headers["kid"] == "key2"
+        assert frontend.provider.signing_key.kid == "key2"
+        # The tokens signed before the rotation can still be verified
+        jwks = load_jwks(jwks_response.message.decode())
+        for response in (before, after):
+            claims = JWS().verify_compact(response.message, jwks)
+            assert claims["uid"] == "user@example.fr"
+
+    def test_keeps_previous_ring_on_error(self, tmp_path, signing_key_path):
+        ring_path = tmp_path / "signing_keys.yaml"
+        self.write_ring(ring_path, [("key1", signing_key_path, "current")])
+        frontend = self.create_ring_frontend(ring_path, signing_key_path)
+        self.write_ring(ring_path, [("key2", str(tmp_path / "missing.key"), "current")])
+        assert self.published_kids(frontend) == ["key1"]
+        assert frontend.signing_key.kid == "key1"
+
+    def write_clients(self, path, client_secret):
+        path.with_suffix(".tmp").write_text(
+            json.dumps(
+                {
+                    "client": {
+                        "client_secret": client_secret,
+                        "redirect_uris": ["https://client.example.com/cb"],
+                        "response_types": ["code"],
+                        "token_endpoint_auth_method": "client_secret_post",
+                    }
+                }
+            )
+        )
+        path.with_suffix(".tmp").rename(path)
+
+    def exchange_code(self, frontend, client_secret):
+        auth_req = AuthorizationRequest(
+            client_id="client",
+            redirect_uri="https://client.example.com/cb",
+            response_type="code",
+            scope=["openid", "email"],
+        )
+        # This is what the authentication response does
+        authz_state = frontend.provider.authz_state
+        sub = authz_state.get_subject_identifier("public", "user@example.fr")
+        code = authz_state.create_authorization_code(
+            auth_req, sub, user_info={"email": "user@example.fr"}
+        )
+        context = Context()
+        context.request_authorization = ""
+        context.request = {
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": "https://client.example.com/cb",
+            "client_id": "client",
+            "client_secret": client_secret,
+        }
+        return frontend.token_endpoint(context).status
+
+    def test_reloads_clients(self, tmp_path, signing_key_path):
+        client_db_path = tmp_path / "client_db.json"
+        self.write_clients(client_db_path, "secret")
+        frontend = self.create_frontend(
+            signing_key_path,
+            client_db_path=str(client_db_path),
+            client_db_interval=0,
+        )
+        assert self.exchange_code(frontend, "secret") == "200 OK"
+        assert self.exchange_code(frontend, "new secret") == "401 Unauthorized"
+
+        self.write_clients(client_db_path, "new secret")
+        assert self.exchange_code(frontend, "new secret") == "200 OK"
+        assert self.exchange_code(frontend, "secret") == "401 Unauthorized"
+
+    def test_keeps_previous_clients_on_error(self, tmp_path, signing_key_path):
+        client_db_path = tmp_path / "client_db.json"
+        self.write_clients(client_db_path, "secret")
+        frontend = self.create_frontend(
+            signing_key_path,
+            client_db_path=str(client_db_path),
+            client_db_interval=0,
+        )
+        client_db_path.write_text("{")
+        assert self.exchange_code(frontend, "secret") == "200 OK"
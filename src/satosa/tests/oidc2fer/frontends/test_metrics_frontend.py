@@ -0,0 +1,53 @@
+import pytest
+from prometheus_client import CONTENT_TYPE_LATEST
+from satosa.context import Context
+
+from oidc2fer.frontends.metrics import MetricsFrontend
+
+TOKEN = "metrics-token"
+
+
+class TestMetricsFrontend:
+    def create_endpoint(self, config):
+        frontend = MetricsFrontend(
+            None, {"attributes": {}}, config, "https://satosa.example.com", "metrics"
+        )
+        ((regex, endpoint),) = frontend.register_endpoints(["Saml2"])
+        assert regex == "^metrics$"
+        return endpoint
+
+    def scrape(self, endpoint, authorization=None):
+        context = Context()
+        if authorization is not None:
+            context.request_authorization = authorization
+        return endpoint(context)
+
+    def test_exports_metrics(self):
+        endpoint = self.create_endpoint({"bearer_token": TOKEN})
+        response = self.scrape(endpoint, f"Bearer {TOKEN}")
+        assert response.status == "200 OK"
+        assert "# TYPE oidc2fer_requests_total counter" in response.message
+        assert ("Content-Type", CONTENT_TYPE_LATEST) in response.headers
+
+    @pytest.mark.parametrize(
+        "authorization", [None, "", "Bearer wrong-token", f"Basic {TOKEN}"]
+    )
+    def test_refuses_scrapes_without_token(self, authorization):
+        endpoint = self.create_endpoint({"bearer_token": TOKEN})
+        response = self.scrape(endpoint, authorization)
+        assert response.status == "401 Unauthorized"
+        assert ("WWW-Authenticate", "Bearer") in response.headers
+        assert "oidc2fer_requests_total" not in response.message
+
+    def test_reads_token_from_environment(self, monkeypatch):
+        monkeypatch.setenv("METRICS_TOKEN", TOKEN)
+        endpoint = self.create_endpoint(None)
+        assert self.scrape(endpoint, f"Bearer {TOKEN}").status == "200 OK"
+        assert self.scrape(endpoint, "Bearer wrong").status == "401 Unauthorized"
+
+    @pytest.mark.parametrize("config", [None, {"bearer_token": ""}])
+    def test_refuses_all_scrapes_without_configured_token(self, monkeypatch, config):
+        monkeypatch.delenv("METRICS_TOKEN", raising=False)
+        endpoint = self.create_endpoint(config)
+        assert self.scrape(endpoint, "Bearer ").status == "401 Unauthorized"
+        assert self.scrape(endpoint, "").status == "401 Unauthorized"
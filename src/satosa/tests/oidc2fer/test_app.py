@@ -0,0 +1,88 @@
+from http.cookies import SimpleCookie
+
+import pytest
+from satosa.context import Context
+from satosa.exception import SATOSAConfigurationError
+from satosa.response import Response
+from satosa.satosa_config import SATOSAConfig
+from satosa.state import State
+
+from oidc2fer.app import GatewayApplication
+
+ENCRYPTION_KEY = "0123456789abcdef" * 4
+
+
+def create_config(**kwargs):
+    return SATOSAConfig(
+        {
+            "BASE": "https://satosa.example.com",
+            "COOKIE_STATE_NAME": "SATOSA_STATE",
+            "STATE_ENCRYPTION_KEY": ENCRYPTION_KEY,
+            "INTERNAL_ATTRIBUTES": {"attributes": {}},
+            "BACKEND_MODULES": [
+                {
+                    "module": "satosa.backends.github.GitHubBackend",
+                    "name": "github",
+                    "config": {
+                        "authz_page": "github/auth/callback",
+                        "base_url": "https://satosa.example.com",
+                        "client_config": {"client_id": "client"},
+                        "client_secret": "secret",
+                        "response_type": "code",
+                        "scope": [],
+                        "server_info": {},
+                        "user_id_attr": "id",
+                    },
+                }
+            ],
+            "FRONTEND_MODULES": [
+                {
+                    "module": "satosa.frontends.ping.PingFrontend",
+                    "name": "ping",
+                    "config": None,
+                }
+            ],
+            **kwargs,
+        }
+    )
+
+
+def save_and_load_state(gateway):
+    """
+    Returns the state cookie saved by `gateway`, and the state it loads back.
+    """
+    context = Context()
+    context.state = State()
+    context.state["ROUTER"] = "ping"
+    response = Response("OK")
+    # pylint: disable-next=protected-access
+    gateway._save_state(response, context)
+    cookie = SimpleCookie(
+        "; ".join(value for header, value in response.headers if header == "Set-Cookie")
+    )
+    context = Context()
+    context.cookie = f"SATOSA_STATE={cookie['SATOSA_STATE'].value}"
+    # pylint: disable-next=protected-access
+    gateway._load_state(context)
+    return cookie["SATOSA_STATE"].value, context.state
+
+
+class TestGatewayApplication:
+    def test_keeps_state_in_satosa_cookie(self):
+        value, state = save_and_load_state(GatewayApplication(create_config()))
+        assert not value.startswith("1.")
+        assert state["ROUTER"] == "ping"
+
+    def test_keeps_state_in_compact_cookie(self):
+        gateway = GatewayApplication(create_config(STATE_COOKIE={}))
+        value, state = save_and_load_state(gateway)
+        assert value.startswith("1.")
+        assert state["ROUTER"] == "ping"
+
+    def test_refuses_legacy_name_with_cookies_samesite_compat(self):
+        config = create_config(
+            STATE_COOKIE={"legacy_name": "SATOSA_STATE_LEGACY"},
+            cookies_samesite_compat=[["SATOSA_STATE", "SATOSA_STATE_LEGACY"]],
+        )
+        with pytest.raises(SATOSAConfigurationError, match="cookies_samesite_compat"):
+            GatewayApplication(config)
@@ -0,0 +1,47 @@
+from oidc2fer.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    def test_returns_cached_value(self):
+        cache = TTLCache(10, clock=FakeClock())
+        cache.set("key", "value", 1010)
+        assert cache.get("key") == "value"
+        assert cache.stats() == {"hits": 1, "misses": 0, "size": 1}
+
+    def test_expires_entries(self):
+        clock = FakeClock()
+        cache = TTLCache(10, clock=clock)
+        cache.set("key", "value", 1010)
+        clock.now = 1010
+        assert cache.get("key") is None
+        assert cache.stats() == {"hits": 0, "misses": 1, "size": 0}
+
+    def test_ignores_already_expired_entries(self):
+        cache = TTLCache(10, clock=FakeClock())
+        cache.set("key", "value", 999)
+        assert len(cache) == 0
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, clock=FakeClock())
+        cache.set("a", 1, 1010)
+        cache.set("b", 2, 1010)
+        cache.get("a")
+        cache.set("c", 3, 1010)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    def test_deletes_entries(self):
+        cache = TTLCache(10, clock=FakeClock())
+        cache.set("key", "value", 1010)
+        cache.delete("key")
+        cache.delete("unknown")
+        assert cache.get("key") is None
@@ -0,0 +1,60 @@
+import io
+import json
+
+import pytest
+from pyop.client_authentication import verify_client_authentication
+from pyop.exceptions import InvalidClientAuthentication
+
+from oidc2fer.client_registry import ClientSecret, load_clients
+
+CLIENTS = {
+    "client": {
+        "client_secret": "secret",
+        "redirect_uris": ["https://client.example.com/cb"],
+        "response_types": ["code"],
+        "token_endpoint_auth_method": "client_secret_post",
+    },
+    "public": {"redirect_uris": ["https://public.example.com/cb"]},
+}
+
+
+def load(clients):
+    return load_clients(io.StringIO(json.dumps(clients)))
+
+
+class TestClientSecret:
+    def test_compares_with_strings(self):
+        secret = ClientSecret("secret")
+        assert secret == "secret"
+        assert secret != "other secret"
+        assert "secret" not in repr(secret)
+
+
+class TestLoadClients:
+    def test_loads_read_only_clients(self):
+        clients = load(CLIENTS)
+        assert clients["client"]["redirect_uris"] == frozenset(
+            ["https://client.example.com/cb"]
+        )
+        assert clients["client"]["response_types"] == ("code",)
+        assert "client_secret" not in clients["public"]
+        with pytest.raises(TypeError):
+            clients["client"]["client_secret"] = "other secret"
+        with pytest.raises(TypeError):
+            clients["other"] = {}
+
+    def test_pyop_checks_secrets(self):
+        clients = load(CLIENTS)
+        request = {"client_id": "client", "client_secret": "secret"}
+        assert verify_client_authentication(clients, request) == "client"
+        with pytest.raises(InvalidClientAuthentication):
+            verify_client_authentication(
+                clients, {**request, "client_secret": "other secret"}
+            )
+        with pytest.raises(InvalidClientAuthentication):
+            verify_client_authentication(clients, {"client_id": "client"})
+
+    @pytest.mark.parametrize("clients", [[], {"client": []}])
+    def test_rejects_invalid_clients(self, clients):
+        with pytest.raises(TypeError):
+            load(clients)
@@ -0,0 +1,63 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from oidc2fer.file_watcher import FileWatcher
+
+
+class TestFileWatcher:
+    def create_watcher(self, path, interval=0):
+        watcher = FileWatcher(str(path), interval)
+        watcher.loaded(os.stat(path))
+        return watcher
+
+    def test_unchanged_file(self, tmp_path):
+        path = tmp_path / "file"
+        path.write_text("content")
+        watcher = self.create_watcher(path)
+        assert not watcher.changed()
+
+    def test_replaced_file(self, tmp_path):
+        path = tmp_path / "file"
+        path.write_text("content")
+        stat_result = os.stat(path)
+        watcher = self.create_watcher(path)
+        replacement = tmp_path / "replacement"
+        replacement.write_text("content")
+        os.utime(replacement, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        os.replace(replacement, path)
+        assert watcher.changed()
+
+    def test_missing_file(self, tmp_path):
+        path = tmp_path / "file"
+        path.write_text("content")
+        watcher = self.create_watcher(path)
+        path.unlink()
+        assert not watcher.changed()
+
+    def test_checks_at_most_every_interval(self, tmp_path):
+        path = tmp_path / "file"
+        path.write_text("content")
+        watcher = self.create_watcher(path, interval=3600)
+        assert not watcher.changed()
+        path.write_text("new content")
+        assert not watcher.changed()
+
+    def test_reports_change_to_one_thread(self, tmp_path):
+        path = tmp_path / "file"
+        path.write_text("content")
+        watcher = self.create_watcher(path)
+        watcher.interval = 3600
+        replacement = tmp_path / "replacement"
+        replacement.write_text("new content")
+        os.replace(replacement, path)
+
+        barrier = threading.Barrier(8)
+
+        def changed():
+            barrier.wait()
+            return watcher.changed()
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda _: changed(), range(8)))
+        assert results.count(True) == 1
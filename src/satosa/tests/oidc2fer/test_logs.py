@@ -0,0 +1,222 @@
+import gc
+import io
+import json
+import logging
+import sys
+import weakref
+from datetime import UTC, datetime
+
+from oidc2fer import logs
+from oidc2fer.logs import (
+    DefaultJSONFormatter,
+    QueueStreamHandler,
+    RequestJSONFormatter,
+    SamplingFilter,
+    UTCTime,
+    logger_config,
+)
+
+
+def create_record(msg="Hello %s", args=("world",), level=logging.INFO, **kwargs):
+    record = logging.LogRecord("oidc2fer.test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(kwargs)
+    return record
+
+
+class TestUTCTime:
+    def test_formats_like_isoformat(self):
+        format_time = UTCTime()
+        for created in (1792336740.0, 1792336740.123456, 1792336741.999999):
+            assert format_time(created) == datetime.fromtimestamp(
+                created, UTC
+            ).isoformat(timespec="microseconds")
+
+
+class TestDefaultJSONFormatter:
+    def test_formats_record(self):
+        record = create_record(created=1792336740.5, process=42, siret="123")
+        assert json.loads(DefaultJSONFormatter().format(record)) == {
+            "siret": "123",
+            "message": "Hello world",
+            "time": "2026-10-18T15:19:00.500000+00:00",
+            "logger": "oidc2fer.test",
+            "level": "INFO",
+            "pid": 42,
+        }
+
+    def test_appends_static_fields(self):
+        formatter = DefaultJSONFormatter(fields={"service": "oidc2fer"})
+        assert json.loads(formatter.format(create_record()))["service"] == "oidc2fer"
+
+    def test_formats_exception(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = create_record(exc_info=sys.exc_info())
+            line = json.loads(DefaultJSONFormatter().format(record))
+            assert line["exc_info"].endswith("ValueError: boom")
+
+    def test_stringifies_unserializable_extras(self):
+        record = create_record(value={1, 2})
+        assert json.loads(DefaultJSONFormatter().format(record))["value"] == "{1, 2}"
+
+
+class TestRequestJSONFormatter:
+    def test_formats_access_record(self):
+        args = {
+            "h": "127.0.0.1",
+            "m": "GET",
+            "U": "/OIDC/authorization",
+            "q": "client_id=1",
+            "s": 303,
+            "a": "curl/8",
+            "f": "-",
+            "M": 12,
+        }
+        record = create_record(msg="%(h)s", args=(args,), created=1792336740.25)
+        assert json.loads(RequestJSONFormatter().format(record)) == {
+            "logger": "oidc2fer.test",
+            "level": "INFO",
+            "remote_ip": "127.0.0.1",
+            "method": "GET",
+            "path": "/OIDC/authorization?client_id=1",
+            "status": "303",
+            "time": "2026-10-18T15:19:00.250000+00:00",
+            "user_agent": "curl/8",
+            "referer": "-",
+            "duration_in_ms": 12,
+            "pid": record.process,
+        }
+
+
+class TestSamplingFilter:
+    def test_keeps_one_record_in_sample(self):
+        sampling = SamplingFilter(sample=3)
+        kept = [r for r in (create_record() for _ in range(9)) if sampling.filter(r)]
+        assert len(kept) == 3
+        assert all(record.sample_rate == 3 for record in kept)
+
+    def test_limits_records_per_second(self):
+        sampling = SamplingFilter(per_second=2)
+        kept = [sampling.filter(create_record(created=100.5)) for _ in range(5)]
+        assert kept == [True, True, False, False, False]
+        record = create_record(created=101.0)
+        assert sampling.filter(record)
+        assert vars(record)["dropped"] == 3
+
+    def test_keeps_warnings(self):
+        sampling = SamplingFilter(sample=100, per_second=0)
+        assert sampling.filter(create_record(level=logging.WARNING))
+
+
+class TestLoggerConfig:
+    def test_level(self):
+        assert logger_config("debug") == {"level": "DEBUG"}
+
+    def test_sampling(self):
+        config = logger_config({"level": "INFO", "sample": 10})
+        assert config["level"] == "INFO"
+        assert config["filters"][0].sample == 10
+        assert logger_config({"per_second": 5})["filters"][0].per_second == 5
+
+    def test_without_sampling(self):
+        assert logger_config({"level": "info"}) == {"level": "INFO"}
+
+
+class TestQueueStreamHandler:
+    def create_logger(self, handler):
+        logger = logging.getLogger("oidc2fer.test.queue")
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        return logger
+
+    def test_writes_records_from_thread(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(DefaultJSONFormatter())
+        logger = self.create_logger(handler)
+        for i in range(3):
+            logger.info("Record %d", i)
+        handler.close()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [line["message"] for line in lines] == [f"Record {i}" for i in range(3)]
+
+    def test_drops_records_when_full(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream, max_size=1)
+        handler.setFormatter(DefaultJSONFormatter())
+        handler.stop()
+        logger = self.create_logger(handler)
+        for i in range(3):
+            logger.info("Record %d", i)
+        assert handler.dropped == 2
+        handler.queue.get_nowait()
+        logger.info("Record 3")
+        handler.start()
+        handler.close()
+        line = json.loads(stream.getvalue())
+        assert line["message"] == "Record 3"
+        assert line["queue_dropped"] == 2
+
+    def test_resolves_records_in_caller_thread(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(DefaultJSONFormatter())
+        handler.stop()
+        logger = self.create_logger(handler)
+        values = ["a"]
+        logger.info("Values %s", values)
+        values.append("b")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("Failed")
+        record = handler.queue.queue[-1]
+        assert record.exc_info is None
+        assert record.args is None
+        assert record.exc_text.endswith("ValueError: boom")
+        handler.start()
+        handler.close()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert lines[0]["message"] == "Values ['a']"
+        assert lines[1]["exc_info"].endswith("ValueError: boom")
+
+    def test_formats_access_records(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(RequestJSONFormatter())
+        args = {"h": "127.0.0.1", "m": "GET", "U": "/", "q": "", "s": 200}
+        args.update({"a": "curl/8", "f": "-", "M": 12})
+        self.create_logger(handler).info("%(h)s", args)
+        handler.close()
+        line = json.loads(stream.getvalue())
+        assert line["remote_ip"] == "127.0.0.1"
+        assert line["status"] == "200"
+
+    def test_restarts_in_child(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(DefaultJSONFormatter())
+        handler.stop()
+        handler.start_in_child()
+        self.create_logger(handler).info("In the child")
+        handler.close()
+        assert json.loads(stream.getvalue())["message"] == "In the child"
+
+    def test_fork_hooks_hold_handlers_weakly(self):
+        # pylint: disable=protected-access
+        handler = QueueStreamHandler(io.StringIO())
+        logs._stop_queue_stream_handlers()
+        assert handler.listener is None
+        logs._start_queue_stream_handlers()
+        assert handler.listener is not None
+        handler.close()
+        assert handler not in logs._queue_stream_handlers
+        handler = QueueStreamHandler(io.StringIO())
+        listener = handler.listener
+        reference = weakref.ref(handler)
+        del handler
+        gc.collect()
+        assert reference() is None
+        listener.stop()
@@ -0,0 +1,145 @@
+import datetime
+import json
+import shutil
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.config import IdPConfig, SPConfig
+from saml2.metadata import entities_descriptor, entity_descriptor
+from saml2.sigver import SignatureError, security_context
+
+from oidc2fer.metadata_cache import build_metadata_cache
+
+IDP_ENTITY_ID = "https://idp.example.fr/idp/shibboleth"
+SSO_URL = "https://idp.example.fr/idp/profile/SAML2/Redirect/SSO"
+
+requires_xmlsec1 = pytest.mark.skipif(
+    shutil.which("xmlsec1") is None, reason="Signing metadata needs xmlsec1"
+)
+
+
+def create_key_pair(directory, name):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    now = datetime.datetime.now(datetime.UTC)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .sign(key, hashes.SHA256())
+    )
+    key_path = directory / f"{name}.key"
+    cert_path = directory / f"{name}.crt"
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        )
+    )
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    return str(key_path), str(cert_path)
+
+
+class TestMetadataCache:
+    def create_federation(self, directory, sign=False):
+        """
+        Writes federation metadata with an IdP and an SP, as a local stand-in
+        for the RENATER federation, and returns its path and signing cert.
+        """
+        key_file, cert_file = create_key_pair(directory, "federation")
+        idp_config = IdPConfig().load(
+            {
+                "entityid": IDP_ENTITY_ID,
+                "key_file": key_file,
+                "cert_file": cert_file,
+                "service": {
+                    "idp": {
+                        "endpoints": {
+                            "single_sign_on_service": [
+                                (SSO_URL, BINDING_HTTP_REDIRECT)
+                            ],
+                        },
+                    },
+                },
+            }
+        )
+        sp_config = SPConfig().load(
+            {
+                "entityid": "https://sp.example.fr",
+                "service": {
+                    "sp": {
+                        "endpoints": {
+                            "assertion_consumer_service": ["https://sp.example.fr/acs"],
+                        },
+                    },
+                },
+            }
+        )
+        entities, signed_xml = entities_descriptor(
+            [entity_descriptor(idp_config), entity_descriptor(sp_config)],
+            valid_for=0,
+            name=None,
+            ident="federation",
+            sign=sign,
+            secc=security_context(idp_config) if sign else None,
+        )
+        metadata = signed_xml or str(entities)
+        path = directory / "federation.xml"
+        path.write_text(metadata)
+        return str(path), cert_file
+
+    def load_cache(self, path):
+        config = SPConfig().load(
+            {"entityid": "https://oidc2fer.example.com", "metadata": {"mdfile": [path]}}
+        )
+        return config.metadata
+
+    def test_caches_idps(self, tmp_path):
+        federation, _ = self.create_federation(tmp_path)
+        cache_path = str(tmp_path / "metadata.json")
+        assert build_metadata_cache(federation, cache_path) == 1
+
+        metadata = self.load_cache(cache_path)
+        assert list(metadata.keys()) == [IDP_ENTITY_ID]
+        (service,) = metadata.single_sign_on_service(
+            IDP_ENTITY_ID, BINDING_HTTP_REDIRECT
+        )
+        assert service["location"] == SSO_URL
+        assert metadata.certs(IDP_ENTITY_ID, "idpsso", "signing")
+
+    def test_cache_is_compact(self, tmp_path):
+        federation, _ = self.create_federation(tmp_path)
+        cache_path = tmp_path / "metadata.json"
+        build_metadata_cache(federation, str(cache_path))
+        assert "\n" not in cache_path.read_text()
+        assert json.loads(cache_path.read_text())[0][0] == IDP_ENTITY_ID
+
+    @requires_xmlsec1
+    def test_checks_signature(self, tmp_path):
+        federation, cert_file = self.create_federation(tmp_path, sign=True)
+        cache_path = str(tmp_path / "metadata.json")
+        assert build_metadata_cache(federation, cache_path, cert_file) == 1
+
+    @requires_xmlsec1
+    def test_rejects_wrong_signature(self, tmp_path):
+        federation, _ = self.create_federation(tmp_path, sign=True)
+        _, other_cert_file = create_key_pair(tmp_path, "other")
+        cache_path = tmp_path / "metadata.json"
+        with pytest.raises(SignatureError):
+            build_metadata_cache(federation, str(cache_path), other_cert_file)
+        assert not cache_path.exists()
+
+    @requires_xmlsec1
+    def test_rejects_unsigned_metadata(self, tmp_path):
+        federation, cert_file = self.create_federation(tmp_path)
+        with pytest.raises(SignatureError):
+            build_metadata_cache(federation, str(tmp_path / "md.json"), cert_file)
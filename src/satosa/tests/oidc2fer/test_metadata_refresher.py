@@ -0,0 +1,156 @@
+import fcntl
+
+from prometheus_client import REGISTRY
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.client import Saml2Client
+from saml2.config import IdPConfig, SPConfig
+from saml2.metadata import entities_descriptor, entity_descriptor
+
+from oidc2fer import metrics
+from oidc2fer.metadata_cache import build_metadata_cache
+from oidc2fer.metadata_refresher import MetadataRefresher
+
+
+def write_federation(path, *idp_entity_ids):
+    idp_configs = [
+        IdPConfig().load(
+            {
+                "entityid": entity_id,
+                "service": {
+                    "idp": {
+                        "endpoints": {
+                            "single_sign_on_service": [
+                                (f"{entity_id}/sso", BINDING_HTTP_REDIRECT)
+                            ],
+                        },
+                    },
+                },
+            }
+        )
+        for entity_id in idp_entity_ids
+    ]
+    entities, _ = entities_descriptor(
+        [entity_descriptor(config) for config in idp_configs],
+        valid_for=0,
+        name=None,
+        ident="federation",
+        sign=False,
+        secc=None,
+    )
+    path.write_text(str(entities))
+
+
+class TestMetadataRefresher:
+    def create_refresher(self, tmp_path, **config):
+        federation = tmp_path / "federation.xml"
+        write_federation(federation, "https://idp.example.fr")
+        cache_path = str(tmp_path / "metadata.json")
+        build_metadata_cache(str(federation), cache_path)
+        client = Saml2Client(
+            SPConfig().load(
+                {
+                    "entityid": "https://oidc2fer.example.com",
+                    "metadata": {"mdfile": [cache_path]},
+                }
+            )
+        )
+        refresher = MetadataRefresher(cache_path, {"source": str(federation), **config})
+        refresher.watch(client)
+        return refresher
+
+    def sample(self, name):
+        return REGISTRY.get_sample_value(name) or 0
+
+    def idps(self, refresher):
+        return list(refresher.entity.metadata.identity_providers())
+
+    def test_swaps_refreshed_metadata(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=0)
+        previous_metadata = refresher.entity.metadata.metadata
+        write_federation(tmp_path / "federation.xml", "https://idp.autre.fr")
+
+        refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.autre.fr"]
+        assert refresher.entity.metadata.metadata is not previous_metadata
+        assert refresher.stats()["metadata_staleness_seconds"] < 60
+        assert refresher.stats()["metadata_refresh_failures"] == 0
+
+    def test_keeps_last_known_good_metadata(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=0)
+        (tmp_path / "federation.xml").write_text("<EntitiesDescriptor")
+
+        refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.example.fr"]
+        assert refresher.stats()["metadata_refresh_failures"] == 1
+
+    def test_waits_before_retrying(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=0)
+        (tmp_path / "federation.xml").write_text("<EntitiesDescriptor")
+        refresher.run_once()
+        write_federation(tmp_path / "federation.xml", "https://idp.autre.fr")
+
+        refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.example.fr"]
+
+    def test_does_not_refresh_fresh_metadata(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=3600)
+        write_federation(tmp_path / "federation.xml", "https://idp.autre.fr")
+
+        refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.example.fr"]
+
+    def test_builds_missing_cache(self, tmp_path):
+        federation = tmp_path / "federation.xml"
+        write_federation(federation, "https://idp.example.fr")
+        cache_path = tmp_path / "metadata.json"
+        refresher = MetadataRefresher(str(cache_path), {"source": str(federation)})
+
+        refresher.refresh(wait=True)
+        assert "https://idp.example.fr" in cache_path.read_text()
+
+    def test_only_one_process_refreshes(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=0)
+        write_federation(tmp_path / "federation.xml", "https://idp.autre.fr")
+
+        with open(f"{refresher.cache_path}.lock", "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.example.fr"]
+
+    def test_reloads_cache_refreshed_by_another_process(self, tmp_path):
+        refresher = self.create_refresher(tmp_path, interval=3600)
+        write_federation(tmp_path / "federation.xml", "https://idp.autre.fr")
+        build_metadata_cache(str(tmp_path / "federation.xml"), refresher.cache_path)
+
+        refresher.run_once()
+        assert self.idps(refresher) == ["https://idp.autre.fr"]
+        assert refresher.stats()["metadata_reload_duration_seconds"] is not None
+
+    def test_exports_metrics(self, tmp_path):
+        refreshes = self.sample("oidc2fer_metadata_refresh_duration_seconds_count")
+        reloads = self.sample("oidc2fer_metadata_reload_duration_seconds_count")
+        failures = self.sample("oidc2fer_metadata_refresh_failures_total")
+        refresher = self.create_refresher(tmp_path, interval=0, retry_interval=0)
+
+        refresher.run_once()
+        (tmp_path / "federation.xml").write_text("<EntitiesDescriptor")
+        refresher.run_once()
+        assert (
+            self.sample("oidc2fer_metadata_refresh_duration_seconds_count") - refreshes
+            == 2
+        )
+        assert (
+            self.sample("oidc2fer_metadata_reload_duration_seconds_count") - reloads
+            == 1
+        )
+        assert self.sample("oidc2fer_metadata_refresh_failures_total") - failures == 1
+        assert 0 <= self.sample("oidc2fer_metadata_staleness_seconds") < 60
+
+        content, _ = metrics.render()
+        for name in (
+            "oidc2fer_metadata_staleness_seconds",
+            "oidc2fer_metadata_refresh_duration_seconds",
+            "oidc2fer_metadata_reload_duration_seconds",
+            "oidc2fer_metadata_refresh_failures_total",
+        ):
+            assert f"\n{name}" in content
@@ -0,0 +1,79 @@
+import functools
+import subprocess
+import sys
+
+import pytest
+from prometheus_client import REGISTRY
+from satosa.response import BadRequest, Response
+
+from oidc2fer import metrics
+
+
+def process(_context, binding):
+    return Response(binding)
+
+
+class TestMetrics:
+    def count(self, endpoint, outcome):
+        return REGISTRY.get_sample_value(
+            "oidc2fer_requests_total", {"endpoint": endpoint, "outcome": outcome}
+        )
+
+    def test_names_endpoints(self):
+        spec = functools.partial(process, binding="post")
+        assert metrics.qualified_name("Saml2", spec) == "Saml2.process"
+        counted = metrics.count_requests("Saml2.process", spec)
+        assert metrics.qualified_name("Saml2", counted) == "Saml2.process"
+
+    def test_counts_requests_by_outcome(self):
+        def endpoint(context):
+            if context == "invalid":
+                return BadRequest("invalid")
+            if context == "unauthorized":
+                raise ValueError(context)
+            return Response("ok")
+
+        counted = metrics.count_requests("OIDC.test_endpoint", endpoint)
+        counted("valid")
+        counted("invalid")
+        with pytest.raises(ValueError):
+            counted("unauthorized")
+
+        assert self.count("OIDC.test_endpoint", "success") == 1
+        assert self.count("OIDC.test_endpoint", "error") == 2
+        assert (
+            REGISTRY.get_sample_value(
+                "oidc2fer_request_duration_seconds_count",
+                {"endpoint": "OIDC.test_endpoint"},
+            )
+            == 3
+        )
+
+    def test_bounds_issuer_labels(self, monkeypatch):
+        monkeypatch.setattr(metrics, "_issuers", set())
+        monkeypatch.setattr(metrics, "MAX_ISSUERS", 2)
+        assert metrics.issuer_label("https://idp1.fr") == "https://idp1.fr"
+        assert metrics.issuer_label(None) == ""
+        assert metrics.issuer_label("https://idp2.fr") == metrics.OTHER_ISSUER
+        assert metrics.issuer_label("https://idp1.fr") == "https://idp1.fr"
+
+    def test_adds_up_metrics_of_workers(self, tmp_path, monkeypatch):
+        # prometheus_client picks the multiprocess mode when it is imported
+        for _ in range(2):
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "from oidc2fer.metrics import SIRET_MAPPING_MISSES;"
+                    "SIRET_MAPPING_MISSES.labels('https://idp.example.fr').inc()",
+                ],
+                check=True,
+                env={"PROMETHEUS_MULTIPROC_DIR": str(tmp_path)},
+            )
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+        content, _ = metrics.render()
+        assert (
+            'oidc2fer_siret_mapping_misses_total{issuer="https://idp.example.fr"} 2.0'
+            in content.splitlines()
+        )
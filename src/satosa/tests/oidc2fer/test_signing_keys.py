@@ -0,0 +1,120 @@
+import io
+import json
+
+import pytest
+import yaml
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jwkest import jws
+from jwkest.jwk import RSAKey, rsa_load
+from jwkest.jws import JWS
+
+from oidc2fer import signing_keys
+from oidc2fer.signing_keys import (
+    PreparedKeySigner,
+    PreparedPrivateKey,
+    load_key_ring,
+    load_signing_key,
+    register_signers,
+)
+
+CLAIMS = {"sub": "user@example.fr", "aud": "client"}
+
+
+def write_key(path, key):
+    path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return str(path)
+
+
+class TestLoadSigningKey:
+    def sign(self, key):
+        return JWS(json.dumps(CLAIMS), alg=key.alg).sign_compact([key])
+
+    def test_loads_rsa_key(self, tmp_path):
+        path = write_key(
+            tmp_path / "rsa.key", rsa.generate_private_key(65537, key_size=2048)
+        )
+        key = load_signing_key(path, "key1")
+        assert (key.kty, key.alg, key.kid) == ("RSA", "RS256", "key1")
+        assert isinstance(key.get_key(private=True), PreparedPrivateKey)
+        # The signature is the same as pyjwkest's, PKCS#1 v1.5 is deterministic
+        plain_key = RSAKey(key=rsa_load(path), alg="RS256", kid="key1")
+        assert self.sign(key) == self.sign(plain_key)
+
+    def test_loads_ec_key(self, tmp_path):
+        path = write_key(tmp_path / "ec.key", ec.generate_private_key(ec.SECP256R1()))
+        key = load_signing_key(path, "key1")
+        assert (key.kty, key.alg, key.crv) == ("EC", "ES256", "P-256")
+        assert JWS().verify_compact(self.sign(key), [key]) == CLAIMS
+
+    def test_rejects_other_curves(self, tmp_path):
+        path = write_key(tmp_path / "ec.key", ec.generate_private_key(ec.SECP384R1()))
+        with pytest.raises(ValueError):
+            load_signing_key(path)
+
+    def test_pyjwkest_keys_still_sign(self, tmp_path):
+        path = write_key(
+            tmp_path / "rsa.key", rsa.generate_private_key(65537, key_size=2048)
+        )
+        load_signing_key(path)
+        plain_key = RSAKey(key=rsa_load(path), alg="RS256")
+        assert JWS().verify_compact(self.sign(plain_key), [plain_key]) == CLAIMS
+
+    def test_wraps_pyjwkest_signers(self, tmp_path):
+        path = write_key(tmp_path / "ec.key", ec.generate_private_key(ec.SECP256R1()))
+        load_signing_key(path)
+        for alg, signer_class in (("RS256", jws.RSASigner), ("ES256", jws.DSASigner)):
+            signer = jws.SIGNER_ALGS[alg]
+            assert isinstance(signer, PreparedKeySigner)
+            # pylint: disable-next=no-member
+            assert isinstance(signer.signer, signer_class)
+
+    def test_signs_with_pyjwkest_with_other_version(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(signing_keys, "PATCHED_PYJWKEST_VERSIONS", ("1.4.2",))
+        register_signers.cache_clear()
+        try:
+            path = write_key(
+                tmp_path / "ec.key", ec.generate_private_key(ec.SECP256R1())
+            )
+            key = load_signing_key(path)
+        finally:
+            register_signers.cache_clear()
+        assert key.prepared is None
+        assert JWS().verify_compact(self.sign(key), [key]) == CLAIMS
+
+
+class TestLoadKeyRing:
+    def write_ring(self, tmp_path, statuses):
+        ring = []
+        for i, status in enumerate(statuses):
+            path = write_key(
+                tmp_path / f"key{i}.key", ec.generate_private_key(ec.SECP256R1())
+            )
+            ring.append({"kid": f"key{i}", "path": path, "status": status})
+        return io.StringIO(yaml.safe_dump(ring))
+
+    def test_publishes_next_and_previous_keys(self, tmp_path):
+        key_ring = load_key_ring(
+            self.write_ring(tmp_path, ["previous", "current", "next"])
+        )
+        assert key_ring.current.kid == "key1"
+        assert [key["kid"] for key in key_ring.jwks()["keys"]] == [
+            "key1",
+            "key2",
+            "key0",
+        ]
+        assert all("d" not in key for key in key_ring.jwks()["keys"])
+        assert key_ring.algorithms == ["ES256"]
+
+    @pytest.mark.parametrize(
+        "statuses", [[], ["next"], ["current", "current"], ["current", "revoked"]]
+    )
+    def test_rejects_invalid_ring(self, tmp_path, statuses):
+        with pytest.raises(ValueError):
+            load_key_ring(self.write_ring(tmp_path, statuses))
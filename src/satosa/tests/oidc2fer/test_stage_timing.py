@@ -0,0 +1,147 @@
+import logging
+from types import SimpleNamespace
+
+from prometheus_client import CollectorRegistry, Histogram
+from satosa.internal import AuthenticationInformation, InternalData
+
+from oidc2fer.stage_timing import StageTimings, instrument
+
+IDP_ENTITY_ID = "https://idp.example.fr/idp/shibboleth"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeMicroService:
+    def __init__(self, name, clock, duration):
+        self.name = name
+        self.next = None
+        self.clock = clock
+        self.duration = duration
+
+    def process(self, context, data):
+        self.clock.now += self.duration
+        return self.next(context, data)
+
+
+class FakeFrontend:
+    def __init__(self, clock):
+        self.clock = clock
+
+    def handle_authn_response(self, _context, _internal_response):
+        self.clock.now += 0.003
+        return "response"
+
+    def ping_endpoint(self, _context):
+        self.clock.now += 0.1
+        return "pong"
+
+
+class FakeSATOSA:
+    """
+    The parts of a SATOSABase that are instrumented, with a backend whose ACS
+    endpoint takes 5 ms and two micro-services taking 1 and 2 ms.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        frontend = FakeFrontend(clock)
+        self.response_micro_services = [
+            FakeMicroService("AttributeFilter", clock, 0.001),
+            FakeMicroService("AffiliationChecker", clock, 0.002),
+        ]
+        self.response_micro_services[0].next = self.response_micro_services[1].process
+        self.response_micro_services[1].next = self.finish
+        self.module_router = SimpleNamespace(
+            backends={
+                "Saml2": {
+                    "instance": None,
+                    "endpoints": [("^Saml2/acs/post$", self.acs_endpoint)],
+                }
+            },
+            frontends={
+                "OIDC": {"instance": frontend, "endpoints": []},
+                "ping": {
+                    "instance": frontend,
+                    "endpoints": [("^ping", frontend.ping_endpoint)],
+                },
+            },
+        )
+        self.frontend = frontend
+
+    def acs_endpoint(self, context):
+        self.clock.now += 0.005
+        data = InternalData(auth_info=AuthenticationInformation(issuer=IDP_ENTITY_ID))
+        return self.response_micro_services[0].process(context, data)
+
+    def finish(self, context, data):
+        return self.frontend.handle_authn_response(context, data)
+
+    def endpoint(self, module_type, name):
+        ((_, spec),) = getattr(self.module_router, module_type)[name]["endpoints"]
+        return spec
+
+
+def create_timings(log_interval=60, clock=None):
+    registry = CollectorRegistry()
+    histogram = Histogram(
+        "stage_duration_seconds", "Test stages", ["stage"], registry=registry
+    )
+    timings = StageTimings(histogram, log_interval, clock=clock or FakeClock())
+    return timings, registry
+
+
+class TestStageTimings:
+    def create_satosa(self, log_interval=60):
+        clock = FakeClock()
+        satosa = FakeSATOSA(clock)
+        timings, registry = create_timings(log_interval, clock)
+        instrument(satosa, timings, excluded_modules=["ping"])
+        return satosa, registry
+
+    def durations(self, registry):
+        (metric,) = registry.collect()
+        return {
+            sample.labels["stage"]: round(sample.value, 6)
+            for sample in metric.samples
+            if sample.name == "stage_duration_seconds_sum"
+        }
+
+    def test_records_time_spent_in_each_stage(self):
+        satosa, registry = self.create_satosa()
+        assert satosa.endpoint("backends", "Saml2")(None) == "response"
+
+        assert self.durations(registry) == {
+            "Saml2.acs_endpoint": 0.005,
+            "AttributeFilter.process": 0.001,
+            "AffiliationChecker.process": 0.002,
+            "OIDC.handle_authn_response": 0.003,
+        }
+
+    def test_excludes_modules(self):
+        satosa, registry = self.create_satosa()
+        assert satosa.endpoint("frontends", "ping")(None) == "pong"
+        assert not self.durations(registry)
+
+    def test_records_stage_without_issuer(self):
+        timings, registry = create_timings()
+        timings.time("OIDC.token_endpoint", lambda context: None)(None)
+        assert list(self.durations(registry)) == ["OIDC.token_endpoint"]
+
+    def test_logs_timings_since_last_log(self, caplog):
+        satosa, _ = self.create_satosa(log_interval=0)
+        with caplog.at_level(logging.INFO, logger="oidc2fer.stage_timing"):
+            satosa.endpoint("backends", "Saml2")(None)
+            satosa.endpoint("backends", "Saml2")(None)
+
+        acs_records = [
+            record for record in caplog.records if record.stage == "Saml2.acs_endpoint"
+        ]
+        assert [record.count for record in acs_records] == [1, 1]
+        assert acs_records[0].issuer == IDP_ENTITY_ID
+        assert acs_records[0].p95_ms == 5.0
@@ -0,0 +1,191 @@
+from http.cookies import SimpleCookie
+
+import pytest
+from satosa.context import Context
+from satosa.response import Redirect
+from satosa.state import State
+
+from oidc2fer.state_cookie import (
+    StateCookies,
+    decode_state,
+    encode_state,
+    needs_legacy_cookie,
+)
+
+ENCRYPTION_KEY = "0123456789abcdef" * 4
+OIDC_REQUEST = (
+    "client_id=oidc-test-client&redirect_uri=https%3A%2F%2Fclient.example.com"
+    "%2Fredirect_uri&response_type=code&scope=openid+email+uid&state=state"
+    "&nonce=nonce&acr_values=eidas1"
+)
+STATES = {
+    "authorize": {
+        "SESSION_ID": "urn:uuid:6570fd03-b4f6-491f-8bd8-b1f17bb28e52",
+        "OIDC": {"oidc_request": OIDC_REQUEST},
+        "SATOSA_BASE": {"requester": "oidc-test-client"},
+        "ROUTER": "OIDC",
+        "force_authn": None,
+    },
+    "discovery": {
+        "SESSION_ID": "urn:uuid:6570fd03-b4f6-491f-8bd8-b1f17bb28e52",
+        "OIDC": {"oidc_request": OIDC_REQUEST},
+        "SATOSA_BASE": {"requester": "oidc-test-client"},
+        "ROUTER": "OIDC",
+        "force_authn": None,
+        "Saml2": {"relay_state": "kWRJ7urVt596vYIQ"},
+    },
+    "unknown_fields": {
+        "SESSION_ID": "not a UUID",
+        "OIDC": {"oidc_request": "unknown=%C3%A9t%C3%A9&state=", "other": [1, 2]},
+        "SATOSA_BASE": {},
+        "ROUTER": 42,
+        "Saml2": {"relay_state": "état"},
+    },
+    "not_urlencoded_back_the_same": {
+        "OIDC": {"oidc_request": "scope=openid%20email&state=a%2Fb&nonce=n"},
+    },
+    "empty": {},
+}
+LEGACY_USER_AGENT = (
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 12_5_7 like Mac OS X) AppleWebKit/605.1.15"
+    " (KHTML, like Gecko) Version/12.1.2 Mobile/15E148 Safari/604.1"
+)
+CURRENT_USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
+    " Chrome/131.0.0.0 Safari/537.36"
+)
+
+
+class TestStateCodec:
+    @pytest.mark.parametrize("name", STATES)
+    def test_round_trip(self, name):
+        value = encode_state(STATES[name], ENCRYPTION_KEY)
+        assert decode_state(value, ENCRYPTION_KEY) == STATES[name]
+
+    @pytest.mark.parametrize("name", ["authorize", "discovery"])
+    def test_smaller_than_satosa_cookie(self, name):
+        state = State()
+        state.data = STATES[name]
+        satosa_value = state.urlstate(ENCRYPTION_KEY)
+        assert len(encode_state(STATES[name], ENCRYPTION_KEY)) < len(satosa_value) / 2
+
+    def test_rejects_tampered_state(self):
+        value = encode_state(STATES["authorize"], ENCRYPTION_KEY)
+        tampered = value[:-2] + ("AA" if value[-2:] != "AA" else "BB")
+        with pytest.raises(ValueError):
+            decode_state(tampered, ENCRYPTION_KEY)
+
+    def test_rejects_other_key(self):
+        value = encode_state(STATES["authorize"], ENCRYPTION_KEY)
+        with pytest.raises(ValueError):
+            decode_state(value, "other key")
+
+
+class TestNeedsLegacyCookie:
+    @pytest.mark.parametrize(
+        "user_agent",
+        [
+            LEGACY_USER_AGENT,
+            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/605.1.15"
+            " (KHTML, like Gecko) Version/12.1.2 Safari/605.1.15",
+            "Mozilla/5.0 (Windows NT 10.0) AppleWebKit/537.36 (KHTML, like Gecko)"
+            " Chrome/65.0.3325.181 Safari/537.36",
+            "Mozilla/5.0 (Linux; U; Android 8.0.0) AppleWebKit/537.36 (KHTML, like"
+            " Gecko) Version/4.0 UCBrowser/12.13.0.1207 Mobile Safari/537.36",
+            None,
+        ],
+    )
+    def test_incompatible_user_agents(self, user_agent):
+        assert needs_legacy_cookie(user_agent)
+
+    @pytest.mark.parametrize(
+        "user_agent",
+        [
+            CURRENT_USER_AGENT,
+            "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15"
+            " (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+            "Mozilla/5.0 (Linux; U; Android 10) AppleWebKit/537.36 (KHTML, like Gecko)"
+            " Version/4.0 UCBrowser/13.4.0.1306 Mobile Safari/537.36",
+        ],
+    )
+    def test_compatible_user_agents(self, user_agent):
+        assert not needs_legacy_cookie(user_agent)
+
+
+class TestStateCookies:
+    def create_state_cookies(self):
+        return StateCookies(
+            {
+                "COOKIE_STATE_NAME": "SATOSA_STATE",
+                "STATE_ENCRYPTION_KEY": ENCRYPTION_KEY,
+            },
+            "SATOSA_STATE_LEGACY",
+        )
+
+    def create_context(self, cookie="", user_agent=CURRENT_USER_AGENT):
+        context = Context()
+        context.cookie = cookie
+        context.http_headers = {"HTTP_USER_AGENT": user_agent}
+        return context
+
+    def save(self, state_cookies, context):
+        response = Redirect("https://example.com")
+        state_cookies.save(response, context)
+        return {
+            name: morsel
+            for header, value in response.headers
+            if header == "Set-Cookie"
+            for name, morsel in SimpleCookie(value).items()
+        }
+
+    def test_saves_and_loads_state(self):
+        state_cookies = self.create_state_cookies()
+        context = self.create_context()
+        context.state = State()
+        context.state["OIDC"] = {"oidc_request": OIDC_REQUEST}
+        cookies = self.save(state_cookies, context)
+        assert set(cookies) == {"SATOSA_STATE"}
+        assert cookies["SATOSA_STATE"]["samesite"] == "None"
+        assert cookies["SATOSA_STATE"]["secure"]
+
+        loaded = self.create_context(f"SATOSA_STATE={cookies['SATOSA_STATE'].value}")
+        state_cookies.load(loaded)
+        assert loaded.state.state_dict == context.state.state_dict
+
+    def test_saves_legacy_cookie_for_incompatible_user_agents(self):
+        state_cookies = self.create_state_cookies()
+        context = self.create_context(user_agent=LEGACY_USER_AGENT)
+        context.state = State()
+        cookies = self.save(state_cookies, context)
+        assert cookies["SATOSA_STATE_LEGACY"].value == cookies["SATOSA_STATE"].value
+        assert not cookies["SATOSA_STATE_LEGACY"]["samesite"]
+
+        # The user agent dropped the SameSite=None cookie
+        loaded = self.create_context(
+            f"SATOSA_STATE_LEGACY={cookies['SATOSA_STATE_LEGACY'].value}",
+            LEGACY_USER_AGENT,
+        )
+        state_cookies.load(loaded)
+        assert loaded.state.session_id == context.state.session_id
+
+    def test_replaces_legacy_cookie_sent_by_user_agent(self):
+        state_cookies = self.create_state_cookies()
+        context = self.create_context("SATOSA_STATE_LEGACY=old")
+        context.state = State()
+        context.state.delete = True
+        cookies = self.save(state_cookies, context)
+        assert cookies["SATOSA_STATE_LEGACY"]["max-age"] == "0"
+        assert cookies["SATOSA_STATE"]["max-age"] == "0"
+
+    def test_loads_satosa_cookie(self):
+        state = State()
+        state["ROUTER"] = "OIDC"
+        context = self.create_context(f"SATOSA_STATE={state.urlstate(ENCRYPTION_KEY)}")
+        self.create_state_cookies().load(context)
+        assert context.state.state_dict == state.state_dict
+
+    @pytest.mark.parametrize("value", ["1.garbage", "1.", "garbage"])
+    def test_ignores_invalid_cookie(self, value):
+        context = self.create_context(f"SATOSA_STATE={value}")
+        self.create_state_cookies().load(context)
+        assert list(context.state.state_dict) == ["SESSION_ID"]
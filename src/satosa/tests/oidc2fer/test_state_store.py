@@ -0,0 +1,150 @@
+from http.cookies import SimpleCookie
+
+import pytest
+from satosa.context import Context
+from satosa.response import Redirect
+from satosa.state import State
+
+from oidc2fer import workers
+from oidc2fer.state_cookie import StateCookies
+from oidc2fer.state_store import (
+    MemoryStateStore,
+    SQLiteStateStore,
+    create_store,
+)
+
+ENCRYPTION_KEY = "0123456789abcdef" * 4
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name="create_state_store", params=["memory", "sqlite"])
+def fixture_create_state_store(request, tmp_path):
+    def create(ttl=900, clock=None):
+        clock = clock or FakeClock()
+        if request.param == "memory":
+            return MemoryStateStore(ttl, clock=clock)
+        return SQLiteStateStore(str(tmp_path / "state.sqlite"), ttl, clock=clock)
+
+    return create
+
+
+class TestStateStore:
+    def test_saves_and_deletes_state(self, create_state_store):
+        store = create_state_store()
+        store.set("id", b"state")
+        assert store.get("id") == b"state"
+        store.set("id", b"other state")
+        assert store.get("id") == b"other state"
+        store.delete("id")
+        assert store.get("id") is None
+        assert store.get("unknown") is None
+
+    def test_expires_state(self, create_state_store):
+        clock = FakeClock()
+        store = create_state_store(ttl=60, clock=clock)
+        store.set("id", b"state")
+        clock.now += 59
+        assert store.get("id") == b"state"
+        clock.now += 1
+        assert store.get("id") is None
+
+    def test_sqlite_store_is_shared(self, tmp_path):
+        path = str(tmp_path / "state.sqlite")
+        SQLiteStateStore(path).set("id", b"state")
+        assert SQLiteStateStore(path).get("id") == b"state"
+
+    def test_sqlite_store_deletes_expired_states(self, tmp_path):
+        clock = FakeClock()
+        store = SQLiteStateStore(str(tmp_path / "state.sqlite"), 60, 10, clock)
+        store.set("old", b"state")
+        clock.now += 60
+        store.set("new", b"state")
+        rows = store.connection.execute("SELECT id FROM states").fetchall()
+        assert rows == [("new",)]
+
+
+class TestCreateStore:
+    def test_creates_stores(self, tmp_path):
+        assert create_store({}) is None
+        assert isinstance(create_store({"store": "memory"}), MemoryStateStore)
+        store = create_store(
+            {"store": "sqlite", "path": str(tmp_path / "state.sqlite"), "ttl": 60}
+        )
+        assert isinstance(store, SQLiteStateStore)
+        assert store.ttl == 60
+
+    def test_memory_store_runs_in_a_single_worker(self, monkeypatch):
+        monkeypatch.setattr(workers, "_single_worker_reasons", set())
+        create_store({"store": "memory"})
+        with pytest.raises(RuntimeError, match="memory state store"):
+            workers.check(2)
+
+    def test_rejects_unknown_store(self):
+        with pytest.raises(ValueError):
+            create_store({"store": "redis"})
+
+
+class TestStoredStateCookies:
+    def create_state_cookies(self, store):
+        return StateCookies(
+            {
+                "COOKIE_STATE_NAME": "SATOSA_STATE",
+                "STATE_ENCRYPTION_KEY": ENCRYPTION_KEY,
+            },
+            store=store,
+        )
+
+    def create_context(self, cookie=""):
+        context = Context()
+        context.cookie = cookie
+        context.http_headers = {"HTTP_USER_AGENT": "Mozilla/5.0"}
+        return context
+
+    def save(self, state_cookies, context):
+        response = Redirect("https://example.com")
+        state_cookies.save(response, context)
+        return {
+            name: morsel
+            for header, value in response.headers
+            if header == "Set-Cookie"
+            for name, morsel in SimpleCookie(value).items()
+        }
+
+    def test_keeps_state_in_store(self, create_state_store):
+        store = create_state_store()
+        state_cookies = self.create_state_cookies(store)
+        context = self.create_context()
+        context.state = State()
+        context.state["ROUTER"] = "OIDC"
+        value = self.save(state_cookies, context)["SATOSA_STATE"].value
+        assert value.startswith("s.")
+        assert store.get(value[2:]) is not None
+
+        loaded = self.create_context(f"SATOSA_STATE={value}")
+        state_cookies.load(loaded)
+        assert loaded.state.state_dict == context.state.state_dict
+
+        # The next hops keep the same ID
+        loaded.state["Saml2"] = {"relay_state": "relay"}
+        assert self.save(state_cookies, loaded)["SATOSA_STATE"].value == value
+
+        loaded.state.delete = True
+        assert self.save(state_cookies, loaded)["SATOSA_STATE"]["max-age"] == "0"
+        assert store.get(value[2:]) is None
+
+    def test_skips_empty_state(self, create_state_store):
+        context = self.create_context()
+        context.state = State()
+        assert not self.save(self.create_state_cookies(create_state_store()), context)
+
+    def test_ignores_expired_state(self, create_state_store):
+        context = self.create_context("SATOSA_STATE=s.unknown")
+        self.create_state_cookies(create_state_store()).load(context)
+        assert list(context.state.state_dict) == ["SESSION_ID"]
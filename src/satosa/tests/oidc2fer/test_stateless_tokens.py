@@ -0,0 +1,93 @@
+import pytest
+from pyop.storage import StatelessWrapper
+
+from oidc2fer.stateless_tokens import StatelessTokenDB, TokenCodec, load_token_keys
+
+ACCESS_TOKEN = {
+    "iat": 1792336740,
+    "exp": 1792336800,
+    "sub": "user@example.fr",
+    "client_id": "client",
+    "aud": ["client"],
+    "scope": "openid email uid",
+    "granted_scope": "openid email uid",
+    "token_type": "Bearer",
+    "auth_req": {
+        "client_id": "client",
+        "redirect_uri": "https://client.example.com/cb",
+        "response_type": "code",
+        "scope": "openid email uid",
+        "state": "state",
+        "nonce": "nonce",
+    },
+    "user_info": {"email": "user@example.fr", "uid": "user@example.fr"},
+}
+
+
+class TestTokenCodec:
+    def test_round_trip(self):
+        codec = TokenCodec([("1", "secret")])
+        token = codec.encode(ACCESS_TOKEN, "access_tokens")
+        assert token.startswith("1.")
+        assert codec.decode(token, "access_tokens") == ACCESS_TOKEN
+
+    def test_smaller_than_pyop_token(self):
+        token = TokenCodec([("1", "secret")]).encode(ACCESS_TOKEN, "access_tokens")
+        pyop_token = StatelessWrapper("access_tokens", "secret").pack(ACCESS_TOKEN)
+        assert len(token) < len(pyop_token) / 2
+
+    def test_rejects_token_of_other_collection(self):
+        codec = TokenCodec([("1", "secret")])
+        token = codec.encode(ACCESS_TOKEN, "access_tokens")
+        with pytest.raises(ValueError):
+            codec.decode(token, "authz_codes")
+
+    def test_rejects_tampered_token(self):
+        codec = TokenCodec([("1", "secret")])
+        token = codec.encode(ACCESS_TOKEN, "access_tokens")
+        tampered = token[:-2] + ("AA" if token[-2:] != "AA" else "BB")
+        with pytest.raises(ValueError):
+            codec.decode(tampered, "access_tokens")
+
+    def test_rejects_empty_key(self):
+        with pytest.raises(ValueError, match="empty"):
+            load_token_keys([{"kid": "1", "key": ""}])
+
+    def test_rotates_keys(self):
+        previous = TokenCodec([("1", "secret")])
+        token = previous.encode(ACCESS_TOKEN, "access_tokens")
+        codec = load_token_keys([{"kid": 2, "key": "new"}, {"kid": 1, "key": "secret"}])
+        assert codec.encode(ACCESS_TOKEN, "access_tokens").startswith("2.")
+        assert codec.decode(token, "access_tokens") == ACCESS_TOKEN
+
+        with pytest.raises(ValueError):
+            TokenCodec([("2", "new")]).decode(token, "access_tokens")
+
+    @pytest.mark.parametrize("keys", [[], [("", "secret")], [("a.b", "secret")]])
+    def test_rejects_invalid_keys(self, keys):
+        with pytest.raises(ValueError):
+            TokenCodec(keys)
+
+
+class TestStatelessTokenDB:
+    def create_db(self):
+        return StatelessTokenDB("access_tokens", TokenCodec([("1", "secret")]))
+
+    def test_packs_and_unpacks(self):
+        db = self.create_db()
+        token = db.pack(ACCESS_TOKEN)
+        assert token in db
+        assert db[token] == ACCESS_TOKEN
+        assert db.pack({}) is None
+
+    def test_lookups_do_not_share_payload(self):
+        db = self.create_db()
+        token = db.pack({"used": False})
+        db[token]["used"] = True
+        assert db[token] == {"used": False}
+
+    def test_rejects_pyop_tokens(self):
+        pyop_token = StatelessWrapper("access_tokens", "secret").pack(ACCESS_TOKEN)
+        db = self.create_db()
+        assert pyop_token not in db
+        assert "1.invalid" not in db
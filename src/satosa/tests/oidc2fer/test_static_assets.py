@@ -0,0 +1,74 @@
+import json
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+from whitenoise import WhiteNoise
+
+from oidc2fer.static_assets import build_static, is_fingerprinted
+
+LOGO = "<svg>" + "<rect/>" * 200 + "</svg>"
+INDEX = '<html><body><img src="/images/logo.svg">' + "<p>Redirection</p>" * 50
+
+
+class TestStaticAssets:
+    def create_static(self, tmp_path):
+        source = tmp_path / "static"
+        (source / "images").mkdir(parents=True)
+        (source / "images" / "logo.svg").write_text(LOGO)
+        (source / "index.html").write_text(INDEX)
+        target = tmp_path / "staticfiles"
+        manifest = build_static(str(source), str(target))
+        return target, manifest
+
+    def create_app(self, target):
+        return Client(
+            WhiteNoise(
+                Response("SATOSA"),
+                root=str(target),
+                index_file="index.html",
+                immutable_file_test=is_fingerprinted,
+            )
+        )
+
+    def test_fingerprints_files(self, tmp_path):
+        target, manifest = self.create_static(tmp_path)
+        fingerprinted = manifest["images/logo.svg"]
+        assert is_fingerprinted(fingerprinted)
+        assert (target / fingerprinted).read_text() == LOGO
+        assert (target / "images" / "logo.svg").read_text() == LOGO
+        assert json.loads((target / "staticfiles.json").read_text()) == manifest
+        assert "index.html" not in manifest
+
+    def test_rewrites_references(self, tmp_path):
+        target, manifest = self.create_static(tmp_path)
+        index = (target / "index.html").read_text()
+        assert f'src="/{manifest["images/logo.svg"]}"' in index
+
+    def test_compresses_files(self, tmp_path):
+        target, manifest = self.create_static(tmp_path)
+        for name in ("index.html", manifest["images/logo.svg"]):
+            assert (target / f"{name}.gz").exists()
+            assert (target / f"{name}.br").exists()
+
+    def test_serves_fingerprinted_files_forever(self, tmp_path):
+        target, manifest = self.create_static(tmp_path)
+        client = self.create_app(target)
+        response = client.get(
+            f"/{manifest['images/logo.svg']}", headers={"Accept-Encoding": "br"}
+        )
+        assert response.headers["Content-Encoding"] == "br"
+        assert "immutable" in response.headers["Cache-Control"]
+
+        response = client.get(
+            f"/{manifest['images/logo.svg']}",
+            headers={"If-None-Match": response.headers["ETag"]},
+        )
+        assert response.status_code == 304
+
+    def test_serves_original_names(self, tmp_path):
+        target, _ = self.create_static(tmp_path)
+        client = self.create_app(target)
+        response = client.get("/images/logo.svg", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "immutable" not in response.headers["Cache-Control"]
+        assert client.get("/").status_code == 200
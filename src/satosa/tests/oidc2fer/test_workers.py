@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+from oidc2fer import workers
+
+
+class TestWorkers:
+    @pytest.fixture(autouse=True)
+    def reset_workers(self, monkeypatch):
+        monkeypatch.setattr(workers, "_callbacks", [])
+        monkeypatch.setattr(workers, "_started", threading.Event())
+        monkeypatch.setattr(workers, "_single_worker_reasons", set())
+
+    def test_calls_callbacks_in_each_worker(self):
+        calls = []
+        workers.in_each_worker(lambda: calls.append("refresher"))
+        assert not calls
+
+        workers.start()
+        assert calls == ["refresher"]
+
+    def test_calls_callbacks_now_in_a_worker(self):
+        calls = []
+        workers.start()
+
+        workers.in_each_worker(lambda: calls.append("refresher"))
+        assert calls == ["refresher"]
+
+    def test_refuses_several_workers_for_a_single_worker_app(self):
+        workers.check(4)
+        workers.single_worker("the state is kept in the process")
+        workers.check(1)
+        with pytest.raises(RuntimeError, match="the state is kept in the process"):
+            workers.check(4)